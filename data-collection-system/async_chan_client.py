@@ -0,0 +1,198 @@
+"""
+asyncio version of ChanClient.
+
+Requests take their slot from chan_client.rate_limiter, the same limiter the
+synchronous ChanClient uses, so threads.json polls, crawl_thread jobs and any
+number of concurrent async fetches across boards and worker processes stay
+under the 4chan API's 1 request/second rule together. Within that budget a
+single worker can keep requests in flight instead of idling on latency.
+
+Responses go through ChanClient's http_cache layer, so HTTP_CACHE_MODE
+record/replay/cache covers async crawls and backfills too.
+
+Job handlers call run_fetch_threads(), which runs on one event loop per
+process in a background thread. That loop owns the aiohttp session, so
+concurrent jobs share its connections and never close it under each other.
+"""
+
+import asyncio
+import atexit
+import json
+import logging
+import os
+import threading
+
+import aiohttp
+
+import chan_client
+import http_cache
+from chan_client import API_BASE_URL, NOT_MODIFIED
+
+logger = logging.getLogger("4chan async client")
+logger.propagate = False
+
+log_level_str = os.getenv("LOG_LEVEL", "INFO").upper()
+numeric_level = getattr(logging, log_level_str, logging.INFO)
+
+logger.setLevel(numeric_level)
+if not logger.handlers:
+    sh = logging.StreamHandler()
+    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    sh.setFormatter(formatter)
+    logger.addHandler(sh)
+
+
+CHAN_MAX_IN_FLIGHT = int(os.environ.get("CHAN_MAX_IN_FLIGHT", "8"))
+
+
+class AsyncChanClient:
+    """
+    Use as `async with AsyncChanClient() as client:`. Each client has its own
+    aiohttp session, bound to the loop it was entered in; If-Modified-Since
+    validators and the rate limit are shared with ChanClient.
+    """
+
+    stats = {"requests": 0, "not_modified": 0, "bytes_downloaded": 0, "rate_wait_s": 0.0}
+    _stats_lock = threading.Lock()
+
+    def __init__(self):
+        self._session = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=CHAN_MAX_IN_FLIGHT, keepalive_timeout=60)
+        self._session = aiohttp.ClientSession(connector=connector)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+        return False
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def _incr(self, key, amount=1):
+        with self._stats_lock:
+            self.stats[key] += amount
+
+    async def get_threads(self, board, conditional=False, defer_validator=False):
+        api_call = self.build_request([board, "threads.json"])
+        return await self.execute_request(api_call, conditional, defer_validator)
+
+    async def get_thread(self, board, thread_number, conditional=False, defer_validator=False):
+        api_call = self.build_request([board, "thread", f"{thread_number}.json"])
+        return await self.execute_request(api_call, conditional, defer_validator)
+
+    async def get_catalog(self, board, conditional=False):
+        api_call = self.build_request([board, "catalog.json"])
+        return await self.execute_request(api_call, conditional)
+
+    def build_request(self, call_pieces=[]):
+        return "/".join([API_BASE_URL] + call_pieces)
+
+    async def execute_request(self, api_call, conditional=False, defer_validator=False):
+        headers = {}
+        cached = chan_client.get_validator(api_call)
+        if conditional and cached is not None:
+            headers["If-Modified-Since"] = cached[0]
+
+        logger.info(f"api call: {api_call}")
+        # store reads and writes are file I/O, keep them off the event loop
+        r = await asyncio.to_thread(chan_client._http.lookup, api_call)
+        if r is None:
+            # reserving is a quick flock'd file update; the wait itself is async
+            delay = chan_client.rate_limiter.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._incr("rate_wait_s", delay)
+            self._incr("requests")
+            async with self._session.get(api_call, headers=headers) as response:
+                body = await response.read()
+                r = http_cache.FetchedResponse(api_call, response.status, response.headers, body)
+            await asyncio.to_thread(chan_client._http.save, api_call, r)
+
+        if r.status_code == 304:
+            self._incr("not_modified")
+            return NOT_MODIFIED
+        if r.status_code == 404:
+            logger.info(f"404 for {api_call}")
+            chan_client.drop_validator(api_call)
+            return dict()
+        r.raise_for_status()
+
+        self._incr("bytes_downloaded", len(r.content))
+        if "Last-Modified" in r.headers:
+            chan_client.store_validator(api_call, r.headers["Last-Modified"], len(r.content), defer_validator)
+        # big thread bodies take a while to decode, keep that off the event loop
+        return await asyncio.to_thread(json.loads, r.content)
+
+
+async def fetch_threads(client, board, thread_numbers, conditional=False, defer_validator=False):
+    """
+    Fetch many threads concurrently. Returns {thread_number: thread json}; a
+    thread whose fetch failed maps to the exception so the caller can decide.
+    """
+    thread_numbers = list(thread_numbers)
+    results = await asyncio.gather(
+        *[client.get_thread(board, no, conditional, defer_validator) for no in thread_numbers],
+        return_exceptions=True,
+    )
+    return dict(zip(thread_numbers, results))
+
+
+class LoopThread:
+    """one event loop per process, in a daemon thread, with one long-lived client"""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.client = None
+        self._thread = threading.Thread(target=self.loop.run_forever, name="chan-async-loop", daemon=True)
+        self._thread.start()
+        self._pid = os.getpid()
+        self.run(self._open())
+        atexit.register(self.close)
+
+    async def _open(self):
+        self.client = await AsyncChanClient().__aenter__()
+
+    def close(self):
+        if os.getpid() == self._pid and self.loop.is_running():
+            self.run(self.client.close())
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def run(self, coro):
+        """run a coroutine on the loop and block the calling thread until it is done"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+
+_loop_thread = None
+_loop_thread_pid = None
+_loop_thread_lock = threading.Lock()
+
+
+def get_loop_thread():
+    global _loop_thread, _loop_thread_pid
+    with _loop_thread_lock:
+        # threads don't survive a fork, so a forked worker starts its own
+        if _loop_thread is None or _loop_thread_pid != os.getpid():
+            _loop_thread = LoopThread()
+            _loop_thread_pid = os.getpid()
+        return _loop_thread
+
+
+def run_fetch_threads(board, thread_numbers, conditional=False, defer_validator=False):
+    """blocking wrapper for job handlers; safe to call from several threads at once"""
+    runner = get_loop_thread()
+    return runner.run(fetch_threads(runner.client, board, thread_numbers, conditional, defer_validator))
+
+
+if __name__ == "__main__":
+    async def main():
+        async with AsyncChanClient() as client:
+            threads = await client.get_threads("sp")
+            numbers = [t["no"] for page in threads for t in page["threads"]][:5]
+            print(await fetch_threads(client, "sp", numbers))
+        print(AsyncChanClient.stats)
+
+    asyncio.run(main())
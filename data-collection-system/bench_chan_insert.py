@@ -0,0 +1,101 @@
+"""
+Compare the old per-row insert loop against save_thread_posts.
+
+Writes synthetic threads under a throwaway board name into the real chan_posts
+table (so indexes, hypertable chunks and WAL are all exercised) and deletes
+them again at the end.
+
+    python bench_chan_insert.py [posts_per_thread] [threads]
+"""
+
+import logging
+import sys
+import time
+
+import psycopg2
+
+import seen_filter
+from chan_crawler import DATABASE_URL, post_to_row, save_thread_posts
+
+BENCH_BOARD = "__bench__"
+
+logger = logging.getLogger("bench chan insert")
+logger.propagate = False
+logger.setLevel(logging.INFO)
+sh = logging.StreamHandler()
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+sh.setFormatter(formatter)
+logger.addHandler(sh)
+
+
+def make_thread(thread_number, num_posts):
+    now = int(time.time())
+    posts = []
+    for i in range(num_posts):
+        posts.append(
+            {
+                "no": thread_number + i,
+                "resto": 0 if i == 0 else thread_number,
+                "time": now - num_posts + i,
+                "sub": "bench thread" if i == 0 else None,
+                "com": f"post {i} " + "lorem ipsum " * 20,
+                "replies": num_posts - 1 if i == 0 else None,
+            }
+        )
+    return {"posts": posts}
+
+
+def per_row_insert(conn, board, thread_number, posts):
+    """the pre-bulk code path: one INSERT and one commit per post"""
+    cur = conn.cursor()
+    q = "INSERT INTO chan_posts (board_name, thread_number, post_number, title, text_body, num_replies, created_utc, resto, data) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT (board_name, post_number, created_utc) DO NOTHING;"
+    for post in posts:
+        cur.execute(q, post_to_row(board, thread_number, post))
+        conn.commit()
+    cur.close()
+
+
+def clear_bench_rows(conn):
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM chan_posts WHERE board_name = %s;", (BENCH_BOARD,))
+
+
+def run(name, fn, conn, threads):
+    clear_bench_rows(conn)
+    start = time.perf_counter()
+    for thread_number, thread in threads:
+        fn(conn, BENCH_BOARD, thread_number, thread["posts"])
+    elapsed = time.perf_counter() - start
+    total_posts = sum(len(t["posts"]) for _, t in threads)
+    logger.info(f"{name}: {total_posts} posts in {elapsed:.3f}s ({total_posts / elapsed:.0f} posts/s)")
+    return elapsed
+
+
+if __name__ == "__main__":
+    posts_per_thread = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    num_threads = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    threads = [
+        (1_000_000 * (i + 1), make_thread(1_000_000 * (i + 1), posts_per_thread))
+        for i in range(num_threads)
+    ]
+
+    conn = psycopg2.connect(dsn=DATABASE_URL)
+    try:
+        per_row = run("per-row loop", per_row_insert, conn, threads)
+        bulk = run("bulk insert", save_thread_posts, conn, threads)
+        logger.info(f"speedup: {per_row / bulk:.1f}x")
+
+        # second pass over the same threads is all conflicts, like a re-crawl.
+        # The seen filter would drop every row before Postgres sees it (and
+        # would re-warm with them if cleared), so switch it off to time ON CONFLICT
+        seen_filter.bypass("chan_posts")
+        start = time.perf_counter()
+        skipped = 0
+        for thread_number, thread in threads:
+            skipped += save_thread_posts(conn, BENCH_BOARD, thread_number, thread["posts"])[1]
+        logger.info(f"bulk re-insert: {skipped} skipped in {time.perf_counter() - start:.3f}s")
+    finally:
+        clear_bench_rows(conn)
+        conn.close()
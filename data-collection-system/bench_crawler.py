@@ -0,0 +1,337 @@
+"""
+Offline end-to-end throughput benchmark for chan_crawler and reddit_crawler.
+
+Runs a local HTTP server that serves synthetic 4chan (threads.json,
+thread/N.json, archive.json) and reddit listing payloads, points the clients
+at it, and replaces Faktory with an in-process queue drained by a pool of
+worker threads. The real job handlers run end to end against the database in
+DATABASE_URL (use a scratch TimescaleDB with the migrations applied), and the
+run reports jobs/s, p50/p99 job latency and rows/s written.
+
+    python bench_crawler.py chan --concurrency 4 --threads 150 --posts 120
+    python bench_crawler.py reddit --concurrency 4 --subreddits 20
+
+Rows written under the benchmark board/subreddits are deleted afterwards
+unless --keep is passed.
+"""
+
+import argparse
+import json
+import os
+import queue
+import random
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+BENCH_BOARD = "__bench__"
+BENCH_SUBREDDIT_PREFIX = "__bench__"
+BENCH_SUBREDDIT_ID_PREFIX = "t5_bench"
+
+
+class FakeApi:
+    """generates deterministic synthetic API payloads"""
+
+    def __init__(self, num_threads, posts_per_thread, reddit_page_size, latency_s):
+        self.num_threads = num_threads
+        self.posts_per_thread = posts_per_thread
+        self.reddit_page_size = reddit_page_size
+        self.latency_s = latency_s
+        self.now = int(time.time())
+        self.requests = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+
+    def thread_numbers(self):
+        return [10_000_000 + i * 1_000 for i in range(self.num_threads)]
+
+    def threads_json(self):
+        threads = [
+            {"no": no, "last_modified": self.now, "replies": self.posts_per_thread - 1}
+            for no in self.thread_numbers()
+        ]
+        return [{"page": i // 15 + 1, "threads": threads[i : i + 15]} for i in range(0, len(threads), 15)]
+
+    def thread_json(self, thread_number):
+        posts = []
+        for i in range(self.posts_per_thread):
+            posts.append(
+                {
+                    "no": thread_number + i,
+                    "resto": 0 if i == 0 else thread_number,
+                    "time": self.now - self.posts_per_thread + i,
+                    "sub": "bench thread" if i == 0 else None,
+                    "com": f"post {i} &gt;&gt;{thread_number}<br>" + "lorem ipsum " * random.randint(2, 40),
+                    "replies": self.posts_per_thread - 1 if i == 0 else None,
+                }
+            )
+        return {"posts": posts}
+
+    def reddit_listing(self, subreddit, kind, after):
+        # every page is new content, so each scan writes a full page
+        sub_id = f"{BENCH_SUBREDDIT_ID_PREFIX}_{subreddit}"
+        offset = int(after.split("_")[-1]) if after else 0
+        children = []
+        for i in range(offset, offset + self.reddit_page_size):
+            created = self.now - i
+            if kind == "new":
+                data = {
+                    "subreddit_id": sub_id,
+                    "subreddit": subreddit,
+                    "name": f"t3_{subreddit}_{i}",
+                    "title": f"bench post {i}",
+                    "selftext": "lorem ipsum " * random.randint(0, 60),
+                    "link_flair_text": random.choice(["Discussion", "Highlight", None]),
+                    "author_fullname": f"t2_author{i % 97}",
+                    "url": f"https://example.invalid/{i}",
+                    "media": None,
+                    "created_utc": created,
+                }
+            else:
+                data = {
+                    "subreddit_id": sub_id,
+                    "subreddit": subreddit,
+                    "name": f"t1_{subreddit}_{i}",
+                    "body": "lorem ipsum " * random.randint(1, 40),
+                    "author_fullname": f"t2_author{i % 97}",
+                    "link_id": f"t3_{subreddit}_{i // 10}",
+                    "parent_id": f"t3_{subreddit}_{i // 10}",
+                    "created_utc": created,
+                }
+            children.append({"kind": "t3" if kind == "new" else "t1", "data": data})
+        next_after = f"{children[-1]['data']['name'].split('_')[0]}_{subreddit}_{offset + self.reddit_page_size}"
+        return {"kind": "Listing", "data": {"after": next_after, "children": children}}
+
+    def route(self, path, query):
+        m = re.fullmatch(r"/chan/([^/]+)/threads\.json", path)
+        if m:
+            return self.threads_json()
+        m = re.fullmatch(r"/chan/([^/]+)/thread/(\d+)\.json", path)
+        if m:
+            return self.thread_json(int(m.group(2)))
+        m = re.fullmatch(r"/chan/([^/]+)/archive\.json", path)
+        if m:
+            return self.thread_numbers()
+        m = re.fullmatch(r"/r/([^/]+)/(new|comments)/\.json", path)
+        if m:
+            return self.reddit_listing(m.group(1), m.group(2), query.get("after", [""])[0])
+        return None
+
+
+def make_handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            if api.latency_s:
+                time.sleep(api.latency_s)
+            url = urlparse(self.path)
+            payload = api.route(url.path, parse_qs(url.query))
+            if payload is None:
+                body, status = b"{}", 404
+            else:
+                body, status = json.dumps(payload).encode(), 200
+            with api._lock:
+                api.requests += 1
+                api.bytes_sent += len(body)
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+class InProcessQueue:
+    """
+    Stands in for Faktory: pushes land in a local queue and worker threads run
+    the registered handlers. Scheduled jobs (at=...) are the crawlers
+    rescheduling themselves and are only counted, not run.
+    """
+
+    def __init__(self, handlers):
+        self.handlers = handlers
+        self.jobs = queue.Queue()
+        self.scheduled = 0
+        self.latencies = []
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def push(self, job):
+        if job.at:
+            with self._lock:
+                self.scheduled += 1
+        else:
+            self.jobs.put(job)
+        return True
+
+    def push_bulk(self, jobs):
+        for job in jobs:
+            self.push(job)
+        return {}
+
+    def run_job(self, job):
+        start = time.perf_counter()
+        try:
+            self.handlers[job.jobtype](*job.args)
+        except Exception as e:
+            print(f"job {job.jobtype}{tuple(job.args)} failed: {e}", file=sys.stderr)
+            with self._lock:
+                self.failures += 1
+        with self._lock:
+            self.latencies.append(time.perf_counter() - start)
+
+    def drain(self, concurrency):
+        """run jobs until the queue is empty and every worker is idle"""
+        in_flight = threading.Semaphore(concurrency)
+        pending = []
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            while True:
+                try:
+                    job = self.jobs.get(timeout=0.05)
+                except queue.Empty:
+                    pending = [f for f in pending if not f.done()]
+                    if not pending and self.jobs.empty():
+                        return
+                    continue
+                in_flight.acquire()
+                future = pool.submit(self.run_job, job)
+                future.add_done_callback(lambda _: in_flight.release())
+                pending.append(future)
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, round(p / 100 * (len(values) - 1))))
+    return values[k]
+
+
+def count_rows(conn, mode, subreddits):
+    with conn.cursor() as cur:
+        if mode == "chan":
+            cur.execute("SELECT count(*) FROM chan_posts WHERE board_name = %s;", (BENCH_BOARD,))
+            rows = cur.fetchone()[0]
+        else:
+            ids = [f"{BENCH_SUBREDDIT_ID_PREFIX}_{s}" for s in subreddits]
+            cur.execute("SELECT count(*) FROM reddit_posts WHERE subreddit_id = ANY(%s);", (ids,))
+            rows = cur.fetchone()[0]
+            cur.execute("SELECT count(*) FROM reddit_comments WHERE subreddit_id = ANY(%s);", (ids,))
+            rows += cur.fetchone()[0]
+    conn.rollback()
+    return rows
+
+
+def cleanup(conn, subreddits):
+    ids = [f"{BENCH_SUBREDDIT_ID_PREFIX}_{s}" for s in subreddits]
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM chan_posts WHERE board_name = %s;", (BENCH_BOARD,))
+            cur.execute("DELETE FROM reddit_posts WHERE subreddit_id = ANY(%s);", (ids,))
+            cur.execute("DELETE FROM reddit_comments WHERE subreddit_id = ANY(%s);", (ids,))
+            # plain substring match: in LIKE the underscores of __bench__ would be wildcards
+            cur.execute("DELETE FROM crawl_state WHERE strpos(source, %s) > 0;", (BENCH_BOARD,))
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("mode", choices=["chan", "reddit"])
+    p.add_argument("--concurrency", type=int, default=3)
+    p.add_argument("--threads", type=int, default=150, help="live threads on the fake board")
+    p.add_argument("--posts", type=int, default=120, help="posts per fake thread")
+    p.add_argument("--subreddits", type=int, default=10, help="fake subreddits to scan")
+    p.add_argument("--page-size", type=int, default=100, help="items per fake reddit page")
+    p.add_argument("--latency-ms", type=float, default=0, help="added latency per fake API response")
+    p.add_argument("--database-url", default=os.environ.get("DATABASE_URL"))
+    p.add_argument("--keep", action="store_true", help="don't delete the rows written")
+    args = p.parse_args()
+
+    # has to be in place before the crawler modules read their config
+    os.environ["DATABASE_URL"] = args.database_url or ""
+    os.environ["WORKER_CONCURRENCY"] = str(args.concurrency)
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    # the fake API has no request limit, and the bench mustn't share the real crawlers' limiter file
+    os.environ["CHAN_REQUESTS_PER_SECOND"] = "100000"
+    os.environ["CRAWLER_STATE_DIR"] = os.path.join(tempfile.mkdtemp(prefix="bench_crawler_"), "state")
+
+    api = FakeApi(args.threads, args.posts, args.page_size, args.latency_ms / 1000)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(api))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+
+    import async_chan_client
+    import chan_client
+    import chan_crawler
+    import db_pool
+    import faktory_producer
+    import reddit_client
+    import reddit_crawler
+
+    chan_client.API_BASE_URL = f"{base}/chan"
+    async_chan_client.API_BASE_URL = f"{base}/chan"
+    reddit_client.API_BASE_URL = f"{base}/r"
+    reddit_client.token_manager.get = lambda: "bench"
+
+    handlers = {
+        "crawl_thread": chan_crawler.enqueue_crawl_thread,
+        "crawl_threads": chan_crawler.enqueue_crawl_threads,
+        "crawl_thread_listing": chan_crawler.enqueue_crawl_threads_listing,
+        "backfill_archive": chan_crawler.enqueue_backfill_archive,
+        "scan_posts": reddit_crawler.enqueue_scan_posts,
+        "scan_comments": reddit_crawler.enqueue_scan_comments,
+        "process_posts": reddit_crawler.enqueue_process_posts,
+        "process_comments": reddit_crawler.enqueue_process_comments,
+    }
+    jobs = InProcessQueue(handlers)
+    faktory_producer.push = jobs.push
+    faktory_producer.push_bulk = jobs.push_bulk
+    faktory_producer.producer_stats = lambda: {}
+
+    subreddits = [f"{BENCH_SUBREDDIT_PREFIX}{i}" for i in range(args.subreddits)]
+    from pyfaktory import Job
+
+    if args.mode == "chan":
+        jobs.push(Job(jobtype="crawl_thread_listing", args=[BENCH_BOARD], queue="crawl-thread-listing"))
+    else:
+        for sub in subreddits:
+            jobs.push(Job(jobtype="scan_posts", args=[sub, []], queue="scan_posts"))
+            jobs.push(Job(jobtype="scan_comments", args=[sub, []], queue="scan_comments"))
+
+    with db_pool.connection() as conn:
+        cleanup(conn, subreddits)
+        rows_before = count_rows(conn, args.mode, subreddits)
+
+    start = time.perf_counter()
+    jobs.drain(args.concurrency)
+    elapsed = time.perf_counter() - start
+
+    with db_pool.connection() as conn:
+        rows = count_rows(conn, args.mode, subreddits) - rows_before
+        if not args.keep:
+            cleanup(conn, subreddits)
+    server.shutdown()
+
+    latencies = jobs.latencies
+    print(f"mode={args.mode} concurrency={args.concurrency}")
+    print(f"jobs run:        {len(latencies)} ({jobs.failures} failed, {jobs.scheduled} rescheduled)")
+    print(f"wall time:       {elapsed:.2f}s")
+    print(f"jobs/s:          {len(latencies) / elapsed:.1f}")
+    print(f"job latency:     p50 {percentile(latencies, 50) * 1000:.1f}ms, p99 {percentile(latencies, 99) * 1000:.1f}ms, mean {statistics.mean(latencies or [0]) * 1000:.1f}ms")
+    print(f"rows written:    {rows} ({rows / elapsed:.0f} rows/s)")
+    print(f"api requests:    {api.requests} ({api.bytes_sent / 1e6:.1f} MB)")
+    print(f"db pool:         {db_pool.pool_stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Compare the old per-row reddit insert loop against the COPY-based writer.
+
+Writes synthetic listing pages under a throwaway subreddit_id into the real
+reddit_posts/reddit_comments tables and deletes them again at the end.
+
+    python bench_reddit_insert.py [pages] [page_size]
+"""
+
+import logging
+import sys
+import time
+
+import psycopg2
+
+import seen_filter
+from reddit_crawler import (
+    DATABASE_URL,
+    REDDIT_COMMENT_COLUMNS,
+    REDDIT_POST_COLUMNS,
+    comment_to_row,
+    post_to_row,
+    save_comment_metadata,
+    save_post_metadata,
+)
+
+BENCH_SUBREDDIT_ID = "t5___bench__"
+
+logger = logging.getLogger("bench reddit insert")
+logger.propagate = False
+logger.setLevel(logging.INFO)
+sh = logging.StreamHandler()
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+sh.setFormatter(formatter)
+logger.addHandler(sh)
+
+
+def make_page(kind, page, page_size):
+    now = int(time.time())
+    children = []
+    for i in range(page * page_size, (page + 1) * page_size):
+        if kind == "posts":
+            data = {
+                "subreddit_id": BENCH_SUBREDDIT_ID,
+                "name": f"t3_bench{i}",
+                "title": f"bench post {i}",
+                "selftext": "lorem ipsum\t" * 30,
+                "link_flair_text": "Discussion",
+                "author_fullname": "t2_bench",
+                "url": f"https://example.invalid/{i}",
+                "media": None,
+                "created_utc": now - i,
+            }
+        else:
+            data = {
+                "subreddit_id": BENCH_SUBREDDIT_ID,
+                "name": f"t1_bench{i}",
+                "body": "lorem ipsum\n" * 20,
+                "author_fullname": "t2_bench",
+                "link_id": "t3_bench0",
+                "parent_id": "t3_bench0",
+                "created_utc": now - i,
+            }
+        children.append({"data": data})
+    return {"data": {"children": children}}
+
+
+def per_row_insert(conn, table, columns, to_row, listing):
+    """the pre-COPY code path: one INSERT and one commit per item"""
+    cur = conn.cursor()
+    q = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))}) ON CONFLICT (name,created_utc) DO NOTHING;"
+    for child in listing["data"]["children"]:
+        cur.execute(q, to_row(child["data"]))
+        conn.commit()
+    cur.close()
+
+
+def clear_bench_rows(conn):
+    with conn:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM reddit_posts WHERE subreddit_id = %s;", (BENCH_SUBREDDIT_ID,))
+            cur.execute("DELETE FROM reddit_comments WHERE subreddit_id = %s;", (BENCH_SUBREDDIT_ID,))
+
+
+def timed(name, fn, pages):
+    start = time.perf_counter()
+    for page in pages:
+        fn(page)
+    elapsed = time.perf_counter() - start
+    items = sum(len(p["data"]["children"]) for p in pages)
+    logger.info(f"{name}: {items} items in {elapsed:.3f}s ({items / elapsed:.0f} items/s)")
+    return elapsed
+
+
+if __name__ == "__main__":
+    num_pages = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    page_size = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    logging.getLogger("Reddit client").setLevel(logging.WARNING)
+    conn = psycopg2.connect(dsn=DATABASE_URL)
+    try:
+        for kind, table, columns, to_row, save in [
+            ("posts", "reddit_posts", REDDIT_POST_COLUMNS, post_to_row, save_post_metadata),
+            ("comments", "reddit_comments", REDDIT_COMMENT_COLUMNS, comment_to_row, save_comment_metadata),
+        ]:
+            pages = [make_page(kind, i, page_size) for i in range(num_pages)]
+            names = [{c["data"]["name"] for c in p["data"]["children"]} for p in pages]
+
+            clear_bench_rows(conn)
+            per_row = timed(f"{kind} per-row loop", lambda p: per_row_insert(conn, table, columns, to_row, p), pages)
+
+            clear_bench_rows(conn)
+            results = []
+            bulk = timed(f"{kind} COPY upsert", lambda p: results.append(save(p, names[len(results)])), pages)
+            logger.info(f"{kind} speedup: {per_row / bulk:.1f}x, inserted {sum(r[0] for r in results)}")
+
+            # same pages again: everything is a duplicate. The seen filter would
+            # drop every row before Postgres sees it (and would re-warm with them
+            # if cleared), so switch it off to time ON CONFLICT
+            seen_filter.bypass(table)
+            results = []
+            timed(f"{kind} COPY re-insert", lambda p: results.append(save(p, names[len(results)])), pages)
+            logger.info(f"{kind} re-insert duplicates: {sum(r[1] for r in results)}")
+    finally:
+        clear_bench_rows(conn)
+        conn.close()
@@ -0,0 +1,94 @@
+"""
+Full-text search (GIN on the tsvector expressions) against the ILIKE scans
+it replaces.
+
+For each term, times the first page of search() and an ILIKE '%term%' over
+the same text columns and time window, and prints how many rows each found
+(ILIKE matches substrings, so its counts are usually a bit higher).
+
+    python bench_search.py <table> [days] term [term ...]
+"""
+
+import datetime
+import logging
+import statistics
+import sys
+import time
+
+import psycopg2
+
+from search import DATABASE_URL, SEARCH_DOCUMENTS, search
+
+RUNS = 3
+
+logger = logging.getLogger("bench search")
+logger.propagate = False
+logger.setLevel(logging.INFO)
+sh = logging.StreamHandler()
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+sh.setFormatter(formatter)
+logger.addHandler(sh)
+
+
+ILIKE_COLUMNS = {
+    "reddit_posts": ("title", "text"),
+    "reddit_comments": ("text",),
+    "chan_posts": ("title", "text_body"),
+}
+
+
+def timed(fn):
+    samples = []
+    result = None
+    for _ in range(RUNS):
+        start = time.perf_counter()
+        result = fn()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples), result
+
+
+def ilike_page(conn, table, term, start, limit=50):
+    where = " OR ".join(f"{c} ILIKE %(pattern)s" for c in ILIKE_COLUMNS[table])
+    with conn.cursor() as cur:
+        cur.execute(
+            f"SELECT * FROM {table} WHERE ({where}) AND created_utc >= %(start)s ORDER BY created_utc DESC LIMIT %(limit)s;",
+            {"pattern": f"%{term}%", "start": start, "limit": limit},
+        )
+        rows = cur.fetchall()
+    conn.rollback()
+    return rows
+
+
+def count_matches(conn, table, term, start):
+    with conn.cursor() as cur:
+        cur.execute(
+            f"SELECT count(*) FROM {table} WHERE {SEARCH_DOCUMENTS[table]} @@ websearch_to_tsquery('english', %s) AND created_utc >= %s;",
+            (term, start),
+        )
+        fts = cur.fetchone()[0]
+        where = " OR ".join(f"{c} ILIKE %(pattern)s" for c in ILIKE_COLUMNS[table])
+        cur.execute(f"SELECT count(*) FROM {table} WHERE ({where}) AND created_utc >= %(start)s;", {"pattern": f"%{term}%", "start": start})
+        ilike = cur.fetchone()[0]
+    conn.rollback()
+    return fts, ilike
+
+
+if __name__ == "__main__":
+    table = sys.argv[1]
+    rest = sys.argv[2:]
+    days = int(rest.pop(0)) if rest and rest[0].isdigit() else 30
+    terms = rest or ["trade", "injury", "referee"]
+    start = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+
+    conn = psycopg2.connect(dsn=DATABASE_URL)
+    try:
+        for term in terms:
+            fts_s, _ = timed(lambda: search(term, table, start=start, conn=conn))
+            ilike_s, _ = timed(lambda: ilike_page(conn, table, term, start))
+            fts_count, ilike_count = count_matches(conn, table, term, start)
+            logger.info(
+                f"{table} '{term}' ({days}d): full-text {fts_s * 1000:.1f} ms ({fts_count} matches), "
+                f"ILIKE {ilike_s * 1000:.1f} ms ({ilike_count} matches), {ilike_s / fts_s:.1f}x"
+            )
+    finally:
+        conn.close()
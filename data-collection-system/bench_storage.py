@@ -0,0 +1,138 @@
+"""
+Storage size and query time of the hypertables before and after compression.
+
+Measures the current tables, compresses every chunk older than
+STORAGE_COMPRESS_AFTER right away (what the policy would do over time), and
+measures again. Run it against a database with a few weeks of data:
+
+    python bench_storage.py [runs] [--decompress]
+
+--decompress puts the chunks back afterwards, for repeated runs.
+"""
+
+import logging
+import statistics
+import sys
+import time
+
+import psycopg2
+
+from storage_policies import DATABASE_URL, HYPERTABLES, STORAGE_COMPRESS_AFTER, storage_status
+
+logger = logging.getLogger("bench storage")
+logger.propagate = False
+logger.setLevel(logging.INFO)
+sh = logging.StreamHandler()
+formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+sh.setFormatter(formatter)
+logger.addHandler(sh)
+
+
+# what the crawlers and dashboards actually ask for; parameters are filled in
+# from whatever source has the most rows
+QUERIES = {
+    "reddit posts per day, one subreddit, 30 days": (
+        "SELECT time_bucket('1 day', created_utc) AS day, count(*) FROM reddit_posts "
+        "WHERE subreddit_id = %(subreddit_id)s AND created_utc > now() - INTERVAL '30 days' GROUP BY day;"
+    ),
+    "reddit comments per hour, one subreddit, 30 days": (
+        "SELECT time_bucket('1 hour', created_utc) AS hour, count(*) FROM reddit_comments "
+        "WHERE subreddit_id = %(subreddit_id)s AND created_utc > now() - INTERVAL '30 days' GROUP BY hour;"
+    ),
+    "chan posts per day, one board, all time": (
+        "SELECT time_bucket('1 day', created_utc) AS day, count(*) FROM chan_posts "
+        "WHERE board_name = %(board)s GROUP BY day;"
+    ),
+    "chan thread high water": (
+        "SELECT max(post_number) FROM chan_posts WHERE board_name = %(board)s AND thread_number = %(thread_number)s;"
+    ),
+}
+
+
+def pick_params(conn):
+    params = {"subreddit_id": None, "board": None, "thread_number": None}
+    with conn.cursor() as cur:
+        cur.execute("SELECT subreddit_id FROM reddit_comments GROUP BY subreddit_id ORDER BY count(*) DESC LIMIT 1;")
+        row = cur.fetchone()
+        params["subreddit_id"] = row[0] if row else None
+        cur.execute("SELECT board_name, thread_number FROM chan_posts GROUP BY 1, 2 ORDER BY count(*) DESC LIMIT 1;")
+        row = cur.fetchone()
+        if row:
+            params["board"], params["thread_number"] = row
+    conn.rollback()
+    return params
+
+
+def time_queries(conn, params, runs):
+    timings = {}
+    with conn.cursor() as cur:
+        for name, query in QUERIES.items():
+            samples = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                cur.execute(query, params)
+                cur.fetchall()
+                samples.append(time.perf_counter() - start)
+            timings[name] = statistics.median(samples)
+    conn.rollback()
+    return timings
+
+
+def compress_old_chunks(conn, older_than):
+    with conn:
+        with conn.cursor() as cur:
+            for table in HYPERTABLES:
+                cur.execute(
+                    "SELECT count(compress_chunk(c, if_not_compressed => true)) FROM show_chunks(%s, older_than => %s::interval) c;",
+                    (table, older_than),
+                )
+                logger.info(f"{table}: compressed {cur.fetchone()[0]} chunks older than {older_than}")
+
+
+def decompress_all(conn):
+    with conn:
+        with conn.cursor() as cur:
+            for table in HYPERTABLES:
+                cur.execute("SELECT count(decompress_chunk(c, if_compressed => true)) FROM show_chunks(%s) c;", (table,))
+                logger.info(f"{table}: decompressed {cur.fetchone()[0]} chunks")
+
+
+def report(label, status, timings):
+    for table, stats in status.items():
+        mb = (stats["total_bytes"] or 0) / 2**20
+        logger.info(f"{label} {table}: {mb:.1f} MB in {stats['chunks']} chunks ({stats['compressed_chunks']} compressed)")
+    for name, seconds in timings.items():
+        logger.info(f"{label} {name}: {seconds * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    runs = int(args[0]) if args else 5
+
+    conn = psycopg2.connect(dsn=DATABASE_URL)
+    try:
+        params = pick_params(conn)
+        logger.info(f"query parameters: {params}")
+
+        before_status = storage_status(conn)
+        before_timings = time_queries(conn, params, runs)
+        report("before", before_status, before_timings)
+
+        compress_old_chunks(conn, STORAGE_COMPRESS_AFTER)
+
+        after_status = storage_status(conn)
+        after_timings = time_queries(conn, params, runs)
+        report("after", after_status, after_timings)
+
+        for table in HYPERTABLES:
+            before_bytes = before_status[table]["total_bytes"] or 0
+            after_bytes = after_status[table]["total_bytes"] or 0
+            if after_bytes:
+                logger.info(f"{table}: {before_bytes / after_bytes:.1f}x smaller")
+        for name in QUERIES:
+            logger.info(f"{name}: {before_timings[name] / after_timings[name]:.1f}x faster")
+
+        if "--decompress" in sys.argv[1:]:
+            decompress_all(conn)
+    finally:
+        conn.close()
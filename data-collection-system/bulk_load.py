@@ -0,0 +1,84 @@
+"""
+COPY-based bulk upsert.
+
+Rows are streamed with COPY into a session-local temp table shaped like the
+target, then moved over with INSERT ... SELECT ... ON CONFLICT DO NOTHING (or a
+narrow DO UPDATE), all in the caller's transaction. That's one round trip for the data no matter how
+many rows, instead of one INSERT per row.
+"""
+
+import io
+import json
+
+
+def copy_text_value(value):
+    """format one value for COPY's text format"""
+    if value is None:
+        return "\\N"
+    if isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    elif not isinstance(value, str):
+        value = str(value)
+    return (
+        value.replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def rows_to_copy_buffer(rows):
+    buf = io.StringIO()
+    for row in rows:
+        buf.write("\t".join(copy_text_value(v) for v in row))
+        buf.write("\n")
+    buf.seek(0)
+    return buf
+
+
+def upsert_clause(table, update_columns, update_where):
+    """
+    ON CONFLICT action that refreshes update_columns of existing rows matching
+    update_where (SQL on `table`), and only when they actually changed
+    """
+    assignments = ", ".join(f"{c} = EXCLUDED.{c}" for c in update_columns)
+    current = ", ".join(f"{table}.{c}" for c in update_columns)
+    proposed = ", ".join(f"EXCLUDED.{c}" for c in update_columns)
+    return f"DO UPDATE SET {assignments} WHERE {update_where} AND ({current}) IS DISTINCT FROM ({proposed})"
+
+
+def copy_upsert(cur, table, columns, rows, conflict_columns, returning, update_columns=(), update_where=None):
+    """
+    Load rows into `table` and return the `returning` column of each row that
+    was actually inserted. Rows that hit the unique index are skipped, unless
+    update_columns is given: then existing rows matching update_where get
+    those columns from the new row (see upsert_clause), and still don't count
+    as inserted. The temp table is created once per connection and emptied
+    on commit.
+    """
+    staging = f"{table}_staging"
+    column_list = ", ".join(columns)
+    if update_columns:
+        # DO UPDATE can't touch a row twice in one statement, so the last copy of a key wins
+        key = [list(columns).index(c) for c in conflict_columns]
+        rows = list({tuple(row[i] for i in key): row for row in rows}.values())
+        action = upsert_clause(table, update_columns, update_where)
+        # xmax is 0 only on rows this statement inserted rather than updated
+        returning = f"{returning}, xmax = 0"
+    else:
+        action = "DO NOTHING"
+    cur.execute(
+        f"CREATE TEMP TABLE IF NOT EXISTS {staging} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS;"
+    )
+    cur.copy_expert(f"COPY {staging} ({column_list}) FROM STDIN", rows_to_copy_buffer(rows))
+    cur.execute(
+        f"INSERT INTO {table} ({column_list}) SELECT {column_list} FROM {staging} "
+        f"ON CONFLICT ({', '.join(conflict_columns)}) {action} RETURNING {returning};"
+    )
+    if update_columns:
+        inserted = [row[0] for row in cur.fetchall() if row[1]]
+    else:
+        inserted = [row[0] for row in cur.fetchall()]
+    # in case the caller keeps the transaction open for more work
+    cur.execute(f"TRUNCATE {staging};")
+    return inserted
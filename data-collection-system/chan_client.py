@@ -1,6 +1,12 @@
 import requests
+import fcntl
 import logging
 import os
+import threading
+import time
+from requests.adapters import HTTPAdapter
+
+import http_cache
 
 # r = requests.get("http://a.4cdn.org/pol/threads.json")
 
@@ -9,6 +15,10 @@ import os
 # print(f"{r.json()}")
 
 API_BASE_URL = "http://a.4cdn.org"
+# the API's rule is one request per second, for all of our workers together
+CHAN_REQUESTS_PER_SECOND = float(os.environ.get("CHAN_REQUESTS_PER_SECOND", "1"))
+CRAWLER_STATE_DIR = os.environ.get("CRAWLER_STATE_DIR", "crawler_state")
+RATELIMIT_FILE = os.path.join(CRAWLER_STATE_DIR, "chan_ratelimit")
 
 logger = logging.getLogger("4chan client")
 logger.propagate = False
@@ -23,17 +33,138 @@ sh.setFormatter(formatter)
 logger.addHandler(sh)
 
 
+class RateLimiter:
+    """
+    Spaces every request to the 4chan API, from ChanClient and
+    AsyncChanClient alike, at least 1/CHAN_REQUESTS_PER_SECOND apart. The
+    next free slot is kept in a small file guarded by flock, so the spacing
+    holds across worker processes as well as between the threads and the
+    event loop inside one.
+    """
+
+    def __init__(self, rate=CHAN_REQUESTS_PER_SECOND, path=RATELIMIT_FILE):
+        self.interval = 1.0 / rate
+        self.path = path
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """reserve the next request slot and return how long to sleep for it"""
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a+") as file:
+                fcntl.flock(file, fcntl.LOCK_EX)
+                try:
+                    file.seek(0)
+                    raw = file.read().strip()
+                    now = time.time()
+                    slot = max(now, float(raw) if raw else 0.0)
+                    file.truncate(0)
+                    file.write(repr(slot + self.interval))
+                    file.flush()
+                finally:
+                    fcntl.flock(file, fcntl.LOCK_UN)
+        return slot - now
+
+    def wait(self):
+        delay = self.reserve()
+        if delay > 0:
+            logger.debug(f"rate limiter: waiting {delay:.2f}s")
+            time.sleep(delay)
+        return delay
+
+
+rate_limiter = RateLimiter()
+
+
+class NotModified:
+    """returned instead of a parsed body when the server answers 304"""
+
+    def __repr__(self):
+        return "NOT_MODIFIED"
+
+
+NOT_MODIFIED = NotModified()
+
+# one keep-alive session and validator cache per process, shared by every
+# ChanClient so jobs reuse connections and Last-Modified values
+_session = requests.Session()
+_session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+# live, record, replay or TTL cache depending on HTTP_CACHE_MODE
+_http = http_cache.HttpLayer(_session)
+
+# url -> (Last-Modified header, size of the last full body in bytes)
+_validators = {}
+# validators of fetches whose caller hasn't confirmed it saved the body yet
+_pending_validators = {}
+_lock = threading.Lock()
+_stats = {
+    "requests": 0,
+    "not_modified": 0,
+    "bytes_downloaded": 0,
+    "bytes_saved": 0,
+}
+
+
+def request_stats():
+    with _lock:
+        return dict(_stats)
+
+
+def cache_stats():
+    return _http.stats()
+
+
+def get_validator(api_call):
+    """(Last-Modified, body size) of the last full response for this url, or None"""
+    with _lock:
+        return _validators.get(api_call)
+
+
+def store_validator(api_call, last_modified, size, defer=False):
+    with _lock:
+        target = _pending_validators if defer else _validators
+        target[api_call] = (last_modified, size)
+
+
+def drop_validator(api_call):
+    with _lock:
+        _validators.pop(api_call, None)
+        _pending_validators.pop(api_call, None)
+
+
+def commit_validator(api_call):
+    """
+    Start sending If-Modified-Since for a url fetched with defer_validator=True.
+    Call it once the body is saved: if the save fails, the retry must get the
+    full body again, not a 304.
+    """
+    with _lock:
+        pending = _pending_validators.pop(api_call, None)
+        if pending is not None:
+            _validators[api_call] = pending
+
+
 class ChanClient:
-    def get_threads(self, board):
-        api_call = self.build_request([board, "threads.json"])
-        return self.execute_request(api_call)
+    def get_threads(self, board, conditional=False, defer_validator=False):
+        return self.execute_request(self.threads_url(board), conditional, defer_validator)
 
-    def get_thread(self, board, thread_number):
-        api_call = self.build_request([board, "thread", f"{thread_number}.json"])
-        return self.execute_request(api_call)
+    def get_thread(self, board, thread_number, conditional=False, defer_validator=False):
+        return self.execute_request(self.thread_url(board, thread_number), conditional, defer_validator)
+
+    def threads_url(self, board):
+        return self.build_request([board, "threads.json"])
 
-    def get_catalog(self, board):
+    def thread_url(self, board, thread_number):
+        return self.build_request([board, "thread", f"{thread_number}.json"])
+
+    def get_catalog(self, board, conditional=False):
         api_call = self.build_request([board, "catalog.json"])
+        return self.execute_request(api_call, conditional)
+
+    def get_archive(self, board):
+        """thread numbers of the board's archived (closed) threads"""
+        api_call = self.build_request([board, "archive.json"])
         return self.execute_request(api_call)
 
     # Build the full endpoint URL.
@@ -43,16 +174,42 @@ class ChanClient:
         return api_call
 
     """
-    This should execute an api call, so go out and actuall do the http get
+    This should execute an api call, so go out and actuall do the http get.
+    With conditional=True we send If-Modified-Since from the last response for
+    this url and return NOT_MODIFIED on a 304, so the caller can skip parsing.
+    With defer_validator=True the new Last-Modified is only used once the
+    caller passes the url to commit_validator().
     """
 
-    def execute_request(self, api_call):
+    def execute_request(self, api_call, conditional=False, defer_validator=False):
         logger.info(f"api call: {api_call}")
-        r = requests.get(api_call)
+        headers = {}
+        with _lock:
+            _stats["requests"] += 1
+        cached = get_validator(api_call)
+        if conditional and cached is not None:
+            headers["If-Modified-Since"] = cached[0]
+
+        # only real requests take a rate limit slot
+        r = _http.get(api_call, headers=headers, on_fetch=rate_limiter.wait)
+        if r.status_code == 304:
+            logger.info(f"304 for {api_call}")
+            with _lock:
+                _stats["not_modified"] += 1
+                _stats["bytes_saved"] += cached[1] if cached else 0
+            return NOT_MODIFIED
+
         if r.status_code == 404:
             logger.info(f"404 for {api_call}")
+            drop_validator(api_call)
             return dict()
 
+        last_modified = r.headers.get("Last-Modified")
+        with _lock:
+            _stats["bytes_downloaded"] += len(r.content)
+        if last_modified:
+            store_validator(api_call, last_modified, len(r.content), defer_validator)
+
         # logger.info(f"{r.text}")
         return r.json()
 
@@ -1,14 +1,22 @@
 import datetime
-from chan_client import ChanClient
+from chan_client import ChanClient, NOT_MODIFIED, commit_validator, request_stats
+import async_chan_client
+import bulk_load
+import crawl_state
+import db_pool
+import faktory_producer
+import poll_scheduler
+import seen_filter
+import spool
 import os
 import time
-from pyfaktory import Client, Consumer, Job, Producer
+from pyfaktory import Client, Consumer, Job
 import logging
 
 # these three lines allow psycopg to insert a dict into
 # a jsonb coloumn
 import psycopg2
-from psycopg2.extras import Json
+from psycopg2.extras import Json, execute_values
 from psycopg2.extensions import register_adapter
 
 register_adapter(dict, Json)
@@ -35,6 +43,14 @@ logger.addHandler(sh)
 # get db url
 DATABASE_URL = os.environ.get("DATABASE_URL")
 FACTORY_SERVER_URL = os.environ.get("FAKTORY_URL")
+# incremental mode crawls live threads whenever threads.json says they changed,
+# instead of only once after they fall off the board
+CHAN_INCREMENTAL = os.environ.get("CHAN_INCREMENTAL", "1") == "1"
+# push one crawl_threads job per cycle and fetch its threads concurrently with
+# the async client, instead of one crawl_thread job per thread
+CHAN_ASYNC_CRAWL = os.environ.get("CHAN_ASYNC_CRAWL", "0") == "1"
+# archived threads fetched per backfill_archive job before it checkpoints and requeues
+CHAN_BACKFILL_BATCH = int(os.environ.get("CHAN_BACKFILL_BATCH", "50"))
 
 def threads_list_to_thread_number(thread_list):
     thread_numbers = set()
@@ -48,6 +64,36 @@ def threads_list_to_thread_number(thread_list):
     return thread_numbers
 
 
+def threads_list_to_thread_state(thread_list):
+    """map thread number -> (last_modified, replies) for every live thread"""
+    state = {}
+    for page in thread_list:
+        for thread in page["threads"]:
+            state[thread["no"]] = (thread.get("last_modified"), thread.get("replies"))
+
+    return state
+
+
+def thread_state_from_args(old_threads):
+    """
+    The state goes through JSON, so it comes back as {"123": [lm, replies]}.
+    A plain list of thread numbers (the pre-incremental format) is accepted too,
+    with unknown state so those threads get crawled once.
+    """
+    if isinstance(old_threads, dict):
+        return {int(no): tuple(v) if v is not None else None for no, v in old_threads.items()}
+    return {int(no): None for no in old_threads}
+
+
+def thread_state_to_args(state):
+    return {str(no): list(v) if v is not None else None for no, v in state.items()}
+
+
+def get_changed_threads(old_state, new_state):
+    """live threads that are new, or whose last_modified/replies moved since the last poll"""
+    return {no for no, v in new_state.items() if old_state.get(no) != v}
+
+
 """enqueue a thread crawl job to get the posts in a thread"""
 
 
@@ -55,8 +101,13 @@ def enqueue_crawl_thread(board, thread_number):
     client = ChanClient()
     # we probably want to save teh output of get_thread somewherE (e.g., database)
     logger.info(f"Getting thread /{board}/{thread_number}")
-    thread = client.get_thread(board, thread_number)
+    # the validator only sticks once the posts are saved, so a faktory retry
+    # after a failed save refetches the thread instead of getting a 304
+    thread = client.get_thread(board, thread_number, conditional=True, defer_validator=True)
     logger.info(f"Finished getting thread /{board}/{thread_number}")
+    if thread is NOT_MODIFIED:
+        logger.info(f"/{board}/{thread_number} not modified since last crawl, skipping")
+        return
     # id BIGSERIAL NOT NULL,
     # board_name TEXT NOT NULL,
     # thread_number BIGINT NOT NULL,
@@ -66,87 +117,306 @@ def enqueue_crawl_thread(board, thread_number):
 
     # thead is a json object, that has one field called `posts`
     # which is an array of all the posts in the thread
-    conn = psycopg2.connect(dsn=DATABASE_URL)
-    cur = conn.cursor()
-
     logger.debug(f"{thread}")
     if len(thread) == 0:
         logger.warning("Empty thread!")
         return
 
-    for post in thread["posts"]:
-        post_number = post["no"]
-        created_utc = post["time"]
-        created_utc = datetime.datetime.fromtimestamp(created_utc)
-        data = post
-        # logger.info("wut?")
+    save_thread(board, thread_number, thread)
+    commit_validator(client.thread_url(board, thread_number))
+    logger.debug(f"db pool: {db_pool.pool_stats()}")
 
-        sub = post.get("sub")
-        com = post.get("com")
-        replies = post.get("replies")
-        resto = post.get("resto")
 
-        # now we need to insert into our db
-        # sql = f"INSERT INTO posts VALUES ({board}, {thread_number}, {post_number} {created_at}, {data})"
-        # q = "INSERT INTO posts (board_name, thread_number, post_number, created_at, data) VALUES (%s, %s, %s, %s, %s) RETURNING id"
-        q = "INSERT INTO chan_posts (board_name, thread_number, post_number, title, text_body, num_replies, created_utc, resto, data) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT (board_name, post_number, created_utc) DO NOTHING;"
-        # q2 = f"INSERT INTO posts (board_name, thread_number, post_number, created_at, data) VALUES ({board}, {thread_number}, {post_number}, {created_at}, {data})"
-        # logger.info("we got here?")
-        # logger.info(q2)
-        cur.execute(q, (board, thread_number, post_number, sub, com, replies, created_utc, resto, data))
-        conn.commit()
+"""crawl a batch of threads concurrently, rate limited by the async client"""
 
-    cur.close()
-    conn.close()
 
+def enqueue_crawl_threads(board, thread_numbers):
+    logger.info(f"Getting {len(thread_numbers)} threads from /{board}/")
+    # validators only stick for the threads that get saved, as in crawl_thread
+    threads = async_chan_client.run_fetch_threads(board, thread_numbers, conditional=True, defer_validator=True)
+    logger.debug(f"async client stats: {async_chan_client.AsyncChanClient.stats}")
+    client = ChanClient()
 
-"""enqueue a thread list carwl to get the live threads on a board"""
+    failed = []
+    for thread_number, thread in threads.items():
+        if isinstance(thread, Exception):
+            logger.warning(f"Failed to get /{board}/{thread_number}: {thread}")
+            failed.append(thread_number)
+        elif thread is NOT_MODIFIED or len(thread) == 0:
+            continue
+        else:
+            save_thread(board, thread_number, thread)
+            commit_validator(client.thread_url(board, thread_number))
+
+    # failed threads go back out as single crawl_thread jobs, which faktory retries
+    if failed:
+        push_crawl_thread_jobs(board, failed)
+
+
+def save_thread(board, thread_number, thread):
+    """insert the posts of a fetched thread that are above its stored high water, and refresh its OP"""
+    if spool.spool_first():
+        spool_thread_posts(board, thread_number, thread["posts"])
+        return
+    try:
+        with db_pool.connection() as conn:
+            high_water = get_thread_high_water(conn, board, thread_number)
+            # the OP always goes in: its reply count moves on after first sight
+            posts = [post for post in thread["posts"] if is_op(post) or high_water is None or post["no"] > high_water]
+            inserted, skipped = save_thread_posts(conn, board, thread_number, posts)
+    except spool.DB_ERRORS as e:
+        if not spool.can_fallback():
+            raise
+        # keep what we fetched instead of refetching it on the faktory retry
+        logger.warning(f"Database unavailable saving /{board}/{thread_number} ({e}), spooling it")
+        spool_thread_posts(board, thread_number, thread["posts"])
+        return
 
+    logger.info(
+        f"Saved /{board}/{thread_number}: {inserted} inserted, {skipped} skipped, "
+        f"{len(thread['posts']) - len(posts)} at or below high water {high_water}"
+    )
+    logger.debug(f"seen filter: {seen_filter.filter_stats()}")
+
+
+CHAN_POSTS_COLUMNS = ("board_name", "thread_number", "post_number", "title", "text_body", "num_replies", "created_utc", "resto", "data")
+
+# stored OPs get these refreshed on every crawl, everything else is insert-only
+CHAN_OP_UPDATE_COLUMNS = ("num_replies", "data")
+CHAN_OP_UPDATE_WHERE = "chan_posts.resto = 0"
+
+CHAN_POSTS_INSERT = (
+    f"INSERT INTO chan_posts ({', '.join(CHAN_POSTS_COLUMNS)}) "
+    "VALUES %s ON CONFLICT (board_name, post_number, created_utc) "
+    f"{bulk_load.upsert_clause('chan_posts', CHAN_OP_UPDATE_COLUMNS, CHAN_OP_UPDATE_WHERE)} "
+    # xmax is 0 only on rows this statement inserted rather than updated
+    "RETURNING post_number, xmax = 0;"
+)
 
-def enqueue_crawl_threads_listing(board, old_threads=[]):
-    client = ChanClient()
-    # faktory_server_url = "tcp://:password@localhost:7419"
-    # find dead threads, and issue jobs to crawl them
-    dead_threads = get_dead_threads(board, set(old_threads))
-    logger.debug(f"{dead_threads}")
 
-    old_threads = list(threads_list_to_thread_number(client.get_threads(board)))
-
-    # now we neee to run this job again at some point in the future
-    with Client(faktory_url=FACTORY_SERVER_URL, role="producer") as client:
-        # we want the job to run at some point in the future
-        run_at = datetime.datetime.utcnow() + datetime.timedelta(minutes=5)
-        run_at = run_at.isoformat()[:-7] + "Z"
-        # logger.info(f"run_at = {run_at}")
-        producer = Producer(client=client)
-        job = Job(
-            jobtype="crawl_thread_listing",
-            args=(board, old_threads),
-            queue="crawl-thread-listing",
-            at=str(run_at),
+def is_op(post):
+    return post.get("resto") == 0
+
+
+def get_thread_high_water(conn, board, thread_number):
+    """highest post_number already stored for a thread, or None if we have none"""
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT max(post_number) FROM chan_posts WHERE board_name = %s AND thread_number = %s;",
+            (board, thread_number),
         )
-        producer.push(job)
+        high_water = cur.fetchone()[0]
+    conn.rollback()
+    return high_water
+
+
+def post_to_row(board, thread_number, post):
+    """turn one post from thread/N.json into a chan_posts row"""
+    created_utc = datetime.datetime.fromtimestamp(post["time"])
+    return (
+        board,
+        thread_number,
+        post["no"],
+        post.get("sub"),
+        post.get("com"),
+        post.get("replies"),
+        created_utc,
+        post.get("resto"),
+        post,
+    )
+
+
+def save_thread_posts(conn, board, thread_number, posts):
+    """
+    Write all the posts of a thread into chan_posts with one multi-row insert,
+    in a single transaction. Returns (inserted, skipped), where skipped are the
+    rows that already existed; an OP whose counts were refreshed is skipped.
+    """
+    # posts this worker knows are stored never make it into the batch, except
+    # the OP, whose num_replies/data get updated
+    seen = seen_filter.get_filter("chan_posts", conn)
+    fresh, maybe = seen.check([seen_filter.chan_key(board, post["no"]) for post in posts if not is_op(post)])
+    fresh_keys = set(fresh)
+    rows = [post_to_row(board, thread_number, post) for post in posts if is_op(post) or seen_filter.chan_key(board, post["no"]) in fresh_keys]
+    skipped = len(posts) - len(rows)
+    if not rows:
+        return 0, skipped
+
+    with seen_filter.transaction(conn):
+        with conn.cursor() as cur:
+            returned = execute_values(cur, CHAN_POSTS_INSERT, rows, page_size=len(rows), fetch=True)
+        returned = [row[0] for row in returned if row[1]]
+        seen_filter.stage(conn, "chan_posts", fresh, [seen_filter.chan_key(board, no) for no in returned], maybe)
+
+    inserted = len(returned)
+    return inserted, len(rows) - inserted + skipped
+
+
+def spool_thread_posts(board, thread_number, posts):
+    """
+    Append a thread's posts to the local spool for spool_loader.py to insert.
+    No high water lookup here, the loader's upsert drops what we already have
+    and refreshes the OP.
+    """
+    seen = seen_filter.get_filter("chan_posts")
+    fresh, _ = seen.check([seen_filter.chan_key(board, post["no"]) for post in posts if not is_op(post)])
+    fresh_keys = set(fresh)
+    rows = [post_to_row(board, thread_number, post) for post in posts if is_op(post) or seen_filter.chan_key(board, post["no"]) in fresh_keys]
+    if rows:
+        spool.append_rows("chan_posts", CHAN_POSTS_COLUMNS, rows)
+        spool.commit()
+    logger.info(f"Spooled /{board}/{thread_number}: {len(rows)} posts, {len(posts) - len(rows)} already seen")
+    logger.debug(f"spool stats: {spool.spool_stats()}")
 
 
-"""Get a set of the threads that are now dead"""
+"""enqueue a thread list carwl to get the live threads on a board"""
 
 
-def get_dead_threads(board, old_threads=set()):
-    # faktory_server_url = "tcp://:password@localhost:7419"
+def enqueue_crawl_threads_listing(board, old_threads=None):
     client = ChanClient()
-    new_threads = threads_list_to_thread_number(client.get_threads(board))
+    source = crawl_state.chan_source(board)
+    if old_threads is None:
+        old_threads, _ = spool.load_state(source)
+    # jobs queued before the state table existed still carry the threads in their args
+    old_state = thread_state_from_args(old_threads or [])
+
+    # threads.json is fetched once per cycle and shared by the dead/changed checks
+    threads = client.get_threads(board, conditional=bool(old_state), defer_validator=True)
+    if threads is NOT_MODIFIED:
+        logger.info(f"/{board}/threads.json not modified")
+        new_state = old_state
+        to_crawl = set()
+        changed_threads = set()
+    else:
+        new_state = threads_list_to_thread_state(threads)
+        # find dead threads, and issue jobs to crawl them
+        dead_threads = get_dead_threads(board, set(old_state), set(new_state))
+        logger.debug(f"{dead_threads}")
+        changed_threads = get_changed_threads(old_state, new_state)
+        logger.info(f"/{board}/: {len(changed_threads)} changed, {len(dead_threads)} dead threads")
+        to_crawl = set(dead_threads)
+        if CHAN_INCREMENTAL:
+            to_crawl |= changed_threads
+
+    # crawls go out before the state moves on, so a failed push re-diffs next cycle
+    enqueue_thread_crawls(board, to_crawl)
+    spool.save_state(source, thread_state_to_args(new_state))
+    # same for threads.json: a 304 is only safe once this diff has been acted on
+    commit_validator(client.threads_url(board))
+    logger.debug(f"request stats: {request_stats()}")
+
+    # now we neee to run this job again at some point in the future,
+    # sooner when the board is busy
+    run_at = poll_scheduler.next_run_at("chan", board, len(changed_threads))
+    job = Job(
+        jobtype="crawl_thread_listing",
+        args=(board,),
+        queue="crawl-thread-listing",
+        at=str(run_at),
+    )
+    faktory_producer.push(job)
+    logger.debug(f"producer stats: {faktory_producer.producer_stats()}")
 
-    dead_threads = old_threads.difference(new_threads)
 
-    for thread in dead_threads:
-        with Client(faktory_url=FACTORY_SERVER_URL, role="producer") as client:
-            producer = Producer(client=client)
-            job = Job(
-                    jobtype="crawl_thread", args=(board, thread), queue="crawl-thread"
-            )
-            producer.push(job)
+"""Get a set of the threads that are now dead"""
+
+
+def get_dead_threads(board, old_threads=set(), new_threads=None):
+    if new_threads is None:
+        client = ChanClient()
+        new_threads = threads_list_to_thread_number(client.get_threads(board))
+
+    dead_threads = old_threads.difference(new_threads)
 
     logger.debug(f"{dead_threads}")
+    return dead_threads
+
+
+def enqueue_thread_crawls(board, thread_numbers):
+    if not thread_numbers:
+        return
+    if CHAN_ASYNC_CRAWL:
+        job = Job(jobtype="crawl_threads", args=(board, list(thread_numbers)), queue="crawl-thread")
+        faktory_producer.push(job)
+    else:
+        push_crawl_thread_jobs(board, thread_numbers)
+
+
+def push_crawl_thread_jobs(board, thread_numbers):
+    """push one crawl_thread job per thread, all in a single PUSHB"""
+    jobs = [
+        Job(jobtype="crawl_thread", args=(board, thread), queue="crawl-thread")
+        for thread in thread_numbers
+    ]
+    faktory_producer.push_bulk(jobs)
+
+
+"""backfill the threads in a board's archive that we don't have yet"""
+
+
+def enqueue_backfill_archive(board):
+    source = crawl_state.chan_source(board) + "/backfill"
+    checkpoint, _ = spool.load_state(source)
+    if checkpoint is None:
+        archive = ChanClient().get_archive(board)
+        checkpoint = {"pending": sorted(archive, reverse=True), "done": 0, "failed": []}
+        logger.info(f"Starting backfill of /{board}/: {len(archive)} archived threads")
+
+    pending = checkpoint["pending"]
+    if not pending:
+        logger.info(f"Backfill of /{board}/ already complete ({checkpoint['done']} threads)")
+        return
+
+    batch, rest = pending[:CHAN_BACKFILL_BATCH], pending[CHAN_BACKFILL_BATCH:]
+    try:
+        with db_pool.connection() as conn:
+            stored = get_stored_threads(conn, board, batch)
+    except spool.DB_ERRORS as e:
+        if not spool.can_fallback():
+            raise
+        # fetch the whole batch, the spool loader's upsert drops what we have
+        logger.warning(f"Backfill /{board}/: database unavailable ({e}), not skipping stored threads")
+        stored = set()
+    to_fetch = [no for no in batch if no not in stored]
+    logger.info(f"Backfill /{board}/: fetching {len(to_fetch)}, {len(batch) - len(to_fetch)} already stored, {len(rest)} left")
+
+    # the async client paces these with the shared token bucket
+    threads = async_chan_client.run_fetch_threads(board, to_fetch)
+    failed = []
+    for thread_number, thread in threads.items():
+        if isinstance(thread, Exception):
+            logger.warning(f"Backfill failed to get /{board}/{thread_number}: {thread}")
+            failed.append(thread_number)
+        elif len(thread) > 0:
+            save_thread(board, thread_number, thread)
+
+    # failed threads are kept aside in the checkpoint instead of failing the whole batch
+    checkpoint = {
+        "pending": rest,
+        "done": checkpoint["done"] + len(batch) - len(failed),
+        "failed": checkpoint.get("failed", []) + failed,
+    }
+    spool.save_state(source, checkpoint)
+
+    if rest:
+        job = Job(jobtype="backfill_archive", args=(board,), queue="backfill-archive")
+        faktory_producer.push(job)
+    else:
+        logger.info(f"Backfill of /{board}/ complete ({checkpoint['done']} threads, {len(checkpoint['failed'])} failed)")
+
+
+def get_stored_threads(conn, board, thread_numbers):
+    """which of these threads already have posts in chan_posts"""
+    with conn.cursor() as cur:
+        # answered from the (board_name, thread_number, post_number) index
+        cur.execute(
+            "SELECT t.no FROM unnest(%s::bigint[]) AS t(no) "
+            "WHERE EXISTS (SELECT 1 FROM chan_posts WHERE board_name = %s AND thread_number = t.no);",
+            (list(thread_numbers), board),
+        )
+        stored = {row[0] for row in cur.fetchall()}
+    conn.rollback()
+    return stored
 
 
 if __name__ == "__main__":
@@ -157,10 +427,12 @@ if __name__ == "__main__":
     with Client(faktory_url=FACTORY_SERVER_URL, role="consumer") as client:
         consumer = Consumer(
             client=client,
-            queues=["default", "crawl-thread", "crawl-thread-listing"],
-            concurrency=3,
+            queues=["default", "crawl-thread", "crawl-thread-listing", "backfill-archive"],
+            concurrency=db_pool.WORKER_CONCURRENCY,
         )
         consumer.register("crawl_thread", enqueue_crawl_thread)
+        consumer.register("crawl_threads", enqueue_crawl_threads)
+        consumer.register("backfill_archive", enqueue_backfill_archive)
         consumer.register("crawl_thread_listing", enqueue_crawl_threads_listing)
         consumer.run()
 
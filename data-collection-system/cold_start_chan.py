@@ -16,6 +16,8 @@ logger.addHandler(sh)
 
 if __name__ == "__main__":
     board = sys.argv[1]
+    # python cold_start_chan.py <board> --backfill also walks the board's archive
+    backfill = "--backfill" in sys.argv[2:]
     print(f"Cold starting catalog crawl for board {board}")
     # Default url for a Faktory server running locally
     faktory_server_url = "tcp://:password@localhost:7419"
@@ -26,3 +28,6 @@ if __name__ == "__main__":
             jobtype="crawl_thread_listing", args=(board,), queue="crawl-thread-listing"
         )
         producer.push(job)
+        if backfill:
+            print(f"Starting archive backfill for board {board}")
+            producer.push(Job(jobtype="backfill_archive", args=(board,), queue="backfill-archive"))
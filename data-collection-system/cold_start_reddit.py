@@ -16,6 +16,8 @@ logger.addHandler(sh)
 
 if __name__ == "__main__":
     subreddit = sys.argv[1]
+    # python cold_start_reddit.py <subreddit> --backfill also fills in full comment trees of stored posts
+    backfill = "--backfill" in sys.argv[2:]
     print(f"Cold starting posts and comments crawl for subreddit {subreddit}")
     # Default url for a Faktory server running locally
     faktory_server_url = "tcp://:password@localhost:7419"
@@ -30,3 +32,6 @@ if __name__ == "__main__":
         )
         producer.push(post_job)
         producer.push(comment_job)
+        if backfill:
+            print(f"Starting comment tree backfill for subreddit {subreddit}")
+            producer.push(Job(jobtype="backfill_comment_trees", args=(subreddit,), queue="backfill_comments"))
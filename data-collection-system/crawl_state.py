@@ -0,0 +1,81 @@
+"""
+Crawl state kept in Postgres instead of in Faktory job args.
+
+Each board or subreddit listing has one row keyed by a source id, holding the
+set of things seen on the last poll, an optional watermark and optional
+counters about the poll (stats). Jobs only carry
+the board/subreddit name and diff against this.
+"""
+
+import logging
+import os
+
+from psycopg2.extras import Json
+
+import db_pool
+
+logger = logging.getLogger("crawl state")
+logger.propagate = False
+
+log_level_str = os.getenv("LOG_LEVEL", "INFO").upper()
+numeric_level = getattr(logging, log_level_str, logging.INFO)
+
+logger.setLevel(numeric_level)
+if not logger.handlers:
+    sh = logging.StreamHandler()
+    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    sh.setFormatter(formatter)
+    logger.addHandler(sh)
+
+
+def chan_source(board):
+    return f"chan/{board}"
+
+
+def reddit_source(subreddit, kind):
+    """kind is "posts" or "comments" """
+    return f"reddit/{subreddit}/{kind}"
+
+
+def load_state(source, conn=None):
+    """returns (seen, watermark); (None, None) if the source has no state yet"""
+    seen, watermark, _ = load_state_at(source, conn)
+    return seen, watermark
+
+
+def load_state_at(source, conn=None):
+    """load_state plus when the state was written (unix time, None without state)"""
+    if conn is None:
+        with db_pool.connection() as conn:
+            return load_state_at(source, conn)
+
+    with conn.cursor() as cur:
+        cur.execute("SELECT seen, watermark, extract(epoch FROM updated_at) FROM crawl_state WHERE source = %s;", (source,))
+        row = cur.fetchone()
+    conn.rollback()
+    if row is None:
+        return None, None, None
+    return row[0], row[1], float(row[2])
+
+
+def save_state(source, seen, watermark=None, conn=None, stats=None):
+    """
+    Upsert the state for a source. If a connection is passed, the caller owns
+    the transaction, so the state can be committed together with the rows it
+    describes. `stats` are counters about the poll itself, kept apart from
+    the seen/watermark state.
+    """
+    if conn is None:
+        with db_pool.connection() as conn:
+            with conn:
+                save_state(source, seen, watermark, conn, stats)
+        return
+
+    with conn.cursor() as cur:
+        cur.execute(
+            "INSERT INTO crawl_state (source, seen, watermark, stats, updated_at) VALUES (%s, %s, %s, %s, now()) "
+            "ON CONFLICT (source) DO UPDATE SET seen = EXCLUDED.seen, watermark = EXCLUDED.watermark, "
+            "stats = EXCLUDED.stats, updated_at = now();",
+            (source, Json(seen), Json(watermark), Json(stats)),
+        )
+    logger.debug(f"saved crawl state for {source}")
@@ -0,0 +1,215 @@
+"""
+Process-wide PostgreSQL connection pool shared by the Faktory job handlers.
+
+Faktory workers run handlers concurrently, so the pool is sized to the
+Consumer concurrency. It is built lazily and keyed on the pid, so a pool
+created before a fork is never shared with the child processes.
+"""
+
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger("db pool")
+logger.propagate = False
+
+log_level_str = os.getenv("LOG_LEVEL", "INFO").upper()
+numeric_level = getattr(logging, log_level_str, logging.INFO)
+
+logger.setLevel(numeric_level)
+if not logger.handlers:
+    sh = logging.StreamHandler()
+    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    sh.setFormatter(formatter)
+    logger.addHandler(sh)
+
+
+DATABASE_URL = os.environ.get("DATABASE_URL")
+WORKER_CONCURRENCY = int(os.environ.get("WORKER_CONCURRENCY", "3"))
+# how long a handler waits for a free connection before giving up
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "30"))
+# connections idle for longer than this are pinged before being handed out
+DB_POOL_HEALTHCHECK_IDLE = float(os.environ.get("DB_POOL_HEALTHCHECK_IDLE", "30"))
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool:
+    def __init__(self, dsn, size, timeout=DB_POOL_TIMEOUT, healthcheck_idle=DB_POOL_HEALTHCHECK_IDLE):
+        self.dsn = dsn
+        self.size = size
+        self.timeout = timeout
+        self.healthcheck_idle = healthcheck_idle
+        # idle connections, most recently returned last. psycopg2's pools close
+        # anything handed back beyond minconn, and a minconn of `size` would
+        # connect them all up front, so the pool keeps them itself
+        self._idle = []
+        # a slot per connection, idle or checked out; waiting on it blocks
+        # instead of raising when every connection is in use
+        self._slots = threading.BoundedSemaphore(size)
+        self._last_used = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            "connects": 0,
+            "checkouts": 0,
+            "timeouts": 0,
+            "reconnects": 0,
+            "discarded": 0,
+            "wait_total_s": 0.0,
+            "wait_max_s": 0.0,
+            "held_total_s": 0.0,
+            "held_max_s": 0.0,
+        }
+
+    def _record(self, key, value):
+        with self._lock:
+            self._stats[f"{key}_total_s"] += value
+            self._stats[f"{key}_max_s"] = max(self._stats[f"{key}_max_s"], value)
+
+    def _incr(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def _healthy(self, conn):
+        if conn.closed:
+            return False
+        last_used = self._last_used.get(id(conn))
+        # brand new connections don't need a ping
+        if last_used is None or time.monotonic() - last_used < self.healthcheck_idle:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except psycopg2.Error as e:
+            logger.warning(f"Discarding unhealthy connection: {e}")
+            return False
+
+    def _discard(self, conn):
+        self._last_used.pop(id(conn), None)
+        if not conn.closed:
+            conn.close()
+        self._incr("discarded")
+
+    def _take(self):
+        """the most recently used idle connection, or a new one"""
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        conn = psycopg2.connect(dsn=self.dsn)
+        self._incr("connects")
+        return conn
+
+    def getconn(self):
+        start = time.monotonic()
+        if not self._slots.acquire(timeout=self.timeout):
+            self._incr("timeouts")
+            raise PoolTimeout(f"no database connection free after {self.timeout}s (pool size {self.size})")
+
+        try:
+            conn = self._take()
+            if not self._healthy(conn):
+                self._discard(conn)
+                self._incr("reconnects")
+                conn = self._take()
+        except Exception:
+            self._slots.release()
+            raise
+
+        self._record("wait", time.monotonic() - start)
+        self._incr("checkouts")
+        return conn
+
+    def putconn(self, conn, broken=False):
+        try:
+            if broken or conn.closed:
+                self._discard(conn)
+                return
+            if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            self._last_used[id(conn)] = time.monotonic()
+            with self._lock:
+                self._idle.append(conn)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """
+        Check a connection out for the duration of the block. Connections that
+        failed with a connection-level error are closed instead of returned.
+        """
+        conn = self.getconn()
+        checked_out = time.monotonic()
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            held = time.monotonic() - checked_out
+            self._record("held", held)
+            self.putconn(conn, broken=broken)
+            logger.debug(f"connection held for {held * 1000:.1f}ms")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        checkouts = stats["checkouts"] or 1
+        stats["wait_avg_s"] = stats["wait_total_s"] / checkouts
+        stats["held_avg_s"] = stats["held_total_s"] / checkouts
+        stats["size"] = self.size
+        return stats
+
+    def closeall(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._discard(conn)
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is None or _pool_pid != pid:
+        with _pool_lock:
+            if _pool is None or _pool_pid != pid:
+                logger.info(f"Creating connection pool of size {WORKER_CONCURRENCY} in pid {pid}")
+                _pool = ConnectionPool(DATABASE_URL, WORKER_CONCURRENCY)
+                _pool_pid = pid
+    return _pool
+
+
+def connection():
+    """usage: `with db_pool.connection() as conn:`"""
+    return get_pool().connection()
+
+
+def pool_stats():
+    return get_pool().stats()
+
+
+if __name__ == "__main__":
+    # smoke check against DATABASE_URL: back to back checkouts reuse one connection
+    with connection() as first:
+        pass
+    with connection() as second:
+        assert second is first, "pool opened a new connection instead of reusing the idle one"
+    print(pool_stats())
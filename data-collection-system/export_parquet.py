@@ -0,0 +1,258 @@
+"""
+Incremental Parquet export of reddit_posts, reddit_comments and chan_posts.
+
+Each run exports every whole UTC day after the last exported one, up to
+EXPORT_SETTLE_DAYS ago (so backfills and late comments have landed), one
+zstd-compressed Parquet file per day:
+
+    EXPORT_DIR/<table>/day=2025-11-01/part-0.parquet
+    EXPORT_DIR/<table>/manifest.jsonl
+
+Rows are streamed from a server-side cursor in EXPORT_BATCH-row batches and
+written with an explicit schema, so nothing holds a whole day in memory and
+the columns stay typed. The raw `data` JSONB is left out unless
+EXPORT_INCLUDE_DATA=1 (then it is exported as JSON text, serialized by
+Postgres). The last exported day is kept in crawl_state under
+"export/<table>"; manifest.jsonl gets one line per finished file and is only
+ever appended to, so consumers can remember how many lines they have read and
+load only the new partitions. If a run dies between the manifest line and
+the watermark, the day is exported again and listed twice; the later line
+describes the file on disk.
+
+Backfills (archived threads, comment trees) insert rows for days that were
+already exported. Each run therefore also counts the rows of the last
+EXPORT_RECHECK_DAYS exported days, and any day that now has more rows than
+its manifest entry says is exported again: the file is replaced and a new
+manifest line is appended, so consumers reading new lines pick it up. Rows
+landing further back than that are not seen; raise EXPORT_RECHECK_DAYS for
+long backfills.
+
+    python export_parquet.py [table ...]
+"""
+
+import datetime
+import json
+import logging
+import os
+import sys
+
+import psycopg2
+from psycopg2 import sql
+import pyarrow as pa
+import pyarrow.parquet as pq
+from dotenv import load_dotenv
+
+import crawl_state
+
+load_dotenv()
+
+logger = logging.getLogger("parquet export")
+logger.propagate = False
+
+log_level_str = os.getenv("LOG_LEVEL", "INFO").upper()
+numeric_level = getattr(logging, log_level_str, logging.INFO)
+
+logger.setLevel(numeric_level)
+if not logger.handlers:
+    sh = logging.StreamHandler()
+    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    sh.setFormatter(formatter)
+    logger.addHandler(sh)
+
+
+DATABASE_URL = os.environ.get("DATABASE_URL")
+EXPORT_DIR = os.environ.get("EXPORT_DIR", "export")
+EXPORT_BATCH = int(os.environ.get("EXPORT_BATCH", "50000"))
+EXPORT_SETTLE_DAYS = int(os.environ.get("EXPORT_SETTLE_DAYS", "1"))
+EXPORT_INCLUDE_DATA = os.environ.get("EXPORT_INCLUDE_DATA", "0") == "1"
+EXPORT_RECHECK_DAYS = int(os.environ.get("EXPORT_RECHECK_DAYS", "30"))
+
+# column name, SQL expression, arrow type
+EXPORT_COLUMNS = {
+    "reddit_posts": [
+        ("subreddit_id", "subreddit_id", pa.string()),
+        ("name", "name", pa.string()),
+        ("title", "title", pa.string()),
+        ("text", "text", pa.string()),
+        ("flair", "flair", pa.string()),
+        ("author_fullname", "author_fullname", pa.string()),
+        ("url", "url", pa.string()),
+        ("media", "media::text", pa.string()),
+        ("created_utc", "created_utc", pa.timestamp("us", tz="UTC")),
+    ],
+    "reddit_comments": [
+        ("subreddit_id", "subreddit_id", pa.string()),
+        ("name", "name", pa.string()),
+        ("text", "text", pa.string()),
+        ("author_fullname", "author_fullname", pa.string()),
+        ("link_id", "link_id", pa.string()),
+        ("parent_id", "parent_id", pa.string()),
+        ("created_utc", "created_utc", pa.timestamp("us", tz="UTC")),
+    ],
+    "chan_posts": [
+        ("board_name", "board_name", pa.string()),
+        ("thread_number", "thread_number", pa.int64()),
+        ("post_number", "post_number", pa.int64()),
+        ("title", "title", pa.string()),
+        ("text_body", "text_body", pa.string()),
+        ("num_replies", "num_replies", pa.int64()),
+        ("created_utc", "created_utc", pa.timestamp("us", tz="UTC")),
+        ("resto", "resto", pa.int64()),
+    ],
+}
+
+
+def export_columns(table):
+    columns = list(EXPORT_COLUMNS[table])
+    if EXPORT_INCLUDE_DATA:
+        columns.append(("data", "data::text", pa.string()))
+    return columns
+
+
+def export_source(table):
+    return f"export/{table}"
+
+
+def manifest_path(table):
+    return os.path.join(EXPORT_DIR, table, "manifest.jsonl")
+
+
+def read_manifest(table, skip=0):
+    """manifest entries after the first `skip`, for consumers that only want new partitions"""
+    path = manifest_path(table)
+    if not os.path.exists(path):
+        return []
+    with open(path, "r") as file:
+        entries = [json.loads(line) for line in file if line.strip()]
+    return entries[skip:]
+
+
+def append_manifest(table, entry):
+    with open(manifest_path(table), "a") as file:
+        file.write(json.dumps(entry) + "\n")
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def days_to_export(conn, table, last_day):
+    """whole days after last_day up to EXPORT_SETTLE_DAYS ago"""
+    if last_day is None:
+        with conn.cursor() as cur:
+            cur.execute(sql.SQL("SELECT min(created_utc)::date FROM {};").format(sql.Identifier(table)))
+            first_day = cur.fetchone()[0]
+        conn.rollback()
+        if first_day is None:
+            return []
+    else:
+        first_day = datetime.date.fromisoformat(last_day) + datetime.timedelta(days=1)
+    last_settled = datetime.datetime.utcnow().date() - datetime.timedelta(days=EXPORT_SETTLE_DAYS)
+    days = []
+    day = first_day
+    while day < last_settled:
+        days.append(day)
+        day += datetime.timedelta(days=1)
+    return days
+
+
+def days_with_new_rows(conn, table, last_day):
+    """exported days in the last EXPORT_RECHECK_DAYS that now have more rows than we exported"""
+    if last_day is None or EXPORT_RECHECK_DAYS <= 0:
+        return []
+    # the latest manifest line for a day describes its file on disk
+    exported = {entry["day"]: entry["rows"] for entry in read_manifest(table)}
+    end = datetime.date.fromisoformat(last_day) + datetime.timedelta(days=1)
+    start = end - datetime.timedelta(days=EXPORT_RECHECK_DAYS)
+    with conn.cursor() as cur:
+        cur.execute(
+            sql.SQL(
+                "SELECT created_utc::date, count(*) FROM {} WHERE created_utc >= %s AND created_utc < %s GROUP BY 1;"
+            ).format(sql.Identifier(table)),
+            (start, end),
+        )
+        counts = cur.fetchall()
+    conn.rollback()
+    return sorted(day for day, rows in counts if rows > exported.get(day.isoformat(), 0))
+
+
+def to_batch(rows, schema):
+    # created_utc is stored as naive UTC
+    arrays = []
+    for i, field in enumerate(schema):
+        values = [row[i] for row in rows]
+        if pa.types.is_timestamp(field.type):
+            values = [v.replace(tzinfo=datetime.timezone.utc) if v is not None else None for v in values]
+        arrays.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def export_day(conn, table, day):
+    """write one day of `table` to its partition, returns the manifest entry"""
+    columns = export_columns(table)
+    schema = pa.schema([(name, arrow_type) for name, _, arrow_type in columns])
+    partition = os.path.join(EXPORT_DIR, table, f"day={day.isoformat()}")
+    os.makedirs(partition, exist_ok=True)
+    path = os.path.join(partition, "part-0.parquet")
+    tmp_path = path + ".tmp"
+
+    rows_written = 0
+    # named cursor = server-side, rows come over in itersize chunks
+    with conn.cursor(name=f"export_{table}") as cur:
+        cur.itersize = EXPORT_BATCH
+        # the expressions are our own constants from EXPORT_COLUMNS
+        cur.execute(
+            sql.SQL(
+                "SELECT {} FROM {} WHERE created_utc >= %s AND created_utc < %s ORDER BY created_utc;"
+            ).format(sql.SQL(", ".join(expr for _, expr, _ in columns)), sql.Identifier(table)),
+            (day, day + datetime.timedelta(days=1)),
+        )
+        with pq.ParquetWriter(tmp_path, schema, compression="zstd") as writer:
+            while True:
+                rows = cur.fetchmany(EXPORT_BATCH)
+                if not rows:
+                    break
+                writer.write_batch(to_batch(rows, schema))
+                rows_written += len(rows)
+    conn.rollback()
+    os.replace(tmp_path, path)
+
+    return {
+        "day": day.isoformat(),
+        "path": os.path.relpath(path, os.path.join(EXPORT_DIR, table)),
+        "rows": rows_written,
+        "bytes": os.path.getsize(path),
+        "columns": [name for name, _, _ in columns],
+        "exported_at": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+    }
+
+
+def export_table(conn, table):
+    os.makedirs(os.path.join(EXPORT_DIR, table), exist_ok=True)
+    _, last_day = crawl_state.load_state(export_source(table), conn)
+    stale = days_with_new_rows(conn, table, last_day)
+    days = days_to_export(conn, table, last_day)
+    if not stale and not days:
+        logger.info(f"{table}: nothing new to export (last day {last_day})")
+        return
+    for day in stale:
+        entry = export_day(conn, table, day)
+        append_manifest(table, entry)
+        logger.info(f"{table}: re-exported {entry['day']} with {entry['rows']} rows after late inserts")
+    for day in days:
+        entry = export_day(conn, table, day)
+        append_manifest(table, entry)
+        # the watermark only moves once the file and its manifest line are down
+        crawl_state.save_state(export_source(table), {"last_file": entry["path"], "rows": entry["rows"]}, day.isoformat())
+        logger.info(f"{table}: exported {entry['rows']} rows for {entry['day']} ({entry['bytes'] / 2**20:.1f} MB)")
+
+
+if __name__ == "__main__":
+    tables = sys.argv[1:] or list(EXPORT_COLUMNS)
+    unknown = [table for table in tables if table not in EXPORT_COLUMNS]
+    if unknown:
+        sys.exit(f"unknown table(s) {', '.join(unknown)}; pick from {', '.join(EXPORT_COLUMNS)}")
+    conn = psycopg2.connect(dsn=DATABASE_URL)
+    try:
+        for table in tables:
+            export_table(conn, table)
+    finally:
+        conn.close()
@@ -0,0 +1,178 @@
+"""
+One long-lived Faktory producer connection per worker process.
+
+Job handlers used to open (and handshake/auth) a new pyfaktory Client for
+every job they pushed. This keeps a single connection around, reconnects it
+when it breaks, and offers push_bulk() so a whole cycle's jobs go out in one
+PUSHB round trip.
+
+Delivery is at least once. A push that fails is retried on a fresh
+connection, and when the connection dropped after the server had already
+accepted the push, the jobs end up queued twice (Faktory only dedupes by jid
+with unique jobs, which we don't use). That is fine for every job we push:
+inserts are ON CONFLICT upserts and a second listing/crawl of the same thing
+finds nothing new.
+"""
+
+import logging
+import os
+import threading
+import time
+
+from pyfaktory import Client, Producer
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger("faktory producer")
+logger.propagate = False
+
+log_level_str = os.getenv("LOG_LEVEL", "INFO").upper()
+numeric_level = getattr(logging, log_level_str, logging.INFO)
+
+logger.setLevel(numeric_level)
+if not logger.handlers:
+    sh = logging.StreamHandler()
+    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    sh.setFormatter(formatter)
+    logger.addHandler(sh)
+
+
+FAKTORY_URL = os.environ.get("FAKTORY_URL")
+
+
+class PushRejected(Exception):
+    """the server refused some jobs of a PUSHB; `rejected` maps jid -> reason"""
+
+    def __init__(self, rejected):
+        super().__init__(f"faktory rejected {len(rejected)} job(s): {rejected}")
+        self.rejected = rejected
+
+
+class SharedProducer:
+    def __init__(self, faktory_url):
+        self.faktory_url = faktory_url
+        self._client = None
+        self._producer = None
+        # a faktory connection is one socket, so pushes have to take turns
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "pushes": 0,
+            "jobs": 0,
+            "reconnects": 0,
+            "errors": 0,
+            "rejected": 0,
+            "latency_total_s": 0.0,
+            "latency_max_s": 0.0,
+            "latency_last_s": 0.0,
+        }
+
+    def _connect(self):
+        self._client = Client(faktory_url=self.faktory_url, role="producer")
+        self._client.connect()
+        self._producer = Producer(client=self._client)
+
+    def _disconnect(self):
+        if self._client is not None:
+            try:
+                self._client.disconnect()
+            except Exception as e:
+                logger.debug(f"Error closing faktory connection: {e}")
+        self._client = None
+        self._producer = None
+
+    def _send(self, send, num_jobs):
+        # retried once on a new connection; see the module docstring about duplicates
+        with self._lock:
+            for attempt in range(2):
+                if self._producer is None:
+                    if attempt > 0:
+                        self._incr("reconnects")
+                    self._connect()
+                start = time.monotonic()
+                try:
+                    result = send(self._producer)
+                except Exception as e:
+                    self._disconnect()
+                    self._incr("errors")
+                    if attempt > 0:
+                        raise
+                    logger.warning(f"Faktory push failed, reconnecting: {e}")
+                    continue
+                self._record(time.monotonic() - start, num_jobs)
+                return result
+
+    def _incr(self, key, n=1):
+        with self._stats_lock:
+            self._stats[key] += n
+
+    def _record(self, latency, num_jobs):
+        with self._stats_lock:
+            self._stats["pushes"] += 1
+            self._stats["jobs"] += num_jobs
+            self._stats["latency_total_s"] += latency
+            self._stats["latency_last_s"] = latency
+            self._stats["latency_max_s"] = max(self._stats["latency_max_s"], latency)
+        logger.debug(f"pushed {num_jobs} job(s) in {latency * 1000:.1f}ms")
+
+    def push(self, job):
+        return self._send(lambda producer: producer.push(job), 1)
+
+    def push_bulk(self, jobs):
+        """
+        push many jobs with a single PUSHB command. Jobs the server rejects are
+        pushed once more, and PushRejected is raised if any are still refused,
+        so the calling job fails (and is retried) instead of dropping them.
+        """
+        jobs = list(jobs)
+        if not jobs:
+            return None
+        rejected = self._send(lambda producer: producer.push_bulk(jobs), len(jobs)) or {}
+        if rejected:
+            self._incr("rejected", len(rejected))
+            logger.warning(f"faktory rejected {len(rejected)} of {len(jobs)} jobs, retrying them: {rejected}")
+            retry = [job for job in jobs if job.jid in rejected]
+            rejected = self._send(lambda producer: producer.push_bulk(retry), len(retry)) or {}
+            if rejected:
+                self._incr("rejected", len(rejected))
+                raise PushRejected(rejected)
+        return None
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["latency_avg_s"] = stats["latency_total_s"] / (stats["pushes"] or 1)
+        return stats
+
+    def close(self):
+        with self._lock:
+            self._disconnect()
+
+
+_producer = None
+_producer_pid = None
+_producer_lock = threading.Lock()
+
+
+def get_producer():
+    global _producer, _producer_pid
+    pid = os.getpid()
+    if _producer is None or _producer_pid != pid:
+        with _producer_lock:
+            if _producer is None or _producer_pid != pid:
+                _producer = SharedProducer(FAKTORY_URL)
+                _producer_pid = pid
+    return _producer
+
+
+def push(job):
+    return get_producer().push(job)
+
+
+def push_bulk(jobs):
+    return get_producer().push_bulk(jobs)
+
+
+def producer_stats():
+    return get_producer().stats()
@@ -0,0 +1,248 @@
+"""
+Record/replay HTTP layer under ChanClient and RedditClient.
+
+HTTP_CACHE_MODE picks what happens to each GET:
+
+    off     straight to the network (default)
+    record  go to the network and write every response to the store
+    replay  never touch the network; serve recorded responses, in the order
+            they were recorded, and raise ReplayMiss for anything unrecorded
+    cache   read-through: serve a recorded 200 younger than HTTP_CACHE_TTL_S,
+            otherwise fetch, record and serve
+
+The store under HTTP_CACHE_DIR is content-addressed. Bodies are zlib
+compressed and written once under objects/<sha256 of body>, so a threads.json
+polled a hundred times without changing costs one file. Each url gets a
+requests/<sha256 of url>.jsonl log with one line per response: status, the
+headers the clients look at, the body hash and when it was recorded.
+Request headers (auth tokens, If-Modified-Since) are not part of the key.
+
+Replay walks each url's log with a per-process cursor and keeps returning the
+last response once it runs out, so re-running one crawler process over a
+captured day sees the same sequence the live run did.
+"""
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+logger = logging.getLogger("http cache")
+logger.propagate = False
+
+log_level_str = os.getenv("LOG_LEVEL", "INFO").upper()
+numeric_level = getattr(logging, log_level_str, logging.INFO)
+
+logger.setLevel(numeric_level)
+if not logger.handlers:
+    sh = logging.StreamHandler()
+    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    sh.setFormatter(formatter)
+    logger.addHandler(sh)
+
+
+HTTP_CACHE_MODE = os.environ.get("HTTP_CACHE_MODE", "off")
+HTTP_CACHE_DIR = os.environ.get("HTTP_CACHE_DIR", "http_cache")
+HTTP_CACHE_TTL_S = float(os.environ.get("HTTP_CACHE_TTL_S", "300"))
+
+# response headers the clients read; everything else is dropped when recording
+KEPT_HEADERS = (
+    "Content-Type",
+    "Last-Modified",
+    "X-Ratelimit-Used",
+    "X-Ratelimit-Remaining",
+    "X-Ratelimit-Reset",
+)
+
+
+class ReplayMiss(Exception):
+    """replay mode was asked for a url that was never recorded"""
+
+
+class CachedResponse:
+    """the parts of requests.Response the clients use"""
+
+    from_cache = True
+
+    def __init__(self, url, status_code, headers, content):
+        self.url = url
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers)
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            origin = " (from http cache)" if self.from_cache else ""
+            raise requests.HTTPError(f"{self.status_code} for url: {self.url}{origin}", response=self)
+
+
+class FetchedResponse(CachedResponse):
+    """a live response fetched without requests (the async chan client), in the same shape"""
+
+    from_cache = False
+
+
+class ResponseStore:
+    def __init__(self, root=HTTP_CACHE_DIR):
+        self.root = root
+        self._lock = threading.Lock()
+        self._cursors = {}
+        # replayed logs never change, so each is parsed once
+        self._replay_logs = {}
+        self._stats = {"recorded": 0, "bodies_written": 0, "bytes_compressed": 0, "hits": 0, "misses": 0}
+
+    def _incr(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def _log_path(self, url):
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.root, "requests", key[:2], f"{key}.jsonl")
+
+    def _body_path(self, digest):
+        return os.path.join(self.root, "objects", digest[:2], digest)
+
+    def _write_body(self, content):
+        digest = hashlib.sha256(content).hexdigest()
+        path = self._body_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            compressed = zlib.compress(content, 6)
+            # write under a per-process name first so readers never see half a body
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as file:
+                file.write(compressed)
+            os.replace(tmp_path, path)
+            self._incr("bodies_written")
+            self._incr("bytes_compressed", len(compressed))
+        return digest
+
+    def _read_body(self, digest):
+        with open(self._body_path(digest), "rb") as file:
+            return zlib.decompress(file.read())
+
+    def _read_log(self, url):
+        path = self._log_path(url)
+        if not os.path.exists(path):
+            return []
+        with open(path, "r") as file:
+            return [json.loads(line) for line in file if line.strip()]
+
+    def record(self, url, response):
+        entry = {
+            "url": url,
+            "status": response.status_code,
+            "headers": {h: response.headers[h] for h in KEPT_HEADERS if h in response.headers},
+            "body": self._write_body(response.content),
+            "at": time.time(),
+        }
+        path = self._log_path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "a") as file:
+            # several worker processes may record the same url
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                file.write(json.dumps(entry) + "\n")
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+        self._incr("recorded")
+
+    def _to_response(self, entry):
+        return CachedResponse(entry["url"], entry["status"], entry["headers"], self._read_body(entry["body"]))
+
+    def next_recorded(self, url):
+        """the next response in recording order; the last one again once they run out"""
+        entries = self._replay_logs.get(url)
+        if entries is None:
+            entries = self._replay_logs[url] = self._read_log(url)
+        if not entries:
+            self._incr("misses")
+            raise ReplayMiss(url)
+        with self._lock:
+            i = self._cursors.get(url, 0)
+            self._cursors[url] = i + 1
+        self._incr("hits")
+        return self._to_response(entries[min(i, len(entries) - 1)])
+
+    def latest_fresh(self, url, ttl):
+        """the newest recorded 200 for url if it is younger than ttl, else None"""
+        for entry in reversed(self._read_log(url)):
+            if entry["status"] == 200:
+                if time.time() - entry["at"] < ttl:
+                    self._incr("hits")
+                    return self._to_response(entry)
+                break
+        self._incr("misses")
+        return None
+
+
+class HttpLayer:
+    """
+    get(url, headers, on_fetch) is what the clients call instead of
+    session.get. on_fetch runs right before a request actually goes out, so
+    callers can rate limit real traffic without slowing down cache hits.
+    Responses served from the store have from_cache = True.
+
+    Clients that fetch on their own (AsyncChanClient) call lookup() first and
+    save() with what they fetched, which gives them the same four modes.
+    """
+
+    def __init__(self, session, mode=HTTP_CACHE_MODE, store=None, ttl=HTTP_CACHE_TTL_S):
+        if mode not in ("off", "record", "replay", "cache"):
+            raise ValueError(f"unknown HTTP_CACHE_MODE {mode!r}")
+        self.session = session
+        self.mode = mode
+        self.store = store if store is not None else (ResponseStore() if mode != "off" else None)
+        self.ttl = ttl
+
+    def _fetch(self, url, headers, on_fetch):
+        if on_fetch is not None:
+            on_fetch()
+        r = self.session.get(url, headers=headers)
+        r.from_cache = False
+        return r
+
+    def lookup(self, url):
+        """the stored response to serve for url, or None if it has to be fetched"""
+        if self.mode == "replay":
+            return self.store.next_recorded(url)
+        if self.mode == "cache":
+            cached = self.store.latest_fresh(url, self.ttl)
+            if cached is not None:
+                logger.debug(f"cache hit: {url}")
+            return cached
+        return None
+
+    def save(self, url, r):
+        """store a response that lookup() didn't have, as this mode wants"""
+        if self.mode == "record" or (self.mode == "cache" and r.status_code == 200):
+            self.store.record(url, r)
+
+    def get(self, url, headers=None, on_fetch=None):
+        cached = self.lookup(url)
+        if cached is not None:
+            return cached
+        r = self._fetch(url, headers, on_fetch)
+        self.save(url, r)
+        return r
+
+    def stats(self):
+        return self.store.stats() if self.store is not None else {}
@@ -0,0 +1,2 @@
+-- Add down migration script here
+DROP INDEX IF EXISTS chan_posts_thread_high_water_idx;
@@ -0,0 +1,4 @@
+-- Add up migration script here
+-- lets the crawl_thread job look up the highest stored post of a thread
+-- without scanning every chunk
+CREATE INDEX IF NOT EXISTS chan_posts_thread_high_water_idx ON chan_posts (board_name, thread_number, post_number DESC);
@@ -0,0 +1,8 @@
+-- Add up migration script here
+-- per board/subreddit crawl state, so jobs don't carry it in their args
+CREATE TABLE IF NOT EXISTS crawl_state(
+    source TEXT PRIMARY KEY,
+    seen JSONB NOT NULL,
+    watermark JSONB,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
@@ -0,0 +1,2 @@
+-- Add down migration script here
+DROP INDEX IF EXISTS reddit_comments_link_id_idx;
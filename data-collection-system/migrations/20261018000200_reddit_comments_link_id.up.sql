@@ -0,0 +1,3 @@
+-- Add up migration script here
+-- lets the comment tree backfill find the comments already stored for a post
+CREATE INDEX IF NOT EXISTS reddit_comments_link_id_idx ON reddit_comments (link_id, created_utc DESC);
@@ -0,0 +1,22 @@
+-- Add down migration script here
+SELECT delete_job(job_id) FROM timescaledb_information.jobs WHERE proc_name = 'strip_raw_data';
+DROP PROCEDURE IF EXISTS strip_raw_data(INT, JSONB);
+
+SELECT remove_retention_policy('reddit_posts', if_exists => true);
+SELECT remove_retention_policy('reddit_comments', if_exists => true);
+SELECT remove_retention_policy('chan_posts', if_exists => true);
+SELECT remove_compression_policy('reddit_posts', if_exists => true);
+SELECT remove_compression_policy('reddit_comments', if_exists => true);
+SELECT remove_compression_policy('chan_posts', if_exists => true);
+
+-- compression can only be turned off once every chunk is decompressed
+SELECT decompress_chunk(c, if_compressed => true) FROM show_chunks('reddit_posts') c;
+SELECT decompress_chunk(c, if_compressed => true) FROM show_chunks('reddit_comments') c;
+SELECT decompress_chunk(c, if_compressed => true) FROM show_chunks('chan_posts') c;
+ALTER TABLE reddit_posts SET (timescaledb.compress = false);
+ALTER TABLE reddit_comments SET (timescaledb.compress = false);
+ALTER TABLE chan_posts SET (timescaledb.compress = false);
+
+SELECT set_chunk_time_interval('reddit_posts', INTERVAL '1 hours');
+SELECT set_chunk_time_interval('reddit_comments', INTERVAL '1 hours');
+SELECT set_chunk_time_interval('chan_posts', INTERVAL '1 hours');
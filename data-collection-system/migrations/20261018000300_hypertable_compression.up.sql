@@ -0,0 +1,55 @@
+-- Add up migration script here
+-- 1 hour chunks left us with thousands of tiny chunks; new chunks cover a day.
+-- Existing chunks keep their size, they just get compressed like the rest.
+SELECT set_chunk_time_interval('reddit_posts', INTERVAL '1 day');
+SELECT set_chunk_time_interval('reddit_comments', INTERVAL '1 day');
+SELECT set_chunk_time_interval('chan_posts', INTERVAL '1 day');
+
+-- columnar compression, one segment per subreddit/board so per-source queries
+-- only decompress their own rows. Orders match the unique indexes so
+-- ON CONFLICT checks against compressed chunks stay cheap.
+ALTER TABLE reddit_posts SET (
+    timescaledb.compress,
+    timescaledb.compress_segmentby = 'subreddit_id',
+    timescaledb.compress_orderby = 'created_utc DESC, name'
+);
+ALTER TABLE reddit_comments SET (
+    timescaledb.compress,
+    timescaledb.compress_segmentby = 'subreddit_id',
+    timescaledb.compress_orderby = 'created_utc DESC, name'
+);
+ALTER TABLE chan_posts SET (
+    timescaledb.compress,
+    timescaledb.compress_segmentby = 'board_name',
+    timescaledb.compress_orderby = 'created_utc DESC, thread_number, post_number'
+);
+
+-- default policy; storage_policies.py changes the interval and adds retention
+SELECT add_compression_policy('reddit_posts', INTERVAL '7 days', if_not_exists => true);
+SELECT add_compression_policy('reddit_comments', INTERVAL '7 days', if_not_exists => true);
+SELECT add_compression_policy('chan_posts', INTERVAL '7 days', if_not_exists => true);
+
+-- Shrinks the raw `data` JSONB of rows older than config->>'older_than' down
+-- to the keys in config->'keep', per table. Only looks at the day before the
+-- cutoff, so run it (via add_job) more often than daily and before the
+-- compression policy gets to those rows.
+--   {"older_than": "3 days", "tables": {"reddit_posts": ["subreddit", "num_comments"]}}
+CREATE OR REPLACE PROCEDURE strip_raw_data(job_id INT, config JSONB)
+LANGUAGE plpgsql AS $$
+DECLARE
+    cutoff TIMESTAMP := now()::timestamp - (config->>'older_than')::interval;
+    tbl TEXT;
+    keep JSONB;
+BEGIN
+    FOR tbl, keep IN SELECT * FROM jsonb_each(config->'tables') LOOP
+        EXECUTE format(
+            'UPDATE %I SET data = (SELECT coalesce(jsonb_object_agg(key, value), ''{}''::jsonb) '
+            'FROM jsonb_each(data) WHERE key IN (SELECT jsonb_array_elements_text($1))) '
+            'WHERE created_utc < $2 AND created_utc >= $2 - INTERVAL ''1 day'' '
+            'AND EXISTS (SELECT 1 FROM jsonb_object_keys(data) k WHERE k NOT IN (SELECT jsonb_array_elements_text($1)))',
+            tbl
+        ) USING keep, cutoff;
+        COMMIT;
+    END LOOP;
+END
+$$;
@@ -0,0 +1,4 @@
+-- Add down migration script here
+DROP MATERIALIZED VIEW IF EXISTS reddit_posts_activity_15m;
+DROP MATERIALIZED VIEW IF EXISTS reddit_comments_activity_15m;
+DROP MATERIALIZED VIEW IF EXISTS chan_posts_activity_15m;
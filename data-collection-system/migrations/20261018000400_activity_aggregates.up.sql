@@ -0,0 +1,39 @@
+-- no-transaction
+-- Add up migration script here
+-- 15 minute activity counts per subreddit/flair and board, the base bin of the
+-- dashboard's Activity tab; coarser bins are rolled up from these at query time.
+-- Runs outside a transaction so the views can be filled WITH DATA.
+CREATE MATERIALIZED VIEW IF NOT EXISTS reddit_posts_activity_15m
+WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+SELECT time_bucket(INTERVAL '15 minutes', created_utc) AS bucket, subreddit_id, flair, count(*) AS count
+FROM reddit_posts
+GROUP BY bucket, subreddit_id, flair
+WITH DATA;
+
+-- comments carry no flair of their own, so these are per subreddit only
+CREATE MATERIALIZED VIEW IF NOT EXISTS reddit_comments_activity_15m
+WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+SELECT time_bucket(INTERVAL '15 minutes', created_utc) AS bucket, subreddit_id, count(*) AS count
+FROM reddit_comments
+GROUP BY bucket, subreddit_id
+WITH DATA;
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS chan_posts_activity_15m
+WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+SELECT time_bucket(INTERVAL '15 minutes', created_utc) AS bucket, board_name, count(*) AS count
+FROM chan_posts
+GROUP BY bucket, board_name
+WITH DATA;
+
+-- refresh the last 3 days every 15 minutes; that covers late rows from the
+-- thread/comment backfills and stays clear of compressed (7 day) chunks.
+-- Anything newer than the last refresh is aggregated on the fly.
+SELECT add_continuous_aggregate_policy('reddit_posts_activity_15m',
+    start_offset => INTERVAL '3 days', end_offset => INTERVAL '15 minutes',
+    schedule_interval => INTERVAL '15 minutes', if_not_exists => true);
+SELECT add_continuous_aggregate_policy('reddit_comments_activity_15m',
+    start_offset => INTERVAL '3 days', end_offset => INTERVAL '15 minutes',
+    schedule_interval => INTERVAL '15 minutes', if_not_exists => true);
+SELECT add_continuous_aggregate_policy('chan_posts_activity_15m',
+    start_offset => INTERVAL '3 days', end_offset => INTERVAL '15 minutes',
+    schedule_interval => INTERVAL '15 minutes', if_not_exists => true);
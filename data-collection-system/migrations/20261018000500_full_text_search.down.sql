@@ -0,0 +1,4 @@
+-- Add down migration script here
+DROP INDEX IF EXISTS reddit_posts_search_idx;
+DROP INDEX IF EXISTS reddit_comments_search_idx;
+DROP INDEX IF EXISTS chan_posts_search_idx;
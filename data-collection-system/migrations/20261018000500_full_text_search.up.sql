@@ -0,0 +1,22 @@
+-- no-transaction
+-- Add up migration script here
+-- GIN expression indexes for search.py. Title/thread subject weigh more than
+-- the body. search.py's SEARCH_DOCUMENTS must repeat these expressions exactly
+-- or the planner won't use the indexes.
+--
+-- Indexes on expressions (instead of a stored generated column) leave the
+-- table definition alone, so compression stays on and no chunk has to be
+-- decompressed. Compressed chunks aren't indexed; search.py filters them.
+-- transaction_per_chunk builds the index one chunk at a time instead of
+-- locking the whole hypertable, which needs the migration outside a transaction.
+CREATE INDEX IF NOT EXISTS reddit_posts_search_idx ON reddit_posts USING GIN ((
+    setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+    setweight(to_tsvector('english', coalesce(text, '')), 'B')
+)) WITH (timescaledb.transaction_per_chunk);
+CREATE INDEX IF NOT EXISTS reddit_comments_search_idx ON reddit_comments USING GIN ((
+    to_tsvector('english', coalesce(text, ''))
+)) WITH (timescaledb.transaction_per_chunk);
+CREATE INDEX IF NOT EXISTS chan_posts_search_idx ON chan_posts USING GIN ((
+    setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+    setweight(to_tsvector('english', coalesce(text_body, '')), 'B')
+)) WITH (timescaledb.transaction_per_chunk);
@@ -0,0 +1,2 @@
+-- Add down migration script here
+DROP INDEX IF EXISTS reddit_posts_subreddit_id_idx;
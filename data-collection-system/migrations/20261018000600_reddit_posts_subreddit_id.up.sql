@@ -0,0 +1,3 @@
+-- Add up migration script here
+-- lets the comment tree backfill walk one subreddit's posts in created_utc order
+CREATE INDEX IF NOT EXISTS reddit_posts_subreddit_id_idx ON reddit_posts (subreddit_id, created_utc, name);
@@ -0,0 +1,3 @@
+-- Add down migration script here
+UPDATE crawl_state SET seen = stats WHERE stats IS NOT NULL;
+ALTER TABLE crawl_state DROP COLUMN IF EXISTS stats;
@@ -0,0 +1,8 @@
+-- Add up migration script here
+-- per-poll fetch counters (pages, api requests, ...) get their own column
+-- instead of riding in `seen`
+ALTER TABLE crawl_state ADD COLUMN IF NOT EXISTS stats JSONB;
+
+-- reddit listing sources used to keep them in `seen`; move them over
+UPDATE crawl_state SET stats = seen, seen = '{}'::jsonb
+WHERE source LIKE 'reddit/%' AND (source LIKE '%/posts' OR source LIKE '%/comments') AND seen ? 'pages';
@@ -0,0 +1,182 @@
+"""
+Adaptive poll scheduling for chan boards and subreddits.
+
+Each source (a board's thread listing, a subreddit's /new or /comments
+listing) keeps a smoothed estimate of how many new items arrive per second.
+The next poll is scheduled so that, at that rate, it should find about
+`target_fill` new items, i.e. well inside the 100-item page, clamped to
+[min_interval_s, max_interval_s]. Busy subs get polled more often, quiet
+boards less.
+
+Sources and per-source overrides come from a JSON file (POLL_CONFIG,
+default poll_config.json):
+
+    {
+        "defaults": {"target_fill": 60},
+        "chan": {"sp": {}, "pol": {"max_interval_s": 600}},
+        "reddit_posts": {"sports": {}},
+        "reddit_comments": {"sports": {"target_fill": 50}, "hockey+golf+f1": {}}
+    }
+
+A reddit name like "hockey+golf+f1" is polled as one combined listing (one
+request for all three). Subreddits that turn out to dominate the shared page
+get split off into their own scans by the crawler.
+
+Running `python poll_scheduler.py` pushes the first job for every source in
+the config file.
+"""
+
+import datetime
+import json
+import logging
+import os
+import time
+
+from pyfaktory import Job
+
+import crawl_state
+import faktory_producer
+import spool
+
+logger = logging.getLogger("poll scheduler")
+logger.propagate = False
+
+log_level_str = os.getenv("LOG_LEVEL", "INFO").upper()
+numeric_level = getattr(logging, log_level_str, logging.INFO)
+
+logger.setLevel(numeric_level)
+if not logger.handlers:
+    sh = logging.StreamHandler()
+    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    sh.setFormatter(formatter)
+    logger.addHandler(sh)
+
+
+POLL_CONFIG = os.environ.get("POLL_CONFIG", "poll_config.json")
+
+# weight of the newest observation in the arrival rate average
+RATE_ALPHA = 0.3
+
+# initial_interval_s is used until a source has been polled twice; the values
+# are the intervals the crawlers used before scheduling was adaptive
+KIND_DEFAULTS = {
+    "chan": {"target_fill": 60, "page_size": None, "min_interval_s": 60, "max_interval_s": 900, "initial_interval_s": 300},
+    "reddit_posts": {"target_fill": 60, "page_size": 100, "min_interval_s": 300, "max_interval_s": 3 * 3600, "initial_interval_s": 3600},
+    "reddit_comments": {"target_fill": 60, "page_size": 100, "min_interval_s": 60, "max_interval_s": 3600, "initial_interval_s": 900},
+}
+
+# jobtype/queue that polls each kind of source
+KIND_JOBS = {
+    "chan": ("crawl_thread_listing", "crawl-thread-listing"),
+    "reddit_posts": ("scan_posts", "scan_posts"),
+    "reddit_comments": ("scan_comments", "scan_comments"),
+}
+
+_config = None
+
+
+def load_config(path=POLL_CONFIG):
+    global _config
+    if _config is None:
+        if os.path.exists(path):
+            with open(path, "r") as file:
+                _config = json.load(file)
+        else:
+            logger.info(f"{path} not found, using default poll settings")
+            _config = {}
+    return _config
+
+
+def source_settings(kind, name):
+    config = load_config()
+    settings = dict(KIND_DEFAULTS[kind])
+    settings.update(config.get("defaults", {}))
+    settings.update(config.get(kind, {}).get(name) or {})
+    return settings
+
+
+def schedule_source(kind, name):
+    if kind == "chan":
+        base = crawl_state.chan_source(name)
+    else:
+        base = crawl_state.reddit_source(name, kind.split("_", 1)[1])
+    return base + "/schedule"
+
+
+def compute_interval(settings, rate):
+    """seconds until the next poll for a source seeing `rate` new items/second"""
+    if rate is None:
+        interval = settings["initial_interval_s"]
+    elif rate <= 0:
+        interval = settings["max_interval_s"]
+    else:
+        interval = settings["target_fill"] / rate
+    return max(settings["min_interval_s"], min(settings["max_interval_s"], interval))
+
+
+def update_rate(rate, new_items, elapsed, saturated=False):
+    observed = new_items / elapsed
+    if saturated:
+        # a full page of new items means we missed some, so the real rate is
+        # higher than what we saw; overshoot so the interval shrinks quickly
+        observed *= 2
+    if rate is None:
+        return observed
+    return RATE_ALPHA * observed + (1 - RATE_ALPHA) * rate
+
+
+def format_run_at(run_at):
+    return run_at.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def next_run_at(kind, name, new_items, saturated=False):
+    """
+    Record that a poll of `name` found `new_items` new items and return the
+    faktory `at=` string for the next poll.
+
+    The schedule state goes through the spool like the listing state, so with
+    SPOOL_MODE set a database outage doesn't fail the poll after its rows are
+    spooled. If there is no state to be had at all, the next poll uses the
+    initial interval and the stored rate is left alone.
+    """
+    settings = source_settings(kind, name)
+    source = schedule_source(kind, name)
+    try:
+        state, _ = spool.load_state(source)
+    except spool.DB_ERRORS as e:
+        if not spool.can_fallback():
+            raise
+        interval = compute_interval(settings, None)
+        logger.warning(f"{kind} {name}: database unavailable ({e}), next poll in {interval:.0f}s")
+        return format_run_at(datetime.datetime.utcnow() + datetime.timedelta(seconds=interval))
+    state = state or {}
+
+    now = time.time()
+    rate = state.get("rate")
+    last_poll = state.get("last_poll")
+    if last_poll is not None and now > last_poll:
+        page_size = settings["page_size"]
+        saturated = saturated or (page_size is not None and new_items >= page_size)
+        rate = update_rate(rate, new_items, now - last_poll, saturated)
+
+    interval = compute_interval(settings, rate)
+    spool.save_state(source, {"rate": rate, "last_poll": now, "interval": interval})
+
+    rate_str = f"{rate * 3600:.1f}/h" if rate is not None else "unknown"
+    logger.info(f"{kind} {name}: {new_items} new, rate {rate_str}, next poll in {interval:.0f}s")
+    return format_run_at(datetime.datetime.utcnow() + datetime.timedelta(seconds=interval))
+
+
+def seed_jobs():
+    """push the first polling job for every configured source"""
+    config = load_config()
+    jobs = []
+    for kind, (jobtype, queue) in KIND_JOBS.items():
+        for name in config.get(kind, {}):
+            jobs.append(Job(jobtype=jobtype, args=(name,), queue=queue))
+            logger.info(f"seeding {jobtype} for {name}")
+    faktory_producer.push_bulk(jobs)
+
+
+if __name__ == "__main__":
+    seed_jobs()
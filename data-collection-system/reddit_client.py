@@ -2,8 +2,13 @@ import requests
 import logging
 import os
 import json
+import time
+import fcntl
+import threading
 from dotenv import load_dotenv
 
+import http_cache
+
 load_dotenv()
 
 API_BASE_URL = "https://oauth.reddit.com/r"
@@ -11,6 +16,18 @@ REDDIT_OAUTH_CLIENT_ID = os.getenv('REDDIT_OAUTH_CLIENT_ID')
 REDDIT_OAUTH_CLIENT_SECRET = os.getenv('REDDIT_OAUTH_CLIENT_SECRET')
 CLIENT_AUTH = requests.auth.HTTPBasicAuth(REDDIT_OAUTH_CLIENT_ID, REDDIT_OAUTH_CLIENT_SECRET)
 POST_DATA = {"grant_type": "client_credentials"}
+# token cache, rate limit state and their lock files, shared by the worker processes
+CRAWLER_STATE_DIR = os.getenv("CRAWLER_STATE_DIR", "crawler_state")
+TOKEN_FILE = os.path.join(CRAWLER_STATE_DIR, "oauth_access_token.json")
+# refresh this many seconds before the token actually expires
+TOKEN_REFRESH_MARGIN = int(os.getenv("REDDIT_TOKEN_REFRESH_MARGIN", "300"))
+RATELIMIT_FILE = os.path.join(CRAWLER_STATE_DIR, "reddit_ratelimit.json")
+# share of the budget that pagination calls leave untouched for scans
+RATELIMIT_PAGE_RESERVE = float(os.getenv("REDDIT_RATELIMIT_PAGE_RESERVE", "0.2"))
+
+# request priorities: scans find new content, pages only follow it back
+PRIORITY_SCAN = "scan"
+PRIORITY_PAGE = "page"
 
 logger = logging.getLogger("Reddit client")
 logger.propagate = False
@@ -23,66 +40,276 @@ if not logger.handlers:
     sh.setFormatter(formatter)
     logger.addHandler(sh)
 
+class TokenManager:
+    """
+    Keeps the OAuth token in memory and refreshes it shortly before it expires.
+    The token file is only a cold-start cache shared between worker processes;
+    a file lock makes sure only one of them fetches a new token at a time.
+    """
+
+    def __init__(self, path=TOKEN_FILE, refresh_margin=TOKEN_REFRESH_MARGIN):
+        self.path = path
+        self.refresh_margin = refresh_margin
+        self._token = None
+        self._lock = threading.Lock()
+
+    def _fresh(self, token):
+        return token is not None and token.get("expires_at", 0) - self.refresh_margin > time.time()
+
+    def _load_file(self):
+        if os.path.exists(self.path) and os.path.getsize(self.path) != 0:
+            with open(self.path, "r") as file:
+                token = json.load(file)
+            if "expires_at" not in token:
+                # files written before expires_at was tracked
+                token["expires_at"] = os.path.getmtime(self.path) + token.get("expires_in", 0)
+            return token
+        return None
+
+    def _fetch(self):
+        r = requests.post(
+            "https://www.reddit.com/api/v1/access_token",
+            auth = CLIENT_AUTH,
+            data = POST_DATA,
+            headers = {"User-Agent": "my_name_deez____deez_what_sir/1.0 by Big-Feeling-1320"}
+        )
+        r.raise_for_status()
+        token = r.json()
+        token["expires_at"] = time.time() + token["expires_in"]
+        logger.info(f"Fetched new OAuth access token, expires in {token['expires_in']}s")
+        return token
+
+    def get(self):
+        token = self._token
+        if self._fresh(token):
+            return token["access_token"]
+
+        with self._lock:
+            if self._fresh(self._token):
+                return self._token["access_token"]
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path + ".lock", "w") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    # another process may have refreshed while we waited
+                    token = self._load_file()
+                    if not self._fresh(token):
+                        token = self._fetch()
+                        tmp_path = self.path + ".tmp"
+                        with open(tmp_path, "w") as file:
+                            json.dump(token, file)
+                        os.replace(tmp_path, self.path)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+            self._token = token
+            return token["access_token"]
+
+    def invalidate(self, access_token):
+        """drop a token the API rejected, unless someone already replaced it"""
+        with self._lock:
+            if self._token is not None and self._token["access_token"] == access_token:
+                self._token["expires_at"] = 0
+            file_token = self._load_file()
+            if file_token is not None and file_token["access_token"] == access_token:
+                os.remove(self.path)
+
+
+token_manager = TokenManager()
+
+
+class RateLimiter:
+    """
+    Paces requests against the budget reddit reports in X-Ratelimit-* headers.
+
+    The budget belongs to the OAuth client, so it is shared by every worker
+    process. The last reported budget and the next free request slot live in
+    a small file guarded by flock; each request reserves a slot so the
+    remaining requests are spread evenly over what is left of the reset
+    window. Pagination calls keep RATELIMIT_PAGE_RESERVE of the budget free
+    for scans.
+    """
+
+    def __init__(self, path=RATELIMIT_FILE, page_reserve=RATELIMIT_PAGE_RESERVE):
+        self.path = path
+        self.page_reserve = page_reserve
+
+    def _locked(self, update):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path + ".lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                state = self._read()
+                result = update(state)
+                tmp_path = self.path + ".tmp"
+                with open(tmp_path, "w") as file:
+                    json.dump(state, file)
+                os.replace(tmp_path, self.path)
+                return result
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read(self):
+        if os.path.exists(self.path) and os.path.getsize(self.path) != 0:
+            with open(self.path, "r") as file:
+                return json.load(file)
+        return {}
+
+    def reserve(self, priority=PRIORITY_SCAN):
+        """reserve the next request slot and return how long to sleep for it"""
+
+        def take_slot(state):
+            now = time.time()
+            reset_at = state.get("reset_at", 0)
+            if reset_at <= now:
+                # window rolled over (or we know nothing yet): no pacing until the next response
+                state["last_slot"] = now
+                return 0.0
+
+            remaining = state.get("remaining", 0)
+            if priority == PRIORITY_PAGE:
+                window_budget = remaining + state.get("used", 0)
+                remaining -= self.page_reserve * window_budget
+
+            if remaining < 1:
+                # out of budget for this priority: wait for the window to reset
+                # without pushing back the slots of other requests
+                return reset_at - now
+
+            interval = (reset_at - now) / remaining
+            slot = max(now, state.get("last_slot", now) + interval)
+            state["last_slot"] = slot
+            state["remaining"] = max(0, state.get("remaining", 0) - 1)
+            return slot - now
+
+        return self._locked(take_slot)
+
+    def wait(self, priority=PRIORITY_SCAN):
+        delay = self.reserve(priority)
+        if delay > 0:
+            logger.debug(f"rate limiter: waiting {delay:.2f}s ({priority})")
+            time.sleep(delay)
+
+    def update(self, headers):
+        try:
+            used = float(headers["X-Ratelimit-Used"])
+            remaining = float(headers["X-Ratelimit-Remaining"])
+            reset = float(headers["X-Ratelimit-Reset"])
+        except (KeyError, ValueError):
+            return
+
+        def store(state):
+            state["used"] = used
+            state["remaining"] = remaining
+            state["reset_at"] = time.time() + reset
+
+        self._locked(store)
+
+    def stats(self):
+        """current budget as last reported by reddit"""
+        state = self._read()
+        reset_in = max(0.0, state.get("reset_at", 0) - time.time())
+        return {
+            "used": state.get("used"),
+            "remaining": state.get("remaining"),
+            "reset_in_s": reset_in,
+        }
+
+
+rate_limiter = RateLimiter()
+
+# live, record, replay or TTL cache depending on HTTP_CACHE_MODE
+_http = http_cache.HttpLayer(requests)
+
+_stats_lock = threading.Lock()
+_stats = {"requests": 0, "auth_retries": 0, "pages_decoded": 0, "bytes": 0}
+
+
+def _incr(key, amount=1):
+    with _stats_lock:
+        _stats[key] += amount
+
+
+def request_stats():
+    """per-process API counters; listing requests minus auth retries should equal pages decoded"""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def rate_limit_stats():
+    return rate_limiter.stats()
+
+
+def cache_stats():
+    return _http.stats()
+
+
 class RedditClient:
-    def get_newest_posts(self, subreddit, params):
+    def get_newest_posts(self, subreddit, params, priority=PRIORITY_SCAN):
         params_call = "&".join(params)
         api_call = self.build_request([f"{subreddit}", "new", f".json?{params_call}"])
-        return self.execute_request(api_call)
+        return self.execute_request(api_call, priority)
 
-    def get_newest_comments(self, subreddit, params):
+    def get_newest_comments(self, subreddit, params, priority=PRIORITY_SCAN):
         params_call = "&".join(params)
         api_call = self.build_request([f"{subreddit}", "comments", f".json?{params_call}"])
-        return self.execute_request(api_call)
+        return self.execute_request(api_call, priority)
+
+    def get_comment_tree(self, subreddit, article, params, priority=PRIORITY_PAGE):
+        """the post and its comment tree; article is the post id without the t3_ prefix"""
+        params_call = "&".join(params)
+        api_call = self.build_request([f"{subreddit}", "comments", f"{article}.json?{params_call}"])
+        return self.execute_request(api_call, priority)
+
+    def get_more_children(self, link_id, children, priority=PRIORITY_PAGE):
+        """expand up to 100 comment ids from a "more" stub of link_id's tree"""
+        params_call = "&".join(["api_type=json", f"link_id={link_id}", f"children={','.join(children)}", "limit_children=false"])
+        # /api lives next to /r, not under it
+        api_call = "/".join([API_BASE_URL.rsplit("/r", 1)[0], "api", f"morechildren?{params_call}"])
+        return self.execute_request(api_call, priority)
 
     def build_request(self, call_pieces=[]):
         api_call = "/".join([API_BASE_URL] + call_pieces)
         return api_call
 
-    def load_access_token(self):
-        if os.path.exists("oauth_access_token.json") and os.path.getsize("oauth_access_token.json") != 0:
-            with open("oauth_access_token.json","r") as file:
-                return json.load(file)
-        return None
-
-    def refresh_access_token(self):      
-        try:
-            r = requests.post(
-                "https://www.reddit.com/api/v1/access_token",
-                auth = CLIENT_AUTH,
-                data = POST_DATA,
-                headers = {"User-Agent": "my_name_deez____deez_what_sir/1.0 by Big-Feeling-1320"}
-            )
-            r.raise_for_status()
-            logger.info("Fetched new OAuth access token")
-        except Exception as e:
-            logger.error(f"Error fetching new OAuth access token: {e}")
-
-        token = r.json()
-        with open("oauth_access_token.json","w") as file:
-            json.dump(token,file)
-        return token
-
-    def execute_request(self, api_call):
-        logger.info(f"api call: {api_call}")
-
-        #get access token if its none
-        token = self.load_access_token()
-        if token is None:
-            token = self.refresh_access_token()
-        access_token = token["access_token"]
-        r = requests.get(
+    def get_with_token(self, api_call, access_token, priority=PRIORITY_SCAN):
+        _incr("requests")
+        r = _http.get(
             api_call,
             headers = {
                 "User-Agent": "my_name_deez____deez_what_sir/69 by Big-Feeling-1320",
                 "Authorization": f"bearer {access_token}"
-            }
+            },
+            # only real requests spend rate limit budget
+            on_fetch = lambda: rate_limiter.wait(priority),
         )
+        if not r.from_cache:
+            rate_limiter.update(r.headers)
+        return r
+
+    def execute_request(self, api_call, priority=PRIORITY_SCAN):
+        logger.info(f"api call: {api_call}")
+
+        # replaying a capture needs no credentials
+        access_token = token_manager.get() if _http.mode != "replay" else "replay"
+        r = self.get_with_token(api_call, access_token, priority)
         if r.status_code == 401:
-            self.refresh_access_token() #write new access token
-            r.raise_for_status()
+            _incr("auth_retries")
+            if _http.mode == "replay":
+                # the live run refreshed and retried here; replay its retry
+                # without going near the token endpoint
+                r = self.get_with_token(api_call, access_token, priority)
+            else:
+                # token was revoked or expired early; refresh and retry once
+                logger.info("Got 401, refreshing OAuth access token and retrying")
+                token_manager.invalidate(access_token)
+                r = self.get_with_token(api_call, token_manager.get(), priority)
+        r.raise_for_status()
+        _incr("bytes", len(r.content))
+        logger.debug(f"rate limit: {rate_limit_stats()}")
 
         #else status 200
         data = r.json()
+        _incr("pages_decoded")
         return data
 
 if __name__ == "__main__":
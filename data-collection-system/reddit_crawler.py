@@ -1,8 +1,15 @@
 import datetime
-from reddit_client import RedditClient
+from reddit_client import RedditClient, PRIORITY_PAGE, PRIORITY_SCAN, request_stats
+import bulk_load
+import crawl_state
+import db_pool
+import faktory_producer
+import poll_scheduler
+import seen_filter
+import spool
 import os
 import time
-from pyfaktory import Client, Consumer, Job, Producer
+from pyfaktory import Client, Consumer, Job
 import logging
 
 # these three lines allow psycopg to insert a dict into
@@ -30,6 +37,17 @@ if not logger.handlers:
 # get db url
 DATABASE_URL = os.environ.get("DATABASE_URL")
 FAKTORY_URL = os.environ.get("FAKTORY_URL")
+# how far back a scan pages looking for the watermark (reddit listings stop around 1000 items)
+REDDIT_MAX_PAGES = int(os.environ.get("REDDIT_MAX_PAGES", "10"))
+# a subreddit bringing more than this share of a multi-page multireddit scan gets its own scans
+REDDIT_GROUP_SPLIT_SHARE = float(os.environ.get("REDDIT_GROUP_SPLIT_SHARE", "0.5"))
+# comment tree backfill: posts per batch, how old a post must be before its
+# thread counts as settled, and the request budget for one thread
+REDDIT_TREE_BATCH = int(os.environ.get("REDDIT_TREE_BATCH", "50"))
+REDDIT_TREE_MIN_AGE_S = int(os.environ.get("REDDIT_TREE_MIN_AGE_S", str(6 * 3600)))
+REDDIT_TREE_MAX_REQUESTS = int(os.environ.get("REDDIT_TREE_MAX_REQUESTS", "20"))
+# /api/morechildren takes at most 100 ids per call
+MORECHILDREN_BATCH = 100
 client = RedditClient()
 
 def json_to_names(posts):
@@ -46,196 +64,501 @@ def json_to_names(posts):
         logger.error(f"Error in json_to_names(): {e}")
         raise
     
+REDDIT_COMMENT_COLUMNS = ("subreddit_id", "name", "text", "author_fullname", "link_id", "parent_id", "created_utc", "data")
+REDDIT_POST_COLUMNS = ("subreddit_id", "name", "title", "text", "flair", "author_fullname", "url", "media", "created_utc", "data")
+
+def comment_to_row(x):
+    return (
+        x['subreddit_id'],
+        x['name'],
+        x['body'],
+        x['author_fullname'],
+        x['link_id'],
+        x['parent_id'],
+        datetime.datetime.fromtimestamp(x['created_utc']),
+        x,
+    )
+
+def post_to_row(x):
+    return (
+        x['subreddit_id'],
+        x['name'],
+        x['title'],                 #post title
+        x['selftext'],              #post text
+        x['link_flair_text'],       #post flair
+        x['author_fullname'],       #author name
+        x['url'],                   #url embedded into post
+        x['media'],                 #embedded video metadata (if any) (json)
+        datetime.datetime.fromtimestamp(x['created_utc']),
+        x,
+    )
+
+def save_listing_rows(table, columns, to_row, items, conn):
+    """
+    COPY the given listing items into `table` inside the caller's transaction,
+    which must be a seen_filter.transaction(). Items the seen filter knows we
+    already stored are not sent at all. Returns (inserted, duplicates).
+    """
+    seen = seen_filter.get_filter(table, conn)
+    fresh, maybe = seen.check([x['name'] for x in items])
+    fresh_names = set(fresh)
+    rows = [to_row(x) for x in items if x['name'] in fresh_names]
+    skipped = len(items) - len(rows)
+    if not rows:
+        return 0, skipped
+    with conn.cursor() as cur:
+        inserted = bulk_load.copy_upsert(cur, table, columns, rows, ("name", "created_utc"), "name")
+    seen_filter.stage(conn, table, fresh, inserted, maybe)
+    return len(inserted), len(rows) - len(inserted) + skipped
+
+def save_listing(table, columns, to_row, listing, names_to_process):
+    """write the children of one listing page whose name is in names_to_process, in one transaction"""
+    items = [child['data'] for child in listing['data']['children'] if child['data']['name'] in names_to_process]
+    if spool.spool_first():
+        return 0, len(items) - spool_listing_rows(table, columns, to_row, items)
+    try:
+        with db_pool.connection() as conn:
+            with seen_filter.transaction(conn):
+                return save_listing_rows(table, columns, to_row, items, conn)
+    except spool.DB_ERRORS as e:
+        if not spool.can_fallback():
+            raise
+        logger.warning(f"save_listing(): database unavailable ({e}), spooling {len(items)} items for '{table}'")
+        return 0, len(items) - spool_listing_rows(table, columns, to_row, items)
+
 def save_comment_metadata(comments, names_to_process):
     logger.info("Entering: save_comment_metadata()")
-    conn = psycopg2.connect(dsn=DATABASE_URL)
-    cur = conn.cursor()
-    for child in comments['data']['children']:
-        x = child['data']
-        name = x['name']
-        if name in names_to_process:
-            try:
-                subreddit_id = x['subreddit_id']
-                text = x['body']
-                author_fullname = x['author_fullname']
-                link_id = x['link_id']
-                parent_id = x['parent_id']
-                created_utc = x['created_utc']
-                created_utc = datetime.datetime.fromtimestamp(created_utc)
-                data = x
-                #...
-                q = "INSERT INTO reddit_comments (subreddit_id, name, text, author_fullname, link_id, parent_id, created_utc, data) VALUES (%s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT (name,created_utc) DO NOTHING;" 
-
-                cur.execute(q, (subreddit_id, name, text, author_fullname, link_id, parent_id, created_utc, data))
-                conn.commit()
-                logger.info(f"save_comment_metadata(): Saved comment {name} to 'reddit_comments' schema")
-            except Exception as e:
-                logger.error(f"Error in save_comment_metadata(): {e}")
-                raise
-    cur.close()
-    conn.close()
+    try:
+        inserted, duplicates = save_listing("reddit_comments", REDDIT_COMMENT_COLUMNS, comment_to_row, comments, names_to_process)
+    except Exception as e:
+        logger.error(f"Error in save_comment_metadata(): {e}")
+        raise
+    logger.info(f"save_comment_metadata(): Saved {inserted} comments to 'reddit_comments' schema, {duplicates} duplicates")
+    logger.debug(f"save_comment_metadata(): db pool: {db_pool.pool_stats()}")
     logger.info("Leaving: save_comment_metadata()")
+    return inserted, duplicates
 
 def save_post_metadata(posts, names_to_process):
     logger.info("Entering: save_post_metadata()")
-    conn = psycopg2.connect(dsn=DATABASE_URL)
-    cur = conn.cursor()
-
-    for child in posts['data']['children']:
-        x = child['data']
-        name = x['name']
-        if name in names_to_process:
-            try:
-                subreddit_id = x['subreddit_id']
-                title = x['title']                        #post title
-                text = x['selftext']                      #post text
-                flair = x['link_flair_text']              #post flair
-                author_fullname = x['author_fullname']    #author name
-                url = x['url']                            #url embedded into post
-                media = x['media']                        #embedded video metadata (if any) (json)
-                created_utc = x['created_utc']
-                created_utc = datetime.datetime.fromtimestamp(created_utc)
-                data = x
-                #...
-                q = "INSERT INTO reddit_posts (subreddit_id, name, title, text, author_fullname, url, media, created_utc, data) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s) ON CONFLICT (name,created_utc) DO NOTHING;"
-
-                cur.execute(q, (subreddit_id, name, title, text, author_fullname, url, media, created_utc, data))
-                conn.commit()
-                logger.info(f"save_post_metadata(): Saved post {name} to 'reddit_posts' schema")
-            except Exception as e:
-                logger.error(f"Error in save_post_metadata(): {e}")
-                raise
-    cur.close()
-    conn.close()
-    logger.info("Leaving: save_post_metadata()")
-
-def enqueue_scan_comments(subreddit, old_names=[]):
-    logger.info(f"Entering: enqueue_scan_comments(): Subreddit: {subreddit}, Old names: {old_names}")
-    old_names = set(old_names)
     try:
-        new_posts = client.get_newest_comments(subreddit, ["limit=100"])
-        logger.info(f"enqueue_scan_comments(): Fetched new comments for '{subreddit}' subreddit")
+        inserted, duplicates = save_listing("reddit_posts", REDDIT_POST_COLUMNS, post_to_row, posts, names_to_process)
     except Exception as e:
-        logger.error(f"Error in enqueue_scan_comments(): {e}")
+        logger.error(f"Error in save_post_metadata(): {e}")
         raise
+    logger.info(f"save_post_metadata(): Saved {inserted} posts to 'reddit_posts' schema, {duplicates} duplicates")
+    logger.debug(f"save_post_metadata(): db pool: {db_pool.pool_stats()}")
+    logger.info("Leaving: save_post_metadata()")
+    return inserted, duplicates
 
-    new_names = json_to_names(new_posts)
-    enqueue_process_comments(subreddit, old_names, after="")
+# how to fetch and store each kind of listing
+LISTINGS = {
+    "posts": {"fetch": "get_newest_posts", "table": "reddit_posts", "columns": REDDIT_POST_COLUMNS, "to_row": post_to_row},
+    "comments": {"fetch": "get_newest_comments", "table": "reddit_comments", "columns": REDDIT_COMMENT_COLUMNS, "to_row": comment_to_row},
+}
 
-    try:
-        with Client(faktory_url=FAKTORY_URL, role="producer") as c:
-            run_at = datetime.datetime.utcnow() + datetime.timedelta(minutes=15)
-            run_at = run_at.isoformat()[:-7] + "Z"
-            producer = Producer(client=c)
-            job = Job(
-                jobtype="scan_comments",
-                args=(subreddit, list(new_names)),
-                queue="scan_comments",
-                at=str(run_at)
-            )
-            producer.push(job)
-            logger.info(f"enqueue_scan_comments(): Enqueued scan_comments job for subreddit: {subreddit}, at: {run_at}")
-            logger.info(f"Leaving: enqueue_scan_comments()")
-    except Exception as e:
-        logger.error(f"Error in enqueue_scan_comments(): {e}")
-        raise
+def is_past_watermark(x, watermark):
+    """
+    watermark is {"created_utc": t, "names": [...]}: the newest created_utc we
+    have stored and the names stored at exactly that second.
+    """
+    if watermark is None:
+        return True
+    if x['created_utc'] != watermark['created_utc']:
+        return x['created_utc'] > watermark['created_utc']
+    return x['name'] not in watermark['names']
+
+def advance_watermark(watermark, items):
+    newest = max([x['created_utc'] for x in items], default=None)
+    if newest is None:
+        return watermark
+    names = [x['name'] for x in items if x['created_utc'] == newest]
+    if watermark is not None and watermark['created_utc'] == newest:
+        names = sorted(set(names) | set(watermark['names']))
+    return {"created_utc": newest, "names": names}
+
+def spool_listing_rows(table, columns, to_row, items, commit=True):
+    """append the items the seen filter doesn't know to the local spool; returns how many"""
+    seen = seen_filter.get_filter(table)
+    fresh, _ = seen.check([x['name'] for x in items])
+    fresh_names = set(fresh)
+    rows = [to_row(x) for x in items if x['name'] in fresh_names]
+    if rows:
+        spool.append_rows(table, columns, rows)
+    if commit:
+        spool.commit()
+    return len(rows)
+
+def spool_listing(listing, items, kind, fetch_stats, new_watermarks):
+    spooled = spool_listing_rows(listing["table"], listing["columns"], listing["to_row"], items, commit=False)
+    # the watermarks go in the same segment, behind the rows, and become
+    # durable with them in one commit
+    for sub, watermark in new_watermarks.items():
+        spool.append_state(crawl_state.reddit_source(sub, kind), {}, watermark, fetch_stats)
+    spool.commit()
+    logger.info(f"crawl_listing(): Spooled {spooled} {kind} for '{listing['table']}', {len(items) - spooled} already seen")
+    logger.debug(f"crawl_listing(): spool stats: {spool.spool_stats()}")
+
+def split_subreddits(subreddit):
+    """"a+b+c" -> ["a", "b", "c"]; a plain subreddit is a group of one"""
+    return [sub for sub in subreddit.split("+") if sub]
+
+def crawl_listing(subreddit, kind):
+    """
+    Walk a listing newest-first with the `after` cursor until it reaches the
+    stored watermark, then insert everything newer and move the watermark in
+    the same transaction.
+
+    `subreddit` can be a multireddit like "a+b+c": reddit then returns one
+    merged listing, which is split back up by each item's subreddit, and the
+    walk goes on until every subreddit in it has reached its own watermark.
+
+    Returns {subreddit: {"new": n, "overflowed": bool}}, where overflowed
+    means we hit REDDIT_MAX_PAGES before finding that subreddit's watermark.
+    """
+    logger.info(f"Entering: crawl_listing(): Subreddit: {subreddit}, kind: {kind}")
+    listing = LISTINGS[kind]
+    fetch = getattr(client, listing["fetch"])
+    subs = {sub.lower(): sub for sub in split_subreddits(subreddit)}
+    # spooled watermarks count too, the loader may not have got to them yet
+    watermarks = {key: spool.load_state(crawl_state.reddit_source(sub, kind))[1] for key, sub in subs.items()}
 
-def enqueue_scan_posts(subreddit, old_names=[]):
-    logger.info(f"Entering: enqueue_scan_posts(): Subreddit: {subreddit}, Old names: {old_names}")
-    old_names = set(old_names)
+    # subreddits with no watermark yet (cold start) only take what the pages
+    # we walk anyway have; if the whole group is cold that's the newest page
+    warm = {key for key, watermark in watermarks.items() if watermark is not None}
+    max_pages = REDDIT_MAX_PAGES if warm else 1
+    new_items = {key: [] for key in subs}
+    reached = set()
+    after = None
+    pages = 0
+    # each page is fetched and decoded exactly once per scan; these prove it
+    fetched_cursors = set()
+    stats_before = request_stats()
+    while pages < max_pages:
+        if after in fetched_cursors:
+            logger.warning(f"crawl_listing(): listing cursor {after} came back twice, stopping")
+            break
+        fetched_cursors.add(after)
+        params = ["limit=100"] + ([f"after={after}"] if after else [])
+        # the first page is the scan, later pages can wait for budget
+        priority = PRIORITY_PAGE if after else PRIORITY_SCAN
+        try:
+            page = fetch(subreddit, params, priority)
+        except Exception as e:
+            logger.error(f"Error in crawl_listing(): Error fetching, {e}")
+            raise
+        pages += 1
+        for child in page['data']['children']:
+            x = child['data']
+            key = x.get('subreddit', subreddit).lower()
+            if key not in subs:
+                logger.debug(f"crawl_listing(): skipping {x['name']} from unexpected subreddit {key}")
+                continue
+            if is_past_watermark(x, watermarks[key]):
+                new_items[key].append(x)
+            else:
+                reached.add(key)
+        after = page['data'].get('after')
+        if warm <= reached or not after:
+            break
+    stats_after = request_stats()
+    fetch_stats = {
+        "pages": pages,
+        "api_requests": stats_after["requests"] - stats_before["requests"] - (stats_after["auth_retries"] - stats_before["auth_retries"]),
+        "pages_decoded": stats_after["pages_decoded"] - stats_before["pages_decoded"],
+        "group": subreddit,
+    }
+    result = {}
+    for key, sub in subs.items():
+        overflowed = key in warm and key not in reached and bool(after)
+        result[sub] = {"new": len(new_items[key]), "overflowed": overflowed}
+        if overflowed:
+            logger.warning(f"crawl_listing(): '{sub}' {kind} went past {REDDIT_MAX_PAGES} pages without reaching the watermark")
+    logger.info(f"crawl_listing(): {sum(len(v) for v in new_items.values())} new {kind} in {pages} page(s) for '{subreddit}', {fetch_stats}")
+
+    all_items = [x for items in new_items.values() for x in items]
+    new_watermarks = {sub: advance_watermark(watermarks[key], new_items[key]) for key, sub in subs.items()}
+    if spool.spool_first():
+        spool_listing(listing, all_items, kind, fetch_stats, new_watermarks)
+        logger.info("Leaving: crawl_listing()")
+        return result
     try:
-        new_posts = client.get_newest_posts(subreddit, ["limit=100"])
-        logger.info(f"enqueue_scan_posts(): Fetched new posts for '{subreddit}' subreddit")
+        with db_pool.connection() as conn:
+            with seen_filter.transaction(conn):
+                inserted, duplicates = save_listing_rows(listing["table"], listing["columns"], listing["to_row"], all_items, conn)
+                for sub, watermark in new_watermarks.items():
+                    # a listing's boundary lives in the watermark, it has no seen set
+                    crawl_state.save_state(crawl_state.reddit_source(sub, kind), {}, watermark, conn=conn, stats=fetch_stats)
+    except spool.DB_ERRORS as e:
+        if not spool.can_fallback():
+            logger.error(f"Error in crawl_listing(): {e}")
+            raise
+        # keep the pages we paid for instead of refetching them on the faktory retry
+        logger.warning(f"crawl_listing(): database unavailable ({e}), spooling {len(all_items)} {kind}")
+        spool_listing(listing, all_items, kind, fetch_stats, new_watermarks)
+        logger.info("Leaving: crawl_listing()")
+        return result
     except Exception as e:
-        logger.error(f"Error in enqueue_scan_posts(): {e}")
+        logger.error(f"Error in crawl_listing(): {e}")
         raise
+    logger.info(f"crawl_listing(): Saved {inserted} {kind} to '{listing['table']}', {duplicates} duplicates")
+    logger.debug(f"crawl_listing(): seen filter: {seen_filter.filter_stats()}")
+    logger.info("Leaving: crawl_listing()")
+    return result
 
-    new_names = json_to_names(new_posts)
-    enqueue_process_posts(subreddit, old_names, after="")
+def split_group(result, listing_size=100):
+    """
+    Pick the subreddits of a multireddit scan that crowd the others out of the
+    shared page: ones that overflowed, or that made up more than
+    REDDIT_GROUP_SPLIT_SHARE of a walk that needed more than one page.
+    Returns (busy, rest).
+    """
+    if len(result) < 2:
+        return [], list(result)
+    total = sum(r["new"] for r in result.values())
+    busy = [
+        sub for sub, r in result.items()
+        if r["overflowed"] or (total > listing_size and r["new"] > REDDIT_GROUP_SPLIT_SHARE * total)
+    ]
+    if len(busy) == len(result):
+        # everyone is busy: scan them all separately
+        return busy, []
+    return busy, [sub for sub in result if sub not in busy]
 
+def scan_job(subreddit, kind, new_items, overflowed):
+    run_at = poll_scheduler.next_run_at(f"reddit_{kind}", subreddit, new_items, overflowed)
+    logger.info(f"enqueue_scan_{kind}(): Enqueuing scan_{kind} job for subreddit: {subreddit}, at: {run_at}")
+    return Job(
+        jobtype=f"scan_{kind}",
+        args=(subreddit,),
+        queue=f"scan_{kind}",
+        at=str(run_at)
+    )
+
+def enqueue_scan(subreddit, kind):
+    result = crawl_listing(subreddit, kind)
     try:
-        with Client(faktory_url=FAKTORY_URL, role="producer") as c:
-            run_at = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
-            run_at = run_at.isoformat()[:-7] + "Z"
-            producer = Producer(client=c)
-            job = Job(
-                jobtype="scan_posts",
-                args=(subreddit, list(new_names)),
-                queue="scan_posts",
-                at=str(run_at)
-            )
-            producer.push(job)
-            logger.info(f"enqueue_scan_posts(): Enqueued scan_posts job for subreddit: {subreddit}, at: {run_at}")
-            logger.info(f"Leaving: enqueue_scan_posts()")
+        busy, rest = split_group(result)
+        jobs = []
+        for sub in busy:
+            logger.info(f"enqueue_scan_{kind}(): splitting '{sub}' out of '{subreddit}'")
+            jobs.append(scan_job(sub, kind, result[sub]["new"], result[sub]["overflowed"]))
+        if rest:
+            group = "+".join(rest)
+            jobs.append(scan_job(group, kind, sum(result[sub]["new"] for sub in rest), any(result[sub]["overflowed"] for sub in rest)))
+        faktory_producer.push_bulk(jobs)
+        logger.debug(f"enqueue_scan_{kind}(): producer stats: {faktory_producer.producer_stats()}")
     except Exception as e:
-        logger.error(f"Error in enqueue_scan_posts(): {e}")      
+        logger.error(f"Error in enqueue_scan_{kind}(): {e}")
         raise
 
-def enqueue_process_comments(subreddit, old_names, after):
-    logger.info(f"Entering: enqueue_process_comments(): Subreddit: {subreddit}, after: {after}")
-    old_names = set(old_names)
+# old_names/after are only accepted so jobs queued by earlier versions still run;
+# the watermark in crawl_state replaces both
+def enqueue_scan_comments(subreddit, old_names=None):
+    logger.info(f"Entering: enqueue_scan_comments(): Subreddit: {subreddit}")
+    enqueue_scan(subreddit, "comments")
+    logger.info(f"Leaving: enqueue_scan_comments()")
+
+def enqueue_scan_posts(subreddit, old_names=None):
+    logger.info(f"Entering: enqueue_scan_posts(): Subreddit: {subreddit}")
+    enqueue_scan(subreddit, "posts")
+    logger.info(f"Leaving: enqueue_scan_posts()")
+
+# pagination happens inside the scan now, a leftover process_* job is just one more walk
+def enqueue_process_comments(subreddit, old_names=None, after=""):
+    logger.info(f"Entering: enqueue_process_comments(): Subreddit: {subreddit}")
+    crawl_listing(subreddit, "comments")
+    logger.info(f"Leaving: enqueue_process_comments()")
+
+def enqueue_process_posts(subreddit, old_names=None, after=""):
+    logger.info(f"Entering: enqueue_process_posts(): Subreddit: {subreddit}")
+    crawl_listing(subreddit, "posts")
+    logger.info(f"Leaving: enqueue_process_posts()")
+
+
+
+def walk_comment_things(things, comments, more):
+    """
+    Flatten a list of reddit "things" from a comment tree or a morechildren
+    response: t1 comments (and their nested replies) go into `comments`,
+    "more" stubs into `more` as (parent_id, [child ids]).
+    """
+    for thing in things:
+        data = thing['data']
+        if thing['kind'] == "t1":
+            comments[data['name']] = data
+            replies = data.get('replies')
+            if replies:
+                walk_comment_things(replies['data']['children'], comments, more)
+        elif thing['kind'] == "more":
+            more.append((data['parent_id'], data.get('children', [])))
+
+def get_stored_comment_names(conn, link_id, post_created):
+    """names of the comments of one post already in reddit_comments"""
+    with conn.cursor() as cur:
+        # comments can't be older than their post, which keeps the scan to
+        # the chunks after it
+        cur.execute(
+            "SELECT name FROM reddit_comments WHERE link_id = %s AND created_utc >= %s;",
+            (link_id, post_created),
+        )
+        stored = {row[0] for row in cur.fetchall()}
+    conn.rollback()
+    return stored
+
+def fetch_comment_tree(subreddit, link_id, stored):
+    """
+    Fetch the full comment tree of a post: the tree page, then every "more"
+    stub through /api/morechildren in batches of 100 ids, and "continue this
+    thread" stubs by re-fetching the tree rooted at their parent. Ids already
+    in `stored` are never requested. Stops after REDDIT_TREE_MAX_REQUESTS.
+    Returns (comments by name, requests made, ids left unfetched).
+    """
+    article = link_id.split("_", 1)[1]
+    comments = {}
+    more = []
+    tree = client.get_comment_tree(subreddit, article, ["limit=500", "sort=old"])
+    requests_made = 1
+    walk_comment_things(tree[1]['data']['children'], comments, more)
+
+    pending = []
+    continue_parents = []
+    while more or pending or continue_parents:
+        for parent_id, children in more:
+            if children:
+                pending.extend(c for c in children if f"t1_{c}" not in stored and f"t1_{c}" not in comments)
+            elif parent_id.startswith("t1_"):
+                # empty stub with no ids: thread is too deep, reddit wants a new tree page
+                continue_parents.append(parent_id)
+        more = []
+        if requests_made >= REDDIT_TREE_MAX_REQUESTS:
+            break
+        # stubs whose ids are all stored leave nothing to request, and cost nothing
+        if pending:
+            batch, pending = pending[:MORECHILDREN_BATCH], pending[MORECHILDREN_BATCH:]
+            response = client.get_more_children(link_id, batch)
+            requests_made += 1
+            walk_comment_things(response['json']['data']['things'], comments, more)
+        elif continue_parents:
+            parent_id = continue_parents.pop()
+            tree = client.get_comment_tree(subreddit, article, ["limit=500", "sort=old", f"comment={parent_id.split('_', 1)[1]}"])
+            requests_made += 1
+            walk_comment_things(tree[1]['data']['children'], comments, more)
+    return comments, requests_made, len(pending) + len(continue_parents)
+
+def backfill_comment_tree(subreddit, link_id):
+    """fill in every comment of one post that the /comments firehose missed"""
+    logger.info(f"Entering: backfill_comment_tree(): Subreddit: {subreddit}, post: {link_id}")
+    with db_pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT created_utc, data->'num_comments' FROM reddit_posts WHERE name = %s LIMIT 1;", (link_id,))
+            row = cur.fetchone()
+        conn.rollback()
+        if row is None:
+            logger.warning(f"backfill_comment_tree(): {link_id} is not in reddit_posts, skipping")
+            return
+        post_created, num_comments = row
+        stored = get_stored_comment_names(conn, link_id, post_created)
 
     try:
-        new_posts = client.get_newest_comments(subreddit, ["limit=100", f"after={after}"])
-        logger.info("enqueue_process_comments(): Fetched next batch of comments")
+        comments, requests_made, unfetched = fetch_comment_tree(subreddit, link_id, stored)
     except Exception as e:
-        logger.error(f"Error in enqueue_process_comments(): Error fetching, {e}")
+        logger.error(f"Error in backfill_comment_tree(): Error fetching {link_id}, {e}")
         raise
 
-    new_names = json_to_names(new_posts)
-    names_to_process = new_names-old_names
-    logger.info(f"enqueue_process_comments(): Found {len(names_to_process)} new comments to process")
-    if names_to_process == new_names and old_names:  #means there are over 100 new posts and old_names is not null
-        after = new_posts['data']['after']
-        try:
-            with Client(faktory_url=FAKTORY_URL, role="producer") as c:
-                producer = Producer(client=c)
-                job = Job(
-                    jobtype="process_comments",
-                    args=(subreddit, list(old_names), after),
-                    queue="process_comments"
-                )
-                producer.push(job)
-                logger.info(f"enqueue_process_comments(): Enqueued process_comments job for subreddit: {subreddit}, after: {after}")
-        except Exception as e:
-            logger.error(f"Error in enqueue_process_comments(): Queue Error, {e}")
-            raise
-    save_comment_metadata(new_posts, names_to_process)
-    logger.info(f"Leaving: enqueue_process_comments()")
-#note for future; fields BEFORE and AFTER used for pagination
-def enqueue_process_posts(subreddit, old_names, after):
-    logger.info(f"Entering: enqueue_process_posts(): Subreddit: {subreddit}, after: {after}")    
-    old_names = set(old_names)
-
+    # deleted/removed comments come back without an author and can't be stored
+    missing = [x for name, x in comments.items() if name not in stored and x.get('author_fullname')]
     try:
-        new_posts = client.get_newest_posts(subreddit, ["limit=100", f"after={after}"])
-        logger.info("enqueue_process_posts(): Fetched next batch of posts")
+        if spool.spool_first():
+            inserted, duplicates = 0, len(missing) - spool_listing_rows("reddit_comments", REDDIT_COMMENT_COLUMNS, comment_to_row, missing)
+        else:
+            with db_pool.connection() as conn:
+                with seen_filter.transaction(conn):
+                    inserted, duplicates = save_listing_rows("reddit_comments", REDDIT_COMMENT_COLUMNS, comment_to_row, missing, conn)
+    except spool.DB_ERRORS as e:
+        if not spool.can_fallback():
+            logger.error(f"Error in backfill_comment_tree(): {e}")
+            raise
+        logger.warning(f"backfill_comment_tree(): database unavailable ({e}), spooling {len(missing)} comments")
+        inserted, duplicates = 0, len(missing) - spool_listing_rows("reddit_comments", REDDIT_COMMENT_COLUMNS, comment_to_row, missing)
     except Exception as e:
-        logger.error(f"Error in enqueue_process_posts(): Error fetching, {e}")
+        logger.error(f"Error in backfill_comment_tree(): {e}")
         raise
+    logger.info(
+        f"backfill_comment_tree(): {link_id}: {len(stored)} stored, {len(comments)} in tree, "
+        f"{inserted} backfilled, {duplicates} duplicates, {unfetched} left unfetched, "
+        f"{requests_made} requests, reddit says {num_comments} comments"
+    )
+    if unfetched:
+        logger.warning(f"backfill_comment_tree(): {link_id} hit the {REDDIT_TREE_MAX_REQUESTS} request budget")
+    logger.info("Leaving: backfill_comment_tree()")
 
-    new_names = json_to_names(new_posts)
-    names_to_process = new_names-old_names
-    logger.info(f"enqueue_process_posts(): Found {len(names_to_process)} new posts to process")
+def enqueue_backfill_comment_trees(subreddit):
+    """
+    Walk reddit_posts for `subreddit` oldest first and push one
+    backfill_comment_tree job per post once it is REDDIT_TREE_MIN_AGE_S old.
+    The cursor ({"created_utc", "name"} of the last post handed out) lives in
+    crawl_state, so this keeps going as new posts age into the window.
+    Posts are selected by subreddit_id (indexed, and the compression segment
+    key); the id is looked up from the newest stored post once and kept in
+    the checkpoint.
+    """
+    logger.info(f"Entering: enqueue_backfill_comment_trees(): Subreddit: {subreddit}")
+    source = crawl_state.reddit_source(subreddit, "trees")
+    checkpoint, cursor = spool.load_state(source)
+    checkpoint = checkpoint or {"queued": 0}
+    settled_before = datetime.datetime.fromtimestamp(time.time() - REDDIT_TREE_MIN_AGE_S)
 
-    if names_to_process == new_names and old_names:  #means there are over 100 new posts and old_names is not null
-        after = new_posts['data']['after']
-        try:
-            with Client(faktory_url=FAKTORY_URL, role="producer") as c:
-                producer = Producer(client=c)
-                job = Job(
-                    jobtype="process_posts",
-                    args=(subreddit, list(old_names), after),
-                    queue="process_posts"
+    posts = []
+    with db_pool.connection() as conn:
+        with conn.cursor() as cur:
+            if checkpoint.get("subreddit_id") is None:
+                cur.execute(
+                    "SELECT subreddit_id FROM reddit_posts WHERE lower(data->>'subreddit') = lower(%s) "
+                    "ORDER BY created_utc DESC LIMIT 1;",
+                    (subreddit,),
                 )
-                producer.push(job)
-                logger.info(f"enqueue_process_posts(): Enqueued process_posts job for subreddit: {subreddit}, after: {after}")
-        except Exception as e:
-            logger.error(f"Error in enqueue_process_comments(): Queue Error, {e}")
-            raise
-    save_post_metadata(new_posts, names_to_process)
-    logger.info(f"Leaving: enqueue_process_posts()")
+                row = cur.fetchone()
+                checkpoint["subreddit_id"] = row[0] if row else None
+            subreddit_id = checkpoint["subreddit_id"]
+            if subreddit_id is None:
+                logger.info(f"enqueue_backfill_comment_trees(): no posts stored for {subreddit} yet")
+            elif cursor is None:
+                cur.execute(
+                    "SELECT name, created_utc FROM reddit_posts WHERE subreddit_id = %s "
+                    "AND created_utc < %s ORDER BY created_utc, name LIMIT %s;",
+                    (subreddit_id, settled_before, REDDIT_TREE_BATCH),
+                )
+                posts = cur.fetchall()
+            else:
+                cur.execute(
+                    "SELECT name, created_utc FROM reddit_posts WHERE subreddit_id = %s "
+                    "AND created_utc < %s AND (created_utc, name) > (%s::timestamp, %s) ORDER BY created_utc, name LIMIT %s;",
+                    (subreddit_id, settled_before, cursor["created_utc"], cursor["name"], REDDIT_TREE_BATCH),
+                )
+                posts = cur.fetchall()
+        conn.rollback()
 
+    jobs = [Job(jobtype="backfill_comment_tree", args=(subreddit, name), queue="backfill_comments") for name, _ in posts]
+    if posts:
+        last_name, last_created = posts[-1]
+        cursor = {"created_utc": last_created.isoformat(), "name": last_name}
+    checkpoint["queued"] += len(posts)
+
+    if len(posts) == REDDIT_TREE_BATCH:
+        # more settled posts waiting, keep going right away
+        run_at = poll_scheduler.format_run_at(datetime.datetime.utcnow())
+    else:
+        run_at = poll_scheduler.format_run_at(datetime.datetime.utcnow() + datetime.timedelta(seconds=REDDIT_TREE_MIN_AGE_S / 4))
+    jobs.append(Job(jobtype="backfill_comment_trees", args=(subreddit,), queue="backfill_comments", at=run_at))
+    try:
+        faktory_producer.push_bulk(jobs)
+    except Exception as e:
+        logger.error(f"Error in enqueue_backfill_comment_trees(): {e}")
+        raise
+    # the jobs are out, so the cursor has to move even if the database just went away
+    spool.save_state(source, checkpoint, cursor)
+    logger.info(f"enqueue_backfill_comment_trees(): queued {len(posts)} posts ({checkpoint['queued']} total), next batch at {run_at}")
+    logger.info("Leaving: enqueue_backfill_comment_trees()")
 
 
 if __name__ == "__main__":
@@ -243,12 +566,14 @@ if __name__ == "__main__":
     with Client(faktory_url=FAKTORY_URL, role="consumer") as c:
         consumer = Consumer(
             client=c,
-            queues=["default", "scan_posts", "process_posts", "scan_comments", "process_comments"],
-            concurrency=3,
+            queues=["default", "scan_posts", "process_posts", "scan_comments", "process_comments", "backfill_comments"],
+            concurrency=db_pool.WORKER_CONCURRENCY,
         )
         consumer.register("scan_posts", enqueue_scan_posts)
         consumer.register("scan_comments", enqueue_scan_comments)
         consumer.register("process_posts", enqueue_process_posts)
         consumer.register("process_comments", enqueue_process_comments)
+        consumer.register("backfill_comment_trees", enqueue_backfill_comment_trees)
+        consumer.register("backfill_comment_tree", backfill_comment_tree)
         consumer.run()
         logger.info("Listening for tasks...")
@@ -0,0 +1,135 @@
+"""
+Ranked full-text search over reddit_posts, reddit_comments and chan_posts.
+
+Matches against the tsvector expressions in SEARCH_DOCUMENTS, which the
+full_text_search migration puts GIN indexes on. Queries use websearch syntax: "lebron james",
+-trade, "free agency" or draft.
+
+    rows, cursor = search("lebron", "reddit_comments", start=..., sources=["t5_2qo4s"])
+    more, cursor = search("lebron", "reddit_comments", start=..., sources=["t5_2qo4s"], after=cursor)
+
+Results are ordered by rank, then newest first, and paged with a keyset
+cursor instead of OFFSET, so deep pages cost the same as the first one.
+Chunks that are already compressed have no GIN index; they are decompressed
+and filtered, so keep `start` inside the uncompressed window when you can.
+
+    python search.py <table> <query> [limit]
+"""
+
+import logging
+import os
+import sys
+
+import psycopg2
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger("search")
+logger.propagate = False
+
+log_level_str = os.getenv("LOG_LEVEL", "INFO").upper()
+numeric_level = getattr(logging, log_level_str, logging.INFO)
+
+logger.setLevel(numeric_level)
+if not logger.handlers:
+    sh = logging.StreamHandler()
+    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    sh.setFormatter(formatter)
+    logger.addHandler(sh)
+
+
+DATABASE_URL = os.environ.get("DATABASE_URL")
+
+# must stay identical to the indexed expressions in the full_text_search migration
+SEARCH_DOCUMENTS = {
+    "reddit_posts": "(setweight(to_tsvector('english', coalesce(title, '')), 'A') || setweight(to_tsvector('english', coalesce(text, '')), 'B'))",
+    "reddit_comments": "to_tsvector('english', coalesce(text, ''))",
+    "chan_posts": "(setweight(to_tsvector('english', coalesce(title, '')), 'A') || setweight(to_tsvector('english', coalesce(text_body, '')), 'B'))",
+}
+
+# source column (subreddit/board) and the unique key that breaks rank/time ties
+SEARCH_TABLES = {
+    "reddit_posts": {"source": "subreddit_id", "key": ("name",), "columns": ("subreddit_id", "name", "title", "text", "flair")},
+    "reddit_comments": {"source": "subreddit_id", "key": ("name",), "columns": ("subreddit_id", "name", "text", "link_id")},
+    "chan_posts": {"source": "board_name", "key": ("board_name", "post_number"), "columns": ("board_name", "thread_number", "post_number", "title", "text_body")},
+}
+
+
+def build_search_query(table, start=None, end=None, sources=None, after=None, headline=False):
+    """SQL and the names of its parameters for one page of search()"""
+    spec = SEARCH_TABLES[table]
+    key = spec["key"]
+    document = SEARCH_DOCUMENTS[table]
+    where = [f"{document} @@ q"]
+    if start is not None:
+        where.append("created_utc >= %(start)s")
+    if end is not None:
+        where.append("created_utc < %(end)s")
+    if sources:
+        where.append(f"{spec['source']} = ANY(%(sources)s)")
+    inner = (
+        f"SELECT {', '.join(spec['columns'])}, created_utc, ts_rank_cd({document}, q) AS rank "
+        f"FROM {table}, websearch_to_tsquery('english', %(query)s) AS q "
+        f"WHERE {' AND '.join(where)}"
+    )
+    outer_where = ""
+    if after is not None:
+        # (rank desc, created_utc desc, key asc) keyset: strictly after the last row
+        key_cols = ", ".join(key)
+        key_params = ", ".join(f"%(after_{k})s" for k in key)
+        outer_where = (
+            "WHERE rank < %(after_rank)s::real "
+            "OR (rank = %(after_rank)s::real AND created_utc < %(after_created_utc)s) "
+            f"OR (rank = %(after_rank)s::real AND created_utc = %(after_created_utc)s AND ({key_cols}) > ({key_params})) "
+        )
+    text_col = "text_body" if table == "chan_posts" else "text"
+    select = "*"
+    if headline:
+        # only computed for the rows on this page
+        select = f"*, ts_headline('english', coalesce({text_col}, ''), websearch_to_tsquery('english', %(query)s)) AS headline"
+    return (
+        f"SELECT {select} FROM ({inner}) AS matches {outer_where}"
+        f"ORDER BY rank DESC, created_utc DESC, {', '.join(key)} LIMIT %(limit)s;"
+    )
+
+
+def search(query, table="reddit_comments", start=None, end=None, sources=None, limit=50, after=None, headline=False, conn=None):
+    """
+    One page of matches for `query` as a list of dicts, and the cursor for the
+    next page (None once there are no more). `sources` are subreddit_ids or
+    board names; start/end bound created_utc (naive UTC).
+    """
+    if conn is None:
+        conn = psycopg2.connect(dsn=DATABASE_URL)
+        try:
+            return search(query, table, start, end, sources, limit, after, headline, conn)
+        finally:
+            conn.close()
+
+    params = {"query": query, "start": start, "end": end, "sources": list(sources) if sources else None, "limit": limit}
+    if after is not None:
+        params.update({f"after_{k}": v for k, v in after.items()})
+    sql = build_search_query(table, start, end, sources, after, headline)
+    with conn.cursor() as cur:
+        cur.execute(sql, params)
+        names = [d[0] for d in cur.description]
+        rows = [dict(zip(names, row)) for row in cur.fetchall()]
+    conn.rollback()
+
+    cursor = None
+    if len(rows) == limit:
+        last = rows[-1]
+        cursor = {"rank": last["rank"], "created_utc": last["created_utc"]}
+        cursor.update({k: last[k] for k in SEARCH_TABLES[table]["key"]})
+    return rows, cursor
+
+
+if __name__ == "__main__":
+    table, query = sys.argv[1], sys.argv[2]
+    limit = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    rows, cursor = search(query, table, limit=limit, headline=True)
+    for row in rows:
+        print(f"{row['rank']:.3f} {row['created_utc']} {row.get('name') or row.get('post_number')}: {row['headline']}")
+    if cursor:
+        print(f"next page after {cursor}")
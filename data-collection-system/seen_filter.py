@@ -0,0 +1,285 @@
+"""
+Per-worker filter of post/comment ids we already stored.
+
+Overlapping polls keep offering the same rows, and ON CONFLICT DO NOTHING
+still costs an index probe per duplicate. Before building an insert batch the
+crawlers run the ids through this filter:
+
+- a bounded LRU of exact ids: a hit is certainly stored, the row is dropped
+- a rotating Bloom filter (two generations of SEEN_BLOOM_CAPACITY ids each)
+  remembering far more ids than the LRU in little memory. A Bloom hit that is
+  not in the LRU is only "probably stored"; by default the row is still
+  offered to Postgres, and if it turns out to be new that is counted as a
+  false positive. SEEN_FILTER_TRUST_BLOOM=1 drops those rows too, trading
+  a SEEN_BLOOM_FP_RATE chance of losing a new row for fewer probes.
+
+Each table's filter is built on first use in a process and warmed, on the
+caller's connection, with the ids stored in the last SEEN_WARM_HOURS. Ids only count as seen once the
+transaction that inserted them commits, so use transaction() instead of
+`with conn:` around inserts that go through the filter.
+"""
+
+import hashlib
+import logging
+import math
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+
+import db_pool
+
+logger = logging.getLogger("seen filter")
+logger.propagate = False
+
+log_level_str = os.getenv("LOG_LEVEL", "INFO").upper()
+numeric_level = getattr(logging, log_level_str, logging.INFO)
+
+logger.setLevel(numeric_level)
+if not logger.handlers:
+    sh = logging.StreamHandler()
+    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    sh.setFormatter(formatter)
+    logger.addHandler(sh)
+
+
+SEEN_FILTER = os.environ.get("SEEN_FILTER", "1") == "1"
+SEEN_LRU_SIZE = int(os.environ.get("SEEN_LRU_SIZE", "100000"))
+SEEN_BLOOM_CAPACITY = int(os.environ.get("SEEN_BLOOM_CAPACITY", "1000000"))
+SEEN_BLOOM_FP_RATE = float(os.environ.get("SEEN_BLOOM_FP_RATE", "0.001"))
+SEEN_FILTER_TRUST_BLOOM = os.environ.get("SEEN_FILTER_TRUST_BLOOM", "0") == "1"
+SEEN_WARM_HOURS = int(os.environ.get("SEEN_WARM_HOURS", "24"))
+
+# how each table's ids are spelled, in SQL (for warming) and by the crawlers
+WARM_QUERIES = {
+    "reddit_posts": "SELECT name FROM reddit_posts WHERE created_utc > now()::timestamp - %s * INTERVAL '1 hour';",
+    "reddit_comments": "SELECT name FROM reddit_comments WHERE created_utc > now()::timestamp - %s * INTERVAL '1 hour';",
+    "chan_posts": "SELECT board_name || '/' || post_number FROM chan_posts WHERE created_utc > now()::timestamp - %s * INTERVAL '1 hour';",
+}
+
+
+def chan_key(board, post_number):
+    return f"{board}/{post_number}"
+
+
+class BloomFilter:
+    def __init__(self, capacity, fp_rate):
+        self.capacity = capacity
+        self.size = max(8, int(-capacity * math.log(fp_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        # double hashing: k positions from two 64 bit halves of one digest
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for p in self._positions(key):
+            self.bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+
+class RotatingBloomFilter:
+    """two generations; when the current one is full the older one is dropped"""
+
+    def __init__(self, capacity=SEEN_BLOOM_CAPACITY, fp_rate=SEEN_BLOOM_FP_RATE):
+        self.capacity = capacity
+        self.fp_rate = fp_rate
+        self.current = BloomFilter(capacity, fp_rate)
+        self.previous = None
+        self.rotations = 0
+
+    def add(self, key):
+        if self.current.count >= self.capacity:
+            self.previous = self.current
+            self.current = BloomFilter(self.capacity, self.fp_rate)
+            self.rotations += 1
+        self.current.add(key)
+
+    def __contains__(self, key):
+        return key in self.current or (self.previous is not None and key in self.previous)
+
+
+class SeenFilter:
+    def __init__(self, table, lru_size=SEEN_LRU_SIZE, trust_bloom=SEEN_FILTER_TRUST_BLOOM):
+        self.table = table
+        self.lru_size = lru_size
+        self.trust_bloom = trust_bloom
+        self._lru = OrderedDict()
+        self._bloom = RotatingBloomFilter()
+        self._lock = threading.Lock()
+        self._stats = {
+            "checked": 0,
+            "lru_hits": 0,
+            "bloom_hits": 0,
+            "bloom_false_positives": 0,
+            "skipped": 0,
+            "warmed": 0,
+        }
+
+    def _remember(self, key):
+        self._lru[key] = None
+        self._lru.move_to_end(key)
+        if len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+        self._bloom.add(key)
+
+    def warm(self, keys):
+        with self._lock:
+            for key in keys:
+                self._remember(key)
+                self._stats["warmed"] += 1
+
+    def check(self, keys):
+        """
+        Returns (fresh, maybe): the keys to offer to Postgres, and the subset of
+        them the Bloom filter thinks we already have.
+        """
+        fresh = []
+        maybe = set()
+        with self._lock:
+            for key in keys:
+                self._stats["checked"] += 1
+                if key in self._lru:
+                    self._lru.move_to_end(key)
+                    self._stats["lru_hits"] += 1
+                    self._stats["skipped"] += 1
+                elif key in self._bloom:
+                    self._stats["bloom_hits"] += 1
+                    if self.trust_bloom:
+                        self._stats["skipped"] += 1
+                    else:
+                        fresh.append(key)
+                        maybe.add(key)
+                else:
+                    fresh.append(key)
+        return fresh, maybe
+
+    def record(self, offered, inserted, maybe):
+        """after commit: everything offered is now stored, whether we inserted it or not"""
+        inserted = set(inserted)
+        with self._lock:
+            self._stats["bloom_false_positives"] += len(maybe & inserted)
+            for key in offered:
+                self._remember(key)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["lru_size"] = len(self._lru)
+            stats["bloom_rotations"] = self._bloom.rotations
+        checked = stats["checked"] or 1
+        stats["hit_rate"] = (stats["lru_hits"] + stats["bloom_hits"]) / checked
+        stats["skip_rate"] = stats["skipped"] / checked
+        stats["bloom_fp_rate"] = stats["bloom_false_positives"] / (stats["bloom_hits"] or 1)
+        return stats
+
+
+class PassThrough:
+    """SEEN_FILTER=0: every key is fresh"""
+
+    def check(self, keys):
+        return list(keys), set()
+
+    def record(self, offered, inserted, maybe):
+        pass
+
+    def stats(self):
+        return {}
+
+
+_filters = {}
+_filters_pid = None
+_filters_lock = threading.Lock()
+# id(conn) -> [(filter, offered, inserted, maybe)] waiting for the commit
+_pending = {}
+
+
+def _warm(seen, conn):
+    with conn.cursor() as cur:
+        cur.execute(WARM_QUERIES[seen.table], (SEEN_WARM_HOURS,))
+        seen.warm(row[0] for row in cur)
+
+
+def _forget_if_forked():
+    global _filters, _filters_pid, _pending
+    if _filters_pid != os.getpid():
+        # never share (or trust) a filter inherited across a fork
+        _filters = {}
+        _pending = {}
+        _filters_pid = os.getpid()
+
+
+def get_filter(table, conn=None):
+    """
+    this process's filter for `table`, warmed from the database on first use.
+
+    Pass the connection you are holding: warming on a second pool connection
+    would wait on the pool, and with every slot held by a handler that is
+    itself waiting here, nobody gets one. Without a conn (the spool paths)
+    the filter warms on its own checkout, and starts cold if the database
+    can't be reached.
+    """
+    with _filters_lock:
+        _forget_if_forked()
+        if table not in _filters:
+            if not SEEN_FILTER:
+                _filters[table] = PassThrough()
+            else:
+                seen = SeenFilter(table)
+                if conn is not None:
+                    idle = conn.get_transaction_status() == extensions.TRANSACTION_STATUS_IDLE
+                    _warm(seen, conn)
+                    if idle:
+                        # don't leave the caller in a transaction it didn't open
+                        conn.rollback()
+                else:
+                    try:
+                        with db_pool.connection() as own_conn:
+                            _warm(seen, own_conn)
+                            own_conn.rollback()
+                    except (psycopg2.OperationalError, psycopg2.InterfaceError, db_pool.PoolTimeout) as e:
+                        logger.warning(f"couldn't warm {table} filter, starting cold: {e}")
+                logger.info(f"warmed {table} filter with {seen.stats()['warmed']} ids from the last {SEEN_WARM_HOURS}h")
+                _filters[table] = seen
+        return _filters[table]
+
+
+def bypass(*tables):
+    """the SEEN_FILTER=0 path for these tables in this process, so benchmarks can time ON CONFLICT"""
+    with _filters_lock:
+        _forget_if_forked()
+        for table in tables:
+            _filters[table] = PassThrough()
+
+
+def stage(conn, table, offered, inserted, maybe):
+    """remember an insert made on conn, applied by transaction() once it commits"""
+    _pending.setdefault(id(conn), []).append((get_filter(table, conn), offered, inserted, maybe))
+
+
+@contextmanager
+def transaction(conn):
+    """`with conn:` that also feeds the staged ids to the filters on commit"""
+    try:
+        with conn:
+            yield conn
+    except Exception:
+        _pending.pop(id(conn), None)
+        raise
+    for seen, offered, inserted, maybe in _pending.pop(id(conn), []):
+        seen.record(offered, inserted, maybe)
+
+
+def filter_stats():
+    return {table: seen.stats() for table, seen in _filters.items()}
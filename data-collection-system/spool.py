@@ -0,0 +1,271 @@
+"""
+Local write-ahead spool between the crawlers and Postgres.
+
+With SPOOL_MODE set, parsed rows (and crawl state) are appended to segment
+files under SPOOL_DIR instead of being lost when the database is slow or
+down, and spool_loader.py drains them into Postgres in large batches:
+
+    off       no spooling, database errors propagate (default)
+    fallback  write to Postgres as before; if that fails with a connection
+              error, spool the rows and carry on
+    always    rows and the listing jobs' crawl state always go to the
+              spool, the crawler never waits on an insert/commit
+
+Segment format: a sequence of records, each a 4-byte big-endian payload
+length, a 4-byte CRC32 of the payload, and the JSON payload:
+
+    {"type": "rows", "table": ..., "columns": [...], "rows": [[...], ...]}
+    {"type": "state", "source": ..., "seen": ..., "watermark": ..., "stats": ..., "at": unix time}
+
+A job's records go to one "<ms>-<pid>-<seq>.open" file; commit() fsyncs it
+once (however many records the job wrote) and renames it to ".seg", which is
+what the loader picks up. The names sort by creation time, so state records
+are applied in the order they were written. Until the loader gets to them,
+load_state() reads spooled state records back, so the next poll diffs
+against what the last one saw rather than an older state in Postgres. A torn record at the end of a
+segment (a crash mid-append) fails its length/CRC check and is dropped with
+everything after it.
+"""
+
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+import psycopg2
+
+import crawl_state
+import db_pool
+
+logger = logging.getLogger("spool")
+logger.propagate = False
+
+log_level_str = os.getenv("LOG_LEVEL", "INFO").upper()
+numeric_level = getattr(logging, log_level_str, logging.INFO)
+
+logger.setLevel(numeric_level)
+if not logger.handlers:
+    sh = logging.StreamHandler()
+    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    sh.setFormatter(formatter)
+    logger.addHandler(sh)
+
+
+SPOOL_MODE = os.environ.get("SPOOL_MODE", "off")
+SPOOL_DIR = os.environ.get("SPOOL_DIR", "spool")
+# turn off only for benchmarks; without fsync a crash can lose committed records
+SPOOL_FSYNC = os.environ.get("SPOOL_FSYNC", "1") == "1"
+
+HEADER = struct.Struct(">II")
+
+# the errors that mean "the database is unreachable", as opposed to bad data
+DB_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, db_pool.PoolTimeout)
+
+
+def spool_first():
+    return SPOOL_MODE == "always"
+
+
+def can_fallback():
+    return SPOOL_MODE in ("fallback", "always")
+
+
+def encode_value(value):
+    # rows carry datetimes (created_utc); Postgres reads them back from ISO strings
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    raise TypeError(f"can't spool {type(value).__name__}")
+
+
+def encode_record(record):
+    payload = json.dumps(record, default=encode_value).encode("utf-8")
+    return HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def read_records(path):
+    """the intact records of a segment; stops at the first torn or corrupt one"""
+    records = []
+    with open(path, "rb") as file:
+        data = file.read()
+    offset = 0
+    while offset + HEADER.size <= len(data):
+        length, crc = HEADER.unpack_from(data, offset)
+        start = offset + HEADER.size
+        payload = data[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            logger.warning(f"{path}: torn record at byte {offset}, dropping the rest of the segment")
+            break
+        records.append(json.loads(payload))
+        offset = start + length
+    return records
+
+
+class SpoolWriter:
+    def __init__(self, directory=SPOOL_DIR, fsync=SPOOL_FSYNC):
+        self.directory = directory
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._file = None
+        self._path = None
+        self._seq = 0
+        self._stats = {"records": 0, "rows": 0, "bytes": 0, "segments": 0, "fsyncs": 0}
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._seq += 1
+        name = f"{int(time.time() * 1000):013d}-{os.getpid()}-{self._seq:06d}"
+        self._path = os.path.join(self.directory, name + ".open")
+        self._file = open(self._path, "ab")
+
+    def append(self, record):
+        data = encode_record(record)
+        with self._lock:
+            if self._file is None:
+                self._open()
+            self._file.write(data)
+            self._stats["records"] += 1
+            self._stats["rows"] += len(record.get("rows", ()))
+            self._stats["bytes"] += len(data)
+
+    def commit(self):
+        """make everything appended so far durable and hand it to the loader"""
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+                self._stats["fsyncs"] += 1
+            self._file.close()
+            sealed = self._path[: -len(".open")] + ".seg"
+            os.replace(self._path, sealed)
+            if self.fsync:
+                # the rename itself has to survive a crash too
+                dir_fd = os.open(self.directory, os.O_RDONLY)
+                try:
+                    os.fsync(dir_fd)
+                finally:
+                    os.close(dir_fd)
+            self._stats["segments"] += 1
+            self._file = None
+            self._path = None
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+_writer = None
+_writer_pid = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    global _writer, _writer_pid
+    with _writer_lock:
+        if _writer is None or _writer_pid != os.getpid():
+            _writer = SpoolWriter()
+            _writer_pid = os.getpid()
+        return _writer
+
+
+def append_rows(table, columns, rows):
+    get_writer().append({"type": "rows", "table": table, "columns": list(columns), "rows": [list(row) for row in rows]})
+
+
+def append_state(source, seen, watermark=None, stats=None):
+    # "at" lets the loader skip this if the state was written directly since
+    get_writer().append({"type": "state", "source": source, "seen": seen, "watermark": watermark, "stats": stats, "at": time.time()})
+
+
+def commit():
+    get_writer().commit()
+
+
+def save_state(source, seen, watermark=None, stats=None):
+    """
+    crawl_state.save_state, spooled instead if the database is unreachable.
+    SPOOL_MODE=always spools it straight away, behind the rows it describes.
+    """
+    if spool_first():
+        append_state(source, seen, watermark, stats)
+        commit()
+        return
+    try:
+        crawl_state.save_state(source, seen, watermark, stats=stats)
+    except DB_ERRORS as e:
+        if not can_fallback():
+            raise
+        logger.warning(f"database unavailable ({e}), spooling state for {source}")
+        append_state(source, seen, watermark, stats)
+        commit()
+
+
+# sealed segment path -> {source: its last state record}; segments never
+# change once sealed, so each is read once per process
+_segment_states = {}
+_segment_states_lock = threading.Lock()
+
+
+def _states_in(path):
+    states = _segment_states.get(path)
+    if states is None:
+        states = {}
+        for record in read_records(path):
+            if record["type"] == "state":
+                states[record["source"]] = record
+        _segment_states[path] = states
+    return states
+
+
+def latest_spooled_state(source, directory=SPOOL_DIR):
+    """the newest state record for source still waiting for the loader, or None"""
+    try:
+        names = sorted(name for name in os.listdir(directory) if name.endswith(".seg"))
+    except FileNotFoundError:
+        return None
+    paths = [os.path.join(directory, name) for name in names]
+    with _segment_states_lock:
+        for loaded in set(_segment_states) - set(paths):
+            del _segment_states[loaded]
+        for path in reversed(paths):
+            try:
+                states = _states_in(path)
+            except FileNotFoundError:
+                # the loader took it in the meantime; its state is in crawl_state now
+                continue
+            if source in states:
+                return states[source]
+    return None
+
+
+def load_state(source):
+    """
+    crawl_state.load_state that also sees state still waiting in the spool.
+
+    With SPOOL_MODE=always every state write goes through the spool, so a
+    spooled state is the newest one and the database isn't asked at all. In
+    fallback mode the newer of the two wins, and if the database can't be
+    reached the spooled state is used. Without either this raises, and the
+    job is retried.
+    """
+    spooled = latest_spooled_state(source) if can_fallback() else None
+    if spooled is not None and spool_first():
+        return spooled["seen"], spooled["watermark"]
+    try:
+        seen, watermark, updated_at = crawl_state.load_state_at(source)
+    except DB_ERRORS as e:
+        if spooled is None:
+            raise
+        logger.warning(f"database unavailable ({e}), using spooled state for {source}")
+        return spooled["seen"], spooled["watermark"]
+    if spooled is not None and (updated_at is None or spooled["at"] > updated_at):
+        return spooled["seen"], spooled["watermark"]
+    return seen, watermark
+
+
+def spool_stats():
+    return get_writer().stats()
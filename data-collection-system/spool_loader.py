@@ -0,0 +1,206 @@
+"""
+Drains the crawler spool (see spool.py) into Postgres.
+
+Sealed segments are loaded oldest first, many at a time: their rows are
+grouped per table and written with one COPY upsert each, and their crawl
+state records are applied, all in one transaction covering up to
+SPOOL_LOAD_BATCH_BYTES of segments. Segments are deleted only after that
+commits, so a loader that dies mid-batch just loads the same segments again
+on restart; the upserts make that a no-op, and state records older than
+what is already in crawl_state are ignored.
+
+A segment that fails for a reason other than the database being unreachable
+is retried on its own and then moved to SPOOL_DIR/failed. ".open" segments
+older than SPOOL_STALE_S belong to a crawler that died before sealing them
+and are loaded as far as their records are intact.
+
+Every batch logs the spool lag: segments and bytes waiting, and the age of
+the oldest one.
+
+    python spool_loader.py [--once]
+"""
+
+import logging
+import os
+import sys
+import time
+
+from psycopg2.extras import Json
+
+import bulk_load
+import db_pool
+import spool
+
+logger = logging.getLogger("spool loader")
+logger.propagate = False
+
+log_level_str = os.getenv("LOG_LEVEL", "INFO").upper()
+numeric_level = getattr(logging, log_level_str, logging.INFO)
+
+logger.setLevel(numeric_level)
+if not logger.handlers:
+    sh = logging.StreamHandler()
+    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    sh.setFormatter(formatter)
+    logger.addHandler(sh)
+
+
+SPOOL_LOAD_BATCH_BYTES = int(os.environ.get("SPOOL_LOAD_BATCH_BYTES", str(64 * 2**20)))
+SPOOL_LOAD_INTERVAL_S = float(os.environ.get("SPOOL_LOAD_INTERVAL_S", "1"))
+SPOOL_STALE_S = float(os.environ.get("SPOOL_STALE_S", "3600"))
+
+# conflict target, returned column and the columns refreshed on conflict
+# (with the rows they apply to) for each table the crawlers spool into
+SPOOL_TABLES = {
+    "reddit_posts": (("name", "created_utc"), "name", (), None),
+    "reddit_comments": (("name", "created_utc"), "name", (), None),
+    # thread OPs carry the reply count, which keeps changing after first sight
+    "chan_posts": (("board_name", "post_number", "created_utc"), "post_number", ("num_replies", "data"), "chan_posts.resto = 0"),
+}
+
+STATE_UPSERT = (
+    "INSERT INTO crawl_state (source, seen, watermark, stats, updated_at) VALUES (%s, %s, %s, %s, to_timestamp(%s)) "
+    "ON CONFLICT (source) DO UPDATE SET seen = EXCLUDED.seen, watermark = EXCLUDED.watermark, stats = EXCLUDED.stats, "
+    "updated_at = EXCLUDED.updated_at "
+    "WHERE crawl_state.updated_at < EXCLUDED.updated_at;"
+)
+
+
+def segment_created(path):
+    """creation time encoded in the segment name, in seconds"""
+    return int(os.path.basename(path).split("-", 1)[0]) / 1000
+
+
+def pending_segments(directory=spool.SPOOL_DIR):
+    if not os.path.isdir(directory):
+        return []
+    now = time.time()
+    paths = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.endswith(".seg"):
+            paths.append(path)
+        elif name.endswith(".open") and now - os.path.getmtime(path) > SPOOL_STALE_S:
+            logger.warning(f"adopting abandoned segment {name}")
+            sealed = path[: -len(".open")] + ".seg"
+            os.replace(path, sealed)
+            paths.append(sealed)
+    return sorted(paths, key=os.path.basename)
+
+
+def lag_stats(paths):
+    now = time.time()
+    sizes = []
+    for path in paths:
+        try:
+            sizes.append(os.path.getsize(path))
+        except FileNotFoundError:
+            pass
+    return {
+        "segments": len(paths),
+        "bytes": sum(sizes),
+        "oldest_s": round(now - segment_created(paths[0]), 1) if paths else 0.0,
+    }
+
+
+def load_segments(conn, paths):
+    """write the records of these segments in one transaction; returns rows inserted/offered"""
+    rows_by_table = {}
+    states = {}
+    for path in paths:
+        for record in spool.read_records(path):
+            if record["type"] == "rows":
+                key = (record["table"], tuple(record["columns"]))
+                rows_by_table.setdefault(key, []).extend(record["rows"])
+            elif record["type"] == "state":
+                # later records for a source win
+                states[record["source"]] = record
+
+    inserted = offered = 0
+    with conn:
+        with conn.cursor() as cur:
+            for (table, columns), rows in rows_by_table.items():
+                conflict_columns, returning, update_columns, update_where = SPOOL_TABLES[table]
+                inserted += len(bulk_load.copy_upsert(cur, table, columns, rows, conflict_columns, returning, update_columns, update_where))
+                offered += len(rows)
+            for source, record in states.items():
+                cur.execute(STATE_UPSERT, (source, Json(record["seen"]), Json(record["watermark"]), Json(record.get("stats")), record["at"]))
+    return inserted, offered
+
+
+def next_batch(paths):
+    """oldest segments up to SPOOL_LOAD_BATCH_BYTES (at least one)"""
+    batch = []
+    total = 0
+    for path in paths:
+        size = os.path.getsize(path)
+        if batch and total + size > SPOOL_LOAD_BATCH_BYTES:
+            break
+        batch.append(path)
+        total += size
+    return batch
+
+
+def quarantine(path):
+    failed_dir = os.path.join(os.path.dirname(path), "failed")
+    os.makedirs(failed_dir, exist_ok=True)
+    os.replace(path, os.path.join(failed_dir, os.path.basename(path)))
+    logger.error(f"moved {os.path.basename(path)} to {failed_dir}")
+
+
+def load_once():
+    """load one batch; returns the number of segments taken off the spool"""
+    paths = pending_segments()
+    if not paths:
+        return 0
+    batch = next_batch(paths)
+    start = time.perf_counter()
+    try:
+        with db_pool.connection() as conn:
+            inserted, offered = load_segments(conn, batch)
+    except spool.DB_ERRORS:
+        raise
+    except Exception as e:
+        if len(batch) > 1:
+            logger.warning(f"batch of {len(batch)} segments failed ({e}), loading them one by one")
+            for path in batch:
+                try:
+                    with db_pool.connection() as conn:
+                        load_segments(conn, [path])
+                    os.remove(path)
+                except spool.DB_ERRORS:
+                    raise
+                except Exception as e:
+                    logger.error(f"{os.path.basename(path)} failed: {e}")
+                    quarantine(path)
+        else:
+            logger.error(f"{os.path.basename(batch[0])} failed: {e}")
+            quarantine(batch[0])
+        return len(batch)
+
+    for path in batch:
+        os.remove(path)
+    elapsed = time.perf_counter() - start
+    logger.info(
+        f"loaded {len(batch)} segments: {inserted} of {offered} rows new in {elapsed:.2f}s, "
+        f"lag {lag_stats(paths[len(batch):])}"
+    )
+    return len(batch)
+
+
+if __name__ == "__main__":
+    once = "--once" in sys.argv[1:]
+    logger.info(f"draining {spool.SPOOL_DIR}")
+    while True:
+        try:
+            loaded = load_once()
+        except spool.DB_ERRORS as e:
+            logger.warning(f"database unavailable ({e}), lag {lag_stats(pending_segments())}")
+            if once:
+                break
+            loaded = 0
+            time.sleep(SPOOL_LOAD_INTERVAL_S * 5)
+        if once and not loaded:
+            break
+        if not loaded:
+            time.sleep(SPOOL_LOAD_INTERVAL_S)
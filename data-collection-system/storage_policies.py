@@ -0,0 +1,141 @@
+"""
+Apply the TimescaleDB compression/retention settings for the hypertables.
+
+The hypertable_compression migration turns on compression with a 7 day
+policy. This script re-applies the policies from the environment, so they
+can be tuned without another migration:
+
+    STORAGE_COMPRESS_AFTER   compress chunks older than this (default "7 days")
+    STORAGE_DATA_RETENTION   strip the raw `data` JSONB of rows older than this
+                             down to STORAGE_KEEP_KEYS (default "": keep it all).
+                             Must be shorter than STORAGE_COMPRESS_AFTER, rows
+                             are rewritten before they get compressed
+    STORAGE_DROP_AFTER       drop whole chunks older than this (default "": never)
+
+    python storage_policies.py            apply the policies
+    python storage_policies.py --status   print sizes, chunk counts and jobs
+"""
+
+import logging
+import os
+import sys
+
+import psycopg2
+from psycopg2.extras import Json
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger("storage policies")
+logger.propagate = False
+
+log_level_str = os.getenv("LOG_LEVEL", "INFO").upper()
+numeric_level = getattr(logging, log_level_str, logging.INFO)
+
+logger.setLevel(numeric_level)
+if not logger.handlers:
+    sh = logging.StreamHandler()
+    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    sh.setFormatter(formatter)
+    logger.addHandler(sh)
+
+
+DATABASE_URL = os.environ.get("DATABASE_URL")
+STORAGE_COMPRESS_AFTER = os.environ.get("STORAGE_COMPRESS_AFTER", "7 days")
+STORAGE_DATA_RETENTION = os.environ.get("STORAGE_DATA_RETENTION", "")
+STORAGE_DROP_AFTER = os.environ.get("STORAGE_DROP_AFTER", "")
+
+HYPERTABLES = ("reddit_posts", "reddit_comments", "chan_posts")
+
+# keys of `data` still read after ingestion (comment tree backfill, dashboards)
+STORAGE_KEEP_KEYS = {
+    "reddit_posts": ["subreddit", "num_comments", "score", "permalink"],
+    "reddit_comments": ["subreddit", "score"],
+    "chan_posts": ["name", "replies"],
+}
+
+
+def interval_seconds(cur, interval):
+    cur.execute("SELECT extract(epoch FROM %s::interval);", (interval,))
+    return float(cur.fetchone()[0])
+
+
+def apply_policies(conn):
+    with conn:
+        with conn.cursor() as cur:
+            if STORAGE_DATA_RETENTION and interval_seconds(cur, STORAGE_DATA_RETENTION) >= interval_seconds(cur, STORAGE_COMPRESS_AFTER):
+                raise ValueError(
+                    f"STORAGE_DATA_RETENTION ({STORAGE_DATA_RETENTION}) must be shorter than "
+                    f"STORAGE_COMPRESS_AFTER ({STORAGE_COMPRESS_AFTER})"
+                )
+
+            for table in HYPERTABLES:
+                cur.execute("SELECT remove_compression_policy(%s, if_exists => true);", (table,))
+                cur.execute("SELECT add_compression_policy(%s, %s::interval);", (table, STORAGE_COMPRESS_AFTER))
+                cur.execute("SELECT remove_retention_policy(%s, if_exists => true);", (table,))
+                if STORAGE_DROP_AFTER:
+                    cur.execute("SELECT add_retention_policy(%s, %s::interval);", (table, STORAGE_DROP_AFTER))
+                logger.info(
+                    f"{table}: compress after {STORAGE_COMPRESS_AFTER}, "
+                    f"drop after {STORAGE_DROP_AFTER or 'never'}"
+                )
+
+            cur.execute("SELECT delete_job(job_id) FROM timescaledb_information.jobs WHERE proc_name = 'strip_raw_data';")
+            if STORAGE_DATA_RETENTION:
+                config = {"older_than": STORAGE_DATA_RETENTION, "tables": STORAGE_KEEP_KEYS}
+                cur.execute("SELECT add_job('strip_raw_data', INTERVAL '1 hour', config => %s);", (Json(config),))
+                logger.info(f"raw data stripped after {STORAGE_DATA_RETENTION}, keeping {STORAGE_KEEP_KEYS}")
+            else:
+                logger.info("raw data kept until the rows are dropped")
+
+
+def storage_status(conn):
+    """per table: chunks, compressed chunks, bytes before/after compression"""
+    status = {}
+    with conn.cursor() as cur:
+        for table in HYPERTABLES:
+            cur.execute("SELECT count(*) FROM show_chunks(%s);", (table,))
+            chunks = cur.fetchone()[0]
+            cur.execute("SELECT total_bytes FROM hypertable_detailed_size(%s);", (table,))
+            total_bytes = cur.fetchone()[0]
+            cur.execute(
+                "SELECT number_compressed_chunks, before_compression_total_bytes, after_compression_total_bytes "
+                "FROM hypertable_compression_stats(%s);",
+                (table,),
+            )
+            compressed_chunks, before, after = cur.fetchone() or (0, None, None)
+            status[table] = {
+                "chunks": chunks,
+                "compressed_chunks": compressed_chunks or 0,
+                "total_bytes": total_bytes,
+                "before_compression_bytes": before,
+                "after_compression_bytes": after,
+            }
+    conn.rollback()
+    return status
+
+
+def print_jobs(conn):
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT job_id, proc_name, hypertable_name, schedule_interval, config "
+            "FROM timescaledb_information.jobs WHERE hypertable_name = ANY(%s) OR proc_name = 'strip_raw_data' "
+            "ORDER BY job_id;",
+            (list(HYPERTABLES),),
+        )
+        for row in cur.fetchall():
+            print(row)
+    conn.rollback()
+
+
+if __name__ == "__main__":
+    conn = psycopg2.connect(dsn=DATABASE_URL)
+    try:
+        if "--status" in sys.argv[1:]:
+            for table, stats in storage_status(conn).items():
+                print(table, stats)
+            print_jobs(conn)
+        else:
+            apply_policies(conn)
+    finally:
+        conn.close()
@@ -0,0 +1,63 @@
+import os
+
+import pandas as pd
+import psycopg2
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# the crawlers' TimescaleDB; when set, the Activity tab reads the 15 minute
+# continuous aggregates instead of binning the CSV exports
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+# dataset -> (continuous aggregate, column the counts are grouped by)
+ACTIVITY_VIEWS = {
+    "reddit_posts": ("reddit_posts_activity_15m", "flair"),
+    "reddit_comments": ("reddit_comments_activity_15m", "subreddit_id"),
+    "chan_posts": ("chan_posts_activity_15m", "board_name"),
+}
+
+BASE_BIN = pd.Timedelta("15min")
+
+
+def bin_seconds(bin_freq):
+    """seconds in a FREQ_MAP bin size; it has to be a whole number of 15 minute buckets"""
+    width = pd.Timedelta(bin_freq)
+    if width < BASE_BIN or width % BASE_BIN != pd.Timedelta(0):
+        raise ValueError(f"bin size {bin_freq} is not a multiple of 15 minutes")
+    return int(width.total_seconds())
+
+
+def activity_counts(ds, bin_freq, start=None, end=None, tz="America/New_York"):
+    """
+    Counts per group and bin, rolled up from the 15 minute aggregates.
+
+    Returns the same frame the Activity tab builds from the CSVs: one row per
+    (group, bin) with a `count`, bins being naive local times in `tz` floored
+    the way pandas' dt.floor(bin_freq) does it. start/end (naive local times)
+    restrict the range.
+    """
+    view, group_col = ACTIVITY_VIEWS[ds]
+    # created_utc is stored as naive UTC; bucket in local time from the same
+    # 1970-01-01 origin pandas floors from
+    local = f"(bucket AT TIME ZONE 'UTC') AT TIME ZONE %(tz)s"
+    where = []
+    if start is not None:
+        where.append(f"{local} >= %(start)s")
+    if end is not None:
+        where.append(f"{local} < %(end)s")
+    query = (
+        f"SELECT {group_col}, time_bucket(%(width)s * INTERVAL '1 second', {local}, TIMESTAMP '1970-01-01') AS bin, "
+        f"sum(count)::bigint AS count FROM {view} "
+        + (f"WHERE {' AND '.join(where)} " if where else "")
+        + "GROUP BY 1, 2 ORDER BY 2, 1;"
+    )
+    params = {"tz": tz, "width": bin_seconds(bin_freq), "start": start, "end": end}
+    conn = psycopg2.connect(dsn=DATABASE_URL)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(query, params)
+            rows = cur.fetchall()
+    finally:
+        conn.close()
+    return pd.DataFrame(rows, columns=[group_col, "bin", "count"])
@@ -3,6 +3,7 @@ import pandas as pd
 import plotly.express as px
 from datetime import date
 from utils import *
+import activity
 
 DATA_FILES = {
     "reddit_posts": "../data/reddit_posts_labelled_filtered_2025-10-31_to_2025-11-14.csv",
@@ -46,8 +47,12 @@ def load_data():
         df2 = pd.read_csv(PERSPECTIVE_FILES[ds])
         out[ds] = pd.concat([df1.reset_index(drop=True), df2[PERSPECTIVE_COLS].reset_index(drop=True)],axis=1)
     return out
-ALL_DATA = load_data()
+@st.cache_data(show_spinner=False, ttl=300)
+def activity_counts_cached(ds, bin_freq):
+    return activity.activity_counts(ds, bin_freq)
 dashboard = st.sidebar.selectbox("Dashboard", ["Activity", "Toxicity", "Sports", "All"], index=0)
+# the DB-backed Activity tab needs no CSVs, so a deployment without them can still show it
+ALL_DATA = {} if dashboard == "Activity" and activity.DATABASE_URL else load_data()
 # -------------------- ACTIVITY TAB
 if dashboard == "Activity":
     ds = st.sidebar.selectbox("Dataset", list(DATA_FILES.keys()))
@@ -55,13 +60,18 @@ if dashboard == "Activity":
     bin_freq = FREQ_MAP[freq]
     with st.container():
         st.markdown("## Activity Overview")
-        df = ALL_DATA[ds].copy()
-        group_col = "flair" if ds.startswith("reddit") else "label"
-        df["created_utc"] = (pd.to_datetime(df["created_utc"], utc=True).dt.tz_convert("America/New_York").dt.tz_localize(None))
-        df = df.rename(columns={"created_utc": "created_est"})        
-        df["bin"] = df["created_est"].dt.floor(bin_freq)
-        #create df groupbed by flair / label
-        agg = (df.groupby([group_col, "bin"]).size().rename("count").reset_index())
+        if activity.DATABASE_URL:
+            # pre-binned counts from the continuous aggregates
+            group_col = activity.ACTIVITY_VIEWS[ds][1]
+            agg = activity_counts_cached(ds, bin_freq)
+        else:
+            df = ALL_DATA[ds].copy()
+            group_col = "flair" if ds.startswith("reddit") else "label"
+            df["created_utc"] = (pd.to_datetime(df["created_utc"], utc=True).dt.tz_convert("America/New_York").dt.tz_localize(None))
+            df = df.rename(columns={"created_utc": "created_est"})        
+            df["bin"] = df["created_est"].dt.floor(bin_freq)
+            #create df groupbed by flair / label
+            agg = (df.groupby([group_col, "bin"]).size().rename("count").reset_index())
         full = pd.date_range(agg["bin"].min(), agg["bin"].max(), freq=bin_freq)
         pivot = (agg.pivot(index=group_col, columns="bin", values="count").reindex(columns=full).fillna(0))
         #plot lineplot
@@ -5,6 +5,7 @@
 # - Skips rows already scored (using row_key)
 # - Repairs/normalizes existing output CSVs even if they are headerless/shifted
 # - Safe temp-file commits (won’t crash if tmp not written)
+# - Optional concurrent scoring (--workers) paced by a shared token bucket (--qps)
 
 #!/usr/bin/env python3
 import os
@@ -15,7 +16,9 @@ import math
 import hashlib
 import logging
 import sqlite3
+import threading
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Optional, Tuple, List
 
 import pandas as pd
@@ -93,6 +96,67 @@ def detect_has_header(path: str, expected_first_col: str) -> bool:
         return False
 
 
+class TokenBucket:
+    """
+    Request budget shared by all worker threads: `qps` tokens per second, up to
+    `burst` saved up. A 429/503 halves the rate and pauses everyone; each
+    success then adds back a little until we're at `qps` again. Requests that
+    were already in flight when the rate was cut don't cut it again, so a
+    burst of 429s across workers counts as one.
+    """
+
+    def __init__(self, qps: float, burst: Optional[float] = None, min_qps: float = 0.1):
+        self.max_rate = qps
+        self.rate = qps
+        self.min_rate = min(min_qps, qps)
+        self.capacity = burst if burst else max(1.0, qps)
+        self.throttled = 0
+        self._last_cut = float("-inf")
+        self._tokens = self.capacity
+        # tokens accrue from here on; pushed into the future while paused
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """wait for a token; returns when it was taken, to pass to throttle()"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now >= self._updated:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return now
+                wait = max(0.0, self._updated - now) + (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def throttle(self, issued_at: float, retry_after: Optional[float] = None) -> None:
+        with self._lock:
+            if issued_at < self._last_cut:
+                # went out at the old rate; the cut it ran into already covers it
+                return
+            now = time.monotonic()
+            self._last_cut = now
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = 0.0
+            pause = retry_after if retry_after else 1.0 / self.rate
+            self._updated = max(self._updated, now + pause)
+            self.throttled += 1
+
+    def succeed(self) -> None:
+        with self._lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + 0.02 * self.max_rate)
+
+
+def _retry_after(r: requests.Response) -> Optional[float]:
+    try:
+        return float(r.headers.get("Retry-After", ""))
+    except ValueError:
+        return None
+
+
 class PerspectiveClient:
     def __init__(
         self,
@@ -101,17 +165,53 @@ class PerspectiveClient:
         max_retries: int = 5,
         timeout_s: int = 30,
         truncate_chars: int = 3000,
+        qps: Optional[float] = None,
+        workers: int = 1,
     ):
         self.api_key = api_key
         self.sleep_s = sleep_s
         self.max_retries = max_retries
         self.timeout_s = timeout_s
         self.truncate_chars = truncate_chars
-        self.session = requests.Session()
         self.url = f"https://commentanalyzer.googleapis.com/v1alpha1/comments:analyze?key={api_key}"
 
         self.requested_attributes = {a: {} for a in ATTRIBUTES}
 
+        # Without qps: serial, sleep_s after every request (the old behaviour).
+        # With qps: requests are paced by a shared token bucket instead, and
+        # analyze_many() spreads them over `workers` threads.
+        self.bucket = TokenBucket(qps) if qps else None
+        self.workers = max(1, workers)
+        self._local = threading.local()
+        self._pool: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def session(self) -> requests.Session:
+        # one Session (connection pool) per worker thread
+        s = getattr(self._local, "session", None)
+        if s is None:
+            s = self._local.session = requests.Session()
+        return s
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    def analyze_many(self, texts: List[str], desc: Optional[str] = None) -> List[Optional[Dict[str, float]]]:
+        """analyze() every text, concurrently if workers > 1; results are in input order"""
+        texts = list(texts)
+        if self.workers == 1:
+            results = map(self.analyze, texts)
+        else:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="perspective")
+            # Executor.map yields in submission order, however the requests finish
+            results = self._pool.map(self.analyze, texts)
+        if tqdm is not None and desc:
+            results = tqdm(results, total=len(texts), desc=desc)
+        return list(results)
+
     def analyze(self, text: str) -> Optional[Dict[str, float]]:
         if not isinstance(text, str):
             return None
@@ -130,11 +230,17 @@ class PerspectiveClient:
         }
 
         for attempt in range(1, self.max_retries + 1):
+            if self.bucket is not None:
+                issued_at = self.bucket.acquire()
             try:
                 r = self.session.post(self.url, json=payload, timeout=self.timeout_s)
 
                 # Rate limit / quota backoff
                 if r.status_code in (429, 503):
+                    if self.bucket is not None:
+                        # slows down every worker, not just this one
+                        self.bucket.throttle(issued_at, _retry_after(r))
+                        continue
                     backoff = self.sleep_s * (2 ** (attempt - 1))
                     jitter = 0.1 * backoff
                     time.sleep(backoff + jitter)
@@ -151,7 +257,10 @@ class PerspectiveClient:
                     out[a.lower()] = v
 
                 # IMPORTANT: sleep ONCE per request (not per attribute)
-                time.sleep(self.sleep_s)
+                if self.bucket is not None:
+                    self.bucket.succeed()
+                else:
+                    time.sleep(self.sleep_s)
                 return out
 
             except Exception as e:
@@ -161,6 +270,7 @@ class PerspectiveClient:
                 backoff = self.sleep_s * (2 ** (attempt - 1))
                 time.sleep(backoff)
 
+        logging.warning(f"Perspective API still rate limited after {self.max_retries} tries, leaving this text unscored")
         return None
 
 
@@ -280,20 +390,8 @@ def process_chan_posts(
             continue
 
         scores_rows = []
-        done_keys = []
-        iterable = todo["text_body"]
-        if tqdm is not None:
-            iterable = tqdm(iterable, total=len(todo), desc=f"[CHAN] chunk {i}")
-
-        for idx, text in enumerate(iterable):
-            if not text:
-                scores_rows.append({a.lower(): None for a in ATTRIBUTES})
-            else:
-                scores = client.analyze(text)
-                if scores is None:
-                    scores_rows.append({a.lower(): None for a in ATTRIBUTES})
-                else:
-                    scores_rows.append(scores)
+        for scores in client.analyze_many(todo["text_body"], desc=f"[CHAN] chunk {i}"):
+            scores_rows.append(scores if scores is not None else {a.lower(): None for a in ATTRIBUTES})
 
         scores_df = pd.DataFrame(scores_rows)
         out_df = pd.concat([todo[["thread_number", "post_number", "text_body"]], scores_df], axis=1)
@@ -364,17 +462,8 @@ def process_reddit_comments(
             continue
 
         scores_rows = []
-        iterable = todo["text"]
-        if tqdm is not None:
-            iterable = tqdm(iterable, total=len(todo), desc=f"[RCOMMENTS] chunk {i}")
-
-        for text in iterable:
-            text = "" if not isinstance(text, str) else text.strip()
-            if not text:
-                scores_rows.append({a.lower(): None for a in ATTRIBUTES})
-            else:
-                scores = client.analyze(text)
-                scores_rows.append(scores if scores is not None else {a.lower(): None for a in ATTRIBUTES})
+        for scores in client.analyze_many(todo["text"], desc=f"[RCOMMENTS] chunk {i}"):
+            scores_rows.append(scores if scores is not None else {a.lower(): None for a in ATTRIBUTES})
 
         scores_df = pd.DataFrame(scores_rows)
         out_df = pd.concat([todo[["link_id", "text"]], scores_df], axis=1)
@@ -504,17 +593,8 @@ def process_reddit_posts(
             continue
 
         scores_rows = []
-        iterable = list(todo_combos)
-        if tqdm is not None:
-            iterable = tqdm(iterable, total=len(todo), desc=f"[RPOSTS] chunk {i}")
-
-        for combo_text in iterable:
-            combo_text = "" if not isinstance(combo_text, str) else combo_text.strip()
-            if not combo_text:
-                scores_rows.append({a.lower(): None for a in ATTRIBUTES})
-            else:
-                scores = client.analyze(combo_text)
-                scores_rows.append(scores if scores is not None else {a.lower(): None for a in ATTRIBUTES})
+        for scores in client.analyze_many(todo_combos, desc=f"[RPOSTS] chunk {i}"):
+            scores_rows.append(scores if scores is not None else {a.lower(): None for a in ATTRIBUTES})
 
         scores_df = pd.DataFrame(scores_rows)
         out_df = pd.concat([todo, scores_df], axis=1)
@@ -552,6 +632,9 @@ def main():
     p.add_argument("--retries", type=int, default=5)
     p.add_argument("--timeout", type=int, default=30)
     p.add_argument("--truncate", type=int, default=3000)
+    p.add_argument("--qps", type=float, default=float(os.getenv("PERSPECTIVE_QPS", "0")),
+                   help="Perspective quota in requests/sec; paces requests with a token bucket instead of --sleep")
+    p.add_argument("--workers", type=int, default=1, help="Concurrent requests (needs --qps)")
 
     p.add_argument("--run-chan", action="store_true")
     p.add_argument("--run-reddit-comments", action="store_true")
@@ -576,12 +659,23 @@ def main():
 
     db_path = os.path.join(base, args.db)
 
+    qps = args.qps
+    if args.workers > 1 and not qps:
+        if args.sleep <= 0:
+            # no pacing to derive a rate from; unthrottled workers would just burn the quota
+            logging.error("--workers with --sleep 0 needs an explicit --qps.")
+            sys.exit(2)
+        qps = 1.0 / args.sleep
+        logging.warning(f"--workers without --qps; limiting to {qps:.2f} req/s (1/--sleep)")
+
     client = PerspectiveClient(
         api_key=args.api_key,
         sleep_s=args.sleep,
         max_retries=args.retries,
         timeout_s=args.timeout,
         truncate_chars=args.truncate,
+        qps=qps or None,
+        workers=args.workers,
     )
 
     state = StateDB(db_path)
@@ -602,7 +696,10 @@ def main():
     except KeyboardInterrupt:
         logging.warning("Interrupted by user (KeyboardInterrupt). Progress is saved; re-run to resume.")
     finally:
+        client.close()
         state.close()
+        if client.bucket is not None:
+            logging.info(f"[PERSPECTIVE] throttled {client.bucket.throttled} times, ending at {client.bucket.rate:.2f} req/s")
 
 
 if __name__ == "__main__":